@@ -0,0 +1,71 @@
+"""
+Segments a directory (or a csv manifest) of NIfTI studies with a trained model.
+Example:
+python batch_inference.py --input ../datasets/MICCAI_BraTS_2018_Data_Training/HGG --output ../predictions \
+    --modalities _t1.nii.gz _t1ce.nii.gz _t2.nii.gz _flair.nii.gz --model UNET3D --inChannels 4 --classes 4 \
+    --pretrained ../saved_models/UNET3D_checkpoints/UNET3D_last_epoch.pth
+"""
+import argparse
+
+import torch
+
+# Lib files
+import lib.medzoo as medzoo
+from lib.visual3D_temp.batch_inference import BatchInference, find_studies
+
+
+def main():
+    args = get_arguments()
+    studies = find_studies(args.input, args.modalities)
+    print('Found {} studies'.format(len(studies)))
+
+    model, _ = medzoo.create_model(args)
+    model.restore_checkpoint(args.pretrained)
+    if args.cuda:
+        model = model.cuda()
+        print("Model transferred in GPU.....")
+
+    pipeline = BatchInference(model, args.output, args.dim, args.classes, overlap=args.overlap,
+                              batch_size=args.batchSz, blend=args.blend, normalization=args.normalization,
+                              memory_budget_mb=args.memory_budget_mb, io_workers=args.io_workers,
+                              foreground_crop=args.foreground_crop)
+    pipeline.run(studies)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, required=True,
+                        help='directory of studies or csv manifest (study_id, modality_0, ..., modality_n)')
+    parser.add_argument('--output', type=str, required=True, help='directory of the predicted label maps')
+    parser.add_argument('--modalities', nargs="+", type=str, default=('.nii.gz',),
+                        help='file name suffix of every modality of a study, in model input order')
+    parser.add_argument('--batchSz', type=int, default=4, help='windows per forward pass')
+    parser.add_argument('--dim', nargs="+", type=int, default=(64, 64, 64))
+    parser.add_argument('--overlap', type=float, default=0.5)
+    parser.add_argument('--blend', type=str, default='gaussian', choices=('gaussian', 'uniform'))
+    parser.add_argument('--normalization', type=str, default='full_volume_mean',
+                        choices=('full_volume_mean', 'mean', 'max', 'max_min', 'brats', 'dataset'))
+    parser.add_argument('--memory_budget_mb', type=float, default=None,
+                        help='bound the memory of every prediction (streaming engine, for large scans)')
+    parser.add_argument('--io_workers', type=int, default=2, help='decode + preprocess threads')
+    parser.add_argument('--foreground_crop', action='store_true', default=False,
+                        help='predict only the bounding box of the non-zero voxels, the background is labelled 0')
+    parser.add_argument('--classes', type=int, default=4)
+    parser.add_argument('--inChannels', type=int, default=4)
+    parser.add_argument('--model', type=str, default='UNET3D',
+                        choices=('VNET', 'VNET2', 'UNET3D', 'DENSENET1', 'DENSENET2', 'DENSENET3', 'HYPERDENSENET',
+                                 'SKIPDENSENET3D', 'DENSEVOXELNET', 'HIGHRESNET', 'RESNETMED3D', 'RESNET3DVAE'))
+    parser.add_argument('--pretrained', type=str, required=True, metavar='PATH',
+                        help='path to the model checkpoint')
+    parser.add_argument('--opt', type=str, default='sgd', choices=('sgd', 'adam', 'rmsprop'))
+    parser.add_argument('--lr', default=1e-2, type=float)
+    parser.add_argument('--cuda', action='store_true', default=False)
+
+    args = parser.parse_args()
+    args.dim = tuple(args.dim)
+    args.cuda = args.cuda and torch.cuda.is_available()
+    return args
+
+
+if __name__ == '__main__':
+    main()
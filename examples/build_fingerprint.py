@@ -0,0 +1,32 @@
+"""
+Scans a dataset once, in parallel, and saves its intensity fingerprint (foreground percentiles,
+mean and std of every modality) in the training folder, for --normalization dataset.
+Example:
+python build_fingerprint.py covid19seg --path ../datasets --workers 8
+"""
+import argparse
+
+from lib.medloaders.fingerprint import build_fingerprint
+from lib.medloaders.manifest import dataset_layouts
+
+
+def main():
+    args = get_arguments()
+    build_fingerprint(args.dataset_name, args.path, bin_width=args.bin_width, workers=args.workers,
+                      low_percentile=args.low_percentile, high_percentile=args.high_percentile)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset_name', type=str, choices=sorted(dataset_layouts))
+    parser.add_argument('--path', type=str, default='.././datasets', help='datasets root folder')
+    parser.add_argument('--workers', type=int, default=1, help='subjects scanned in parallel')
+    parser.add_argument('--bin_width', type=float, default=1.0,
+                        help='intensity histogram bin width, percentiles are exact for integer data with 1')
+    parser.add_argument('--low_percentile', type=float, default=0.5, help='lower clipping percentile')
+    parser.add_argument('--high_percentile', type=float, default=99.5, help='upper clipping percentile')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
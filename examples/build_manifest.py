@@ -0,0 +1,26 @@
+"""
+Scans a dataset once and saves its manifest (paths, headers, intensity and label statistics)
+in the training folder. The loaders then start from it instead of globbing the tree.
+Example:
+python build_manifest.py brats2019 --path ../datasets --workers 8
+"""
+import argparse
+
+from lib.medloaders.manifest import build_manifest, dataset_layouts
+
+
+def main():
+    args = get_arguments()
+    build_manifest(args.dataset_name, args.path, workers=args.workers)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset_name', type=str, choices=sorted(dataset_layouts))
+    parser.add_argument('--path', type=str, default='.././datasets', help='datasets root folder')
+    parser.add_argument('--workers', type=int, default=1, help='subjects scanned in parallel')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -49,12 +49,50 @@ def get_arguments():
     parser.add_argument('--augmentation', action='store_true', default=True)
     parser.add_argument('--normalization', default='full_volume_mean', type=str,
                         help='Tensor normalization: options ,max_min,',
-                        choices=('max_min', 'full_volume_mean', 'brats', 'max', 'mean'))
+                        choices=('max_min', 'full_volume_mean', 'brats', 'max', 'mean', 'dataset'))
     parser.add_argument('--split', default=0.8, type=float, help='Select percentage of training data(default: 0.8)')
     parser.add_argument('--lr', default=1e-2, type=float,
                         help='learning rate (default: 1e-3)')
     parser.add_argument('--cuda', action='store_true', default=True)
     parser.add_argument('--loadData', default=True)
+    parser.add_argument('--packed', action='store_true', default=False,
+                        help='Store generated sub-volumes in one memory-mapped file per split')
+    parser.add_argument('--online_sampling', action='store_true', default=False,
+                        help='Draw random sub-volumes on the fly instead of generating them to disk')
+    parser.add_argument('--generation_workers', default=1, type=int,
+                        help='Processes used to generate the sub-volumes')
+    parser.add_argument('--volume_cache', default=None, type=str,
+                        help='Directory caching the preprocessed full volumes across runs')
+    parser.add_argument('--shared_memory', action='store_true', default=False,
+                        help='With --online_sampling, decode all subjects once into a shared-memory pool')
+    parser.add_argument('--cache_size', default=8, type=int,
+                        help='With --online_sampling, decoded subjects kept in memory by every loader worker')
+    parser.add_argument('--crops_per_subject', default=4, type=int,
+                        help='With --online_sampling, consecutive sub-volumes cut from every drawn subject')
+    parser.add_argument('--patch_codec', default='float32', type=str, choices=('float32', 'float16', 'int16'),
+                        help='Encoding of the generated image sub-volumes on disk')
+    parser.add_argument('--foreground_crop', action='store_true', default=False,
+                        help='Crop every subject to the bounding box of its non-zero voxels before sampling')
+    parser.add_argument('--class_ratios', nargs="+", type=float, default=None,
+                        help='Centre the crops on a voxel of a class drawn with these weights, background first')
+    parser.add_argument('--grid_validation', action='store_true', default=False,
+                        help='Validate on every crop-sized tile of every validation subject')
+    parser.add_argument('--channel_ids', nargs="+", type=int, default=None,
+                        help='Modalities fed to the model (inChannels indices), default depends on inModalities')
+    parser.add_argument('--elastic', type=str, default='dense', choices=('dense', 'coarse'),
+                        help='Elastic deformation of the augmentation: per-voxel field, or a shared coarse-grid field '
+                             '(faster, larger displacements)')
+    parser.add_argument('--spatial', type=str, default='none', choices=('none', 'affine'),
+                        help='Spatial augmentation besides the flips: none, or rotation, zoom and shift composed '
+                             'into one resampling (RandomAffine)')
+    parser.add_argument('--batch_augmentation', action='store_true', default=False,
+                        help='Augment whole batches with torch ops in the workers, instead of every sample')
+    parser.add_argument('--data_echoing', type=int, default=1,
+                        help='Train k times on every loaded batch, the repeats with cheap augmentations, 0 chooses k '
+                             'from the loader wait and step times')
+    parser.add_argument('--read_ahead', type=int, default=0,
+                        help='Read the files of the next N samples (the next N volumes while generating) ahead in the '
+                             'background, for slow storage such as network filesystems, 0 disables it')
     parser.add_argument('--resume', default='', type=str, metavar='PATH',
                         help='path to latest checkpoint (default: none)')
     parser.add_argument('--model', type=str, default='VNET',
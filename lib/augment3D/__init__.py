@@ -2,15 +2,58 @@ import random
 
 import numpy as np
 
-from .elastic_deform import ElasticTransform
+from .elastic_deform import ElasticTransform, CoarseElasticTransform
 from .random_crop import RandomCropToLabels
 from .random_flip import RandomFlip
 from .random_rescale import RandomZoom
 from .random_rotate import RandomRotation
 from .random_shift import RandomShift
 from .gaussian_noise import GaussianNoise
+from .random_affine import RandomAffine
+from .batch_augment import BatchAugmentation, BatchAugmentCollate, EchoAugmentation
 
-functions = ['elastic_deform', 'random_crop', 'random_flip', 'random_rescale', 'random_rotate', 'random_shift']
+functions = ['elastic_deform', 'random_crop', 'random_flip', 'random_rescale', 'random_rotate', 'random_shift',
+             'random_affine']
+
+
+def apply_transform(t, img_tensors, label):
+    """
+    Applies a transform to every modality of a sample, multi-channel transforms
+    (multichannel = True) get all the modalities in a single call
+    """
+    if getattr(t, 'multichannel', False):
+        return t(img_tensors, label)
+    for i in range(len(img_tensors)):
+
+        if i == (len(img_tensors) - 1):
+            ### do only once the augmentation to the label
+            img_tensors[i], label = t(img_tensors[i], label)
+        else:
+            img_tensors[i], _ = t(img_tensors[i], label)
+    return img_tensors, label
+
+
+def create_elastic_transform(kind='dense'):
+    """
+    'dense': ElasticTransform, a smooth per-voxel field (displacements ~1e-3 voxels)
+    'coarse': CoarseElasticTransform, one shared field for all the modalities, control points moved by up to
+    +-2 voxels. Much faster, but a visibly stronger deformation
+    """
+    if kind == 'coarse':
+        return CoarseElasticTransform()
+    assert kind == 'dense', "unknown elastic transform {}".format(kind)
+    return ElasticTransform()
+
+
+def create_spatial_transform(kind='none'):
+    """
+    'none': no spatial transform besides the flips
+    'affine': RandomAffine, rotation, zoom, shift and flips of all the modalities in a single resampling
+    """
+    if kind == 'affine':
+        return RandomAffine()
+    assert kind == 'none', "unknown spatial transform {}".format(kind)
+    return None
 
 
 class RandomChoice(object):
@@ -30,15 +73,7 @@ class RandomChoice(object):
         if not augment:
             return img_tensors, label
         t = random.choice(self.transforms)
-
-        for i in range(len(img_tensors)):
-
-            if i == (len(img_tensors) - 1):
-                ### do only once the augmentation to the label
-                img_tensors[i], label = t(img_tensors[i], label)
-            else:
-                img_tensors[i], _ = t(img_tensors[i], label)
-        return img_tensors, label
+        return apply_transform(t, img_tensors, label)
 
 
 class ComposeTransforms(object):
@@ -56,12 +91,6 @@ class ComposeTransforms(object):
         if not augment:
             return img_tensors, label
 
-        for i in range(len(img_tensors)):
-
-            for t in self.transforms:
-                if i == (len(img_tensors) - 1):
-                    ### do only once augmentation to the label
-                    img_tensors[i], label = t(img_tensors[i], label)
-                else:
-                    img_tensors[i], _ = t(img_tensors[i], label)
+        for t in self.transforms:
+            img_tensors, label = apply_transform(t, img_tensors, label)
         return img_tensors, label
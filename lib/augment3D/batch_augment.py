@@ -0,0 +1,189 @@
+import math
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+
+"""
+Augmentation of whole collated batches with torch ops: B x C x D x H x W images and B x D x H x W labels.
+Every sample draws its own parameters, as batch tensors, and every transform is applied to the whole
+batch at once: flips, rotations, zoom and shifts are composed into one affine matrix per sample and
+resampled with a single grid_sample call, followed by a multiplicative bias field, gamma and noise.
+The random parameters come from a torch generator seeded with torch.initial_seed(), which the
+DataLoader sets differently in every worker and every epoch.
+"""
+
+
+class BatchAugmentation(object):
+    def __init__(self, p=0.5, flip_probability=0.5, max_angle=10, min_percentage=0.8, max_percentage=1.1,
+                 max_shift=0.2, bias_strength=0.3, bias_points=4, gamma=(0.7, 1.5), noise_std=0.01):
+        """
+        :param p: probability of every transform (spatial, bias, gamma, noise) for every sample
+        :param flip_probability: of every axis, for the samples transformed spatially
+        :param max_angle: rotations are uniform in [-max_angle, max_angle] degrees in every plane
+        :param min_percentage: isotropic zoom range, as RandomZoom
+        :param max_percentage: isotropic zoom range, as RandomZoom
+        :param max_shift: shift range as a fraction of every dimension, as RandomShift
+        :param bias_strength: the log bias field is uniform in [-bias_strength, bias_strength] at its control points
+        :param bias_points: control points of the bias field on every axis
+        :param gamma: gamma range, applied to the intensities rescaled to [0, 1] per sample and channel
+        :param noise_std: maximum std of the additive gaussian noise
+        """
+        self.p = p
+        self.flip_probability = flip_probability
+        self.max_angle = max_angle
+        self.min_percentage = min_percentage
+        self.max_percentage = max_percentage
+        self.max_shift = max_shift
+        self.bias_strength = bias_strength
+        self.bias_points = bias_points
+        self.gamma = gamma
+        self.noise_std = noise_std
+        self.generator = None
+        self.seed = None
+
+    def rand(self, *size):
+        if self.generator is None or self.seed != torch.initial_seed():
+            # a new worker or a new epoch
+            self.seed = torch.initial_seed()
+            self.generator = torch.Generator().manual_seed(self.seed)
+        return torch.rand(*size, generator=self.generator)
+
+    def uniform(self, low, high, *size):
+        return low + (high - low) * self.rand(*size)
+
+    def chosen(self, batch_size):
+        return self.rand(batch_size) < self.p
+
+    def affine_theta(self, batch_size, shape):
+        """
+        B x 3 x 4 affine_grid matrices (align_corners=True) of random rotations, zooms, flips and shifts,
+        drawn in voxel space around the volume centre, identity for the samples not chosen
+        :return: matrices, chosen samples
+        """
+        # voxel to normalized coordinates, in (W, H, D) order
+        scale = torch.tensor([2. / max(s - 1, 1) for s in shape[::-1]])
+        angles = self.uniform(-self.max_angle, self.max_angle, batch_size, 3) * math.pi / 180
+        cos, sin = torch.cos(angles), torch.sin(angles)
+        rotation = torch.eye(3).repeat(batch_size, 1, 1)
+        for axis, (i, j) in enumerate([(0, 1), (1, 2), (0, 2)]):
+            plane = torch.eye(3).repeat(batch_size, 1, 1)
+            plane[:, i, i], plane[:, i, j] = cos[:, axis], -sin[:, axis]
+            plane[:, j, i], plane[:, j, j] = sin[:, axis], cos[:, axis]
+            rotation = rotation @ plane
+        zoom = self.uniform(self.min_percentage, self.max_percentage, batch_size, 1)
+        flips = torch.where(self.rand(batch_size, 3) < self.flip_probability, -1., 1.)
+        linear = rotation * (zoom * flips)[:, None, :]
+        linear = scale[:, None] * linear / scale[None, :]
+        shift = self.uniform(-1, 1, batch_size, 3) * torch.tensor(shape[::-1], dtype=torch.float32) * self.max_shift / 2
+        theta = torch.cat([linear, (scale * shift)[:, :, None]], dim=2)
+        chosen = self.chosen(batch_size)
+        return torch.where(chosen[:, None, None], theta, torch.eye(3, 4).expand_as(theta)), chosen
+
+    def spatial(self, images, labels):
+        batch_size, shape = images.shape[0], tuple(images.shape[2:])
+        theta, chosen = self.affine_theta(batch_size, shape)
+        if not chosen.any():
+            return images, labels
+        grid = F.affine_grid(theta, [batch_size, 1] + list(shape), align_corners=True)
+        images = F.grid_sample(images, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+        if labels is not None:
+            warped = F.grid_sample(labels[:, None].float(), grid, mode='nearest', padding_mode='zeros',
+                                   align_corners=True)
+            labels = warped[:, 0].to(labels.dtype)
+        return images, labels
+
+    def bias_field(self, images):
+        batch_size, shape = images.shape[0], tuple(images.shape[2:])
+        coarse = self.uniform(-self.bias_strength, self.bias_strength, batch_size, 1, *([self.bias_points] * 3))
+        coarse *= self.chosen(batch_size).float()[:, None, None, None, None]
+        field = F.interpolate(coarse, size=shape, mode='trilinear', align_corners=True)
+        return images.mul_(field.exp_())
+
+    def gamma_correction(self, images):
+        batch_size, channels = images.shape[:2]
+        flat = images.view(batch_size, channels, -1)
+        low = flat.amin(dim=2, keepdim=True)
+        extent = (flat.amax(dim=2, keepdim=True) - low).clamp_(min=1e-8)
+        # log-uniform, as many darker as brighter samples
+        gamma = torch.exp(self.uniform(math.log(self.gamma[0]), math.log(self.gamma[1]), batch_size, channels, 1))
+        gamma = torch.where(self.chosen(batch_size)[:, None, None], gamma, torch.ones_like(gamma))
+        flat.sub_(low).div_(extent).pow_(gamma).mul_(extent).add_(low)
+        return images
+
+    def noise(self, images):
+        batch_size = images.shape[0]
+        std = self.uniform(0, self.noise_std, batch_size) * self.chosen(batch_size).float()
+        noise = torch.randn(images.shape, generator=self.generator)
+        return images.add_(noise.mul_(std[:, None, None, None, None]))
+
+    def __call__(self, images, labels=None):
+        """
+        :param images: B x C x D x H x W float tensor
+        :param labels: B x D x H x W label tensor or None
+        :return: augmented images and labels
+        """
+        assert images.dim() == 5, "provide B x C x D x H x W batches"
+        images, labels = self.spatial(images.float(), labels)
+        images = self.noise(self.gamma_correction(self.bias_field(images)))
+        return images, labels
+
+
+class BatchAugmentCollate(object):
+    """
+    DataLoader collate_fn that augments every collated (images, labels) batch, inside the workers
+    """
+
+    def __init__(self, augmentation):
+        self.augmentation = augmentation
+
+    def __call__(self, batch):
+        images, labels = default_collate(batch)
+        return self.augmentation(images, labels)
+
+
+class EchoAugmentation(BatchAugmentation):
+    """
+    Cheap augmentation of echoed batches (data echoing), on the device of the batch:
+    per-sample flips, intensity scale and shift, and gaussian noise.
+    Returns new tensors, the echoed batch is left unchanged for its next echo.
+    """
+
+    def __init__(self, p=0.5, flip_probability=0.5, intensity_scale=0.1, intensity_shift=0.1, noise_std=0.01):
+        """
+        :param intensity_scale: intensities are scaled by a factor uniform in [1 - intensity_scale, 1 + intensity_scale]
+        :param intensity_shift: and shifted by an offset uniform in [-intensity_shift, intensity_shift]
+        """
+        super(EchoAugmentation, self).__init__(p=p, flip_probability=flip_probability, noise_std=noise_std)
+        self.intensity_scale = intensity_scale
+        self.intensity_shift = intensity_shift
+
+    def flips(self, tensor, samples):
+        """
+        Flips the last three axes of the given samples, one random subset of samples per axis
+        """
+        for axis, flipped in zip(range(tensor.dim() - 3, tensor.dim()), samples):
+            index = flipped.nonzero()[:, 0].to(tensor.device)
+            if len(index) > 0:
+                tensor = tensor.index_copy(0, index, tensor.index_select(0, index).flip(axis))
+        return tensor
+
+    def __call__(self, images, labels=None):
+        """
+        :param images: B x C x D x H x W float tensor
+        :param labels: B x D x H x W label tensor or None
+        :return: augmented images and labels
+        """
+        batch_size, channels = images.shape[:2]
+        flipped = (self.rand(3, batch_size) < self.flip_probability) & self.chosen(batch_size)
+        images = self.flips(images, flipped)
+        if labels is not None:
+            labels = self.flips(labels, flipped)
+        chosen = self.chosen(batch_size).float()[:, None]
+        scale = 1 + self.uniform(-self.intensity_scale, self.intensity_scale, batch_size, channels) * chosen
+        shift = self.uniform(-self.intensity_shift, self.intensity_shift, batch_size, channels) * chosen
+        std = self.uniform(0, self.noise_std, batch_size) * self.chosen(batch_size).float()
+        scale, shift = [t.to(images.device)[:, :, None, None, None] for t in (scale, shift)]
+        images = images * scale + shift
+        images += torch.randn_like(images) * std.to(images.device)[:, None, None, None, None]
+        return images, labels
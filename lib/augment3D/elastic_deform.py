@@ -1,4 +1,6 @@
 import numpy as np
+import torch
+import torch.nn.functional as F
 from scipy.interpolate import RegularGridInterpolator
 from scipy.ndimage.filters import gaussian_filter
 
@@ -17,6 +19,9 @@ from scipy.ndimage.filters import gaussian_filter
  Modified to take 3D inputs
  Deforms both the image and corresponding label file
  Label volumes are interpolated via nearest neighbour 
+
+ CoarseElasticTransform draws a single field on a coarse control grid
+ and warps all the modalities and the label with it in one grid_sample pass
  """
 
 
@@ -83,3 +88,100 @@ class ElasticTransform(object):
 
     def __call__(self, img_numpy, label=None):
         return elastic_transform_3d(img_numpy, label, self.alpha, self.sigma, self.c_val, self.method)
+
+
+def linear_upsampling(size, control):
+    """
+    size x control matrix of the linear interpolation (align_corners=True) of control points to size points
+    """
+    position = np.linspace(0, control - 1, size)
+    first = np.minimum(np.floor(position).astype(np.int64), control - 2)
+    weight = position - first
+    matrix = np.zeros((size, control), dtype=np.float32)
+    matrix[np.arange(size), first] = 1 - weight
+    matrix[np.arange(size), first + 1] = weight
+    return torch.from_numpy(matrix)
+
+
+def elastic_sampling_grid(shape, spacing=32, max_displacement=2.0):
+    """
+    Random elastic sampling grid for torch.nn.functional.grid_sample (align_corners=True)
+    Displacements are drawn on a coarse control grid, one point every spacing voxels with the volume
+    corners on the grid, and upsampled trilinearly together with the identity coordinates,
+    which the trilinear upsampling reproduces exactly. The upsampling is separable: one small
+    matrix product per axis, the last one writing the grid straight in grid_sample layout.
+    :param shape: D x H x W volume shape
+    :param spacing: control point spacing in voxels
+    :param max_displacement: control point displacements are uniform in [-max_displacement, max_displacement] voxels
+    :return: 1 x D x H x W x 3 grid of (x, y, z) = (W, H, D) normalized sampling coordinates
+    """
+    control = [max(2, int(np.ceil((s - 1) / spacing)) + 1) for s in shape]
+    # grid_sample coordinates are in (W, H, D) order
+    axes = np.meshgrid(*[np.linspace(-1, 1, c) for c in control], indexing='ij')
+    coarse = np.stack(axes[::-1], axis=-1)
+    # voxels to normalized coordinates
+    scale = np.array([2. / max(s - 1, 1) for s in shape[::-1]])
+    coarse += np.random.uniform(-max_displacement, max_displacement, size=control + [3]) * scale
+    coarse = torch.from_numpy(coarse.astype(np.float32))
+    d, h, w = [linear_upsampling(s, c) for s, c in zip(shape, control)]
+    grid = torch.einsum('dc,chwk->dhwk', d, coarse)
+    grid = torch.einsum('hc,dcwk->dhwk', h, grid)
+    return torch.matmul(w, grid)[None]
+
+
+def warp_3d(images, label, grid, c_val=0.0):
+    """
+    Resamples all the modalities (linear) and the label (nearest) of a sample with the same grid
+    :param images: list of D x H x W modalities
+    :param label: D x H x W label or None
+    :return: list of warped modalities (float32), warped label of the label dtype
+    """
+    stacked = torch.from_numpy(np.stack(images).astype(np.float32, copy=False))[None]
+    if c_val != 0:
+        # zeros padding, shifted to c_val
+        stacked = stacked - c_val
+    warped = F.grid_sample(stacked, grid, mode='bilinear', padding_mode='zeros', align_corners=True)[0]
+    if c_val != 0:
+        warped += c_val
+    warped = warped.numpy()
+    if label is None:
+        return list(warped), label
+    label_tensor = torch.from_numpy(np.asarray(label, dtype=np.float32))[None, None]
+    warped_label = F.grid_sample(label_tensor, grid, mode='nearest', padding_mode='zeros', align_corners=True)
+    return list(warped), warped_label[0, 0].numpy().astype(label.dtype)
+
+
+class CoarseElasticTransform(object):
+    """
+    Elastic deformation with one random field shared by all the modalities and the label.
+    Multi-channel transform: RandomChoice and ComposeTransforms call it once per sample with
+    the list of modalities, instead of once per modality.
+    """
+    multichannel = True
+
+    def __init__(self, spacing=32, max_displacement=2.0, c_val=0.0):
+        """
+        :param spacing: control point spacing in voxels
+        :param max_displacement: maximum control point displacement in voxels
+        :param c_val: fill value
+        """
+        self.spacing = spacing
+        self.max_displacement = max_displacement
+        self.c_val = c_val
+
+    def __call__(self, img_numpy, label=None):
+        """
+        Args:
+            img_numpy (list of numpy or numpy): modalities to be deformed, or a single one.
+            label (numpy): Label segmentation map to be deformed
+
+        Returns:
+            img_numpy (list of numpy or numpy): deformed modalities.
+            label (numpy): deformed Label segmentation map.
+        """
+        single = isinstance(img_numpy, np.ndarray) and img_numpy.ndim == 3
+        images = [img_numpy] if single else list(img_numpy)
+        # a fresh field costs a few % of the warp itself (separable upsampling), it is never reused
+        grid = elastic_sampling_grid(tuple(images[0].shape), self.spacing, self.max_displacement)
+        images, label = warp_3d(images, label, grid, self.c_val)
+        return (images[0] if single else images), label
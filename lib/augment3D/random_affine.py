@@ -0,0 +1,122 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .elastic_deform import warp_3d
+
+"""
+Rotation, scaling, shift and flips composed into a single 4 x 4 matrix per sample,
+applied once to every modality (linear) and to the label (nearest): the sample is
+interpolated a single time, however many spatial transforms are drawn.
+Matrices map output voxel coordinates (d, h, w, 1) to input voxel coordinates,
+as scipy.ndimage.affine_transform.
+"""
+
+
+def rotation_matrix(angle, axes):
+    """
+    :param angle: in degrees
+    :param axes: the two axes of the rotation plane
+    """
+    theta = np.deg2rad(angle)
+    matrix = np.eye(4)
+    i, j = axes
+    matrix[i, i], matrix[i, j] = np.cos(theta), -np.sin(theta)
+    matrix[j, i], matrix[j, j] = np.sin(theta), np.cos(theta)
+    return matrix
+
+
+def scaling_matrix(scales):
+    return np.diag(list(scales) + [1.])
+
+
+def translation_matrix(shift):
+    matrix = np.eye(4)
+    matrix[:3, 3] = shift
+    return matrix
+
+
+def random_affine_matrix(shape, min_angle=-10, max_angle=10, min_percentage=0.8, max_percentage=1.1,
+                         max_shift=0.2, flip_probability=0.5):
+    """
+    Random spatial transform of a volume around its centre
+    :param shape: D x H x W volume shape
+    :param min_angle: in degrees, of every rotation plane
+    :param max_angle: in degrees, of every rotation plane
+    :param min_percentage: isotropic zoom range, as RandomZoom
+    :param max_percentage: isotropic zoom range, as RandomZoom
+    :param max_shift: shift range as a fraction of every dimension, as RandomShift
+    :param flip_probability: of every axis
+    :return: 4 x 4 matrix, output voxel coordinates to input voxel coordinates
+    """
+    centre = (np.array(shape) - 1) / 2.
+    matrix = translation_matrix(centre)
+    for axes in [(1, 0), (1, 2), (0, 2)]:
+        matrix = matrix @ rotation_matrix(np.random.uniform(min_angle, max_angle), axes)
+    zoom = np.random.uniform(min_percentage, max_percentage)
+    flips = np.where(np.random.random(3) < flip_probability, -1., 1.)
+    matrix = matrix @ scaling_matrix(zoom * flips)
+    shift = np.random.uniform(-1, 1, size=3) * np.array(shape) * max_shift / 2
+    return translation_matrix(shift) @ matrix @ translation_matrix(-centre)
+
+
+def affine_sampling_grid(matrix, shape):
+    """
+    grid_sample grid (align_corners=True) of a voxel coordinates matrix
+    :return: 1 x D x H x W x 3 grid of (x, y, z) = (W, H, D) normalized sampling coordinates
+    """
+    # voxel to normalized coordinates, in (W, H, D) order
+    normalize = np.eye(4)
+    normalize[:3, :3] = np.diag([2. / max(s - 1, 1) for s in shape])
+    normalize[:3, 3] = -1
+    reverse = np.eye(4)[[2, 1, 0, 3]]
+    theta = reverse @ normalize @ matrix @ np.linalg.inv(normalize) @ reverse
+    theta = torch.from_numpy(theta[:3].astype(np.float32))[None]
+    return F.affine_grid(theta, [1, 1] + list(shape), align_corners=True)
+
+
+def affine_transform_3d(images, label, matrix, c_val=0.0):
+    """
+    :param images: list of D x H x W modalities
+    :param label: D x H x W label or None
+    :param matrix: 4 x 4 matrix, output voxel coordinates to input voxel coordinates
+    """
+    return warp_3d(images, label, affine_sampling_grid(matrix, tuple(images[0].shape)), c_val)
+
+
+class RandomAffine(object):
+    """
+    Random rotation, zoom, shift and flips in one resampling of the whole sample.
+    Multi-channel transform: RandomChoice and ComposeTransforms call it once per sample
+    with the list of modalities.
+    """
+    multichannel = True
+
+    def __init__(self, min_angle=-10, max_angle=10, min_percentage=0.8, max_percentage=1.1, max_shift=0.2,
+                 flip_probability=0.5, c_val=0.0):
+        self.min_angle = min_angle
+        self.max_angle = max_angle
+        self.min_percentage = min_percentage
+        self.max_percentage = max_percentage
+        self.max_shift = max_shift
+        self.flip_probability = flip_probability
+        self.c_val = c_val
+
+    def matrix(self, shape):
+        return random_affine_matrix(shape, self.min_angle, self.max_angle, self.min_percentage, self.max_percentage,
+                                    self.max_shift, self.flip_probability)
+
+    def __call__(self, img_numpy, label=None):
+        """
+        Args:
+            img_numpy (list of numpy or numpy): modalities to be transformed, or a single one.
+            label (numpy): Label segmentation map to be transformed
+
+        Returns:
+            img_numpy (list of numpy or numpy): transformed modalities.
+            label (numpy): transformed Label segmentation map.
+        """
+        single = isinstance(img_numpy, np.ndarray) and img_numpy.ndim == 3
+        images = [img_numpy] if single else list(img_numpy)
+        images, label = affine_transform_3d(images, label, self.matrix(tuple(images[0].shape)), self.c_val)
+        return (images[0] if single else images), label
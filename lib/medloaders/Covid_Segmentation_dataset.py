@@ -1,12 +1,10 @@
 import glob
 import os
 
-import numpy as np
 from torch.utils.data import Dataset
 
 import lib.utils as utils
-from lib.medloaders import medical_image_process as img_loader
-from lib.medloaders.medical_loader_utils import create_sub_volumes
+from lib.medloaders.medical_loader_utils import create_sub_volumes, load_sub_volume, stack_modalities
 
 
 class COVID_Seg_Dataset(Dataset):
@@ -24,7 +22,7 @@ class COVID_Seg_Dataset(Dataset):
     """
 
     def __init__(self, mode, sub_task='lung', split=0.2, fold=0, n_classes=3, samples=10, dataset_path='../datasets',
-                 crop_dim=(32, 32, 32)):
+                 crop_dim=(32, 32, 32), normalization='max_min', sampling=None):
         print("COVID SEGMENTATION DATASET")
         self.CLASSES = n_classes
         self.fold = int(fold)
@@ -72,12 +70,13 @@ class COVID_Seg_Dataset(Dataset):
 
         self.list = create_sub_volumes(self.list_IDs, self.list_labels, dataset_name='covid19seg', mode=mode,
                                        samples=samples, full_vol_dim=self.full_vol_dim, crop_size=self.crop_size,
-                                       sub_vol_path=self.sub_vol_path)
+                                       sub_vol_path=self.sub_vol_path, normalization=normalization,
+                                       sampling=sampling)
         print("{} SAMPLES =  {}".format(mode, len(self.list)))
 
     def __len__(self):
         return len(self.list)
 
     def __getitem__(self, index):
-        t1_path, seg_path = self.list[index]
-        return np.load(t1_path), np.load(seg_path)
+        *images, segmentation_map = load_sub_volume(self.list[index])
+        return stack_modalities(images, segmentation_map)
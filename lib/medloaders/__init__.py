@@ -1,5 +1,8 @@
 from torch.utils.data import DataLoader
 
+from lib.augment3D import BatchAugmentCollate, BatchAugmentation
+from lib.utils.general import seed_worker
+
 from .COVIDxdataset import COVIDxDataset
 from .Covid_Segmentation_dataset import COVID_Seg_Dataset
 from .brats2018 import MICCAIBraTS2018
@@ -10,49 +13,72 @@ from .iseg2017 import MRIDatasetISEG2017
 from .iseg2019 import MRIDatasetISEG2019
 from .ixi_t1_t2 import IXIMRIdataset
 from .miccai_2019_pathology import MICCAI2019_gleason_pathology
+from .manifest import DatasetManifest, dataset_size
+from .medical_image_process import set_volume_cache
 from .mrbrains2018 import MRIDatasetMRBRAINS2018
+from .read_ahead import read_ahead_sampler
+from .sampling import SamplingOptions
+from .volume_cache import VolumeCache
+
+
+def data_loader(dataset, params, read_ahead=0, **kwargs):
+    """
+    DataLoader of a dataset, that warms the files of the next read_ahead samples if it has any (see ReadAheadSampler)
+    """
+    sampler = read_ahead_sampler(dataset, shuffle=params['shuffle'], depth=read_ahead) if read_ahead > 0 else None
+    if sampler is None:
+        return DataLoader(dataset, **params, **kwargs)
+    return DataLoader(dataset, sampler=sampler, **dict(params, shuffle=False), **kwargs)
 
 
 def generate_datasets(args, path='.././datasets'):
     params = {'batch_size': args.batchSz,
               'shuffle': True,
-              'num_workers': 2}
+              'num_workers': 2,
+              'worker_init_fn': seed_worker}
     samples_train = args.samples_train
     samples_val = args.samples_val
     split_percent = args.split
 
+    if getattr(args, 'volume_cache', None) is not None:
+        set_volume_cache(VolumeCache(cache_dir=args.volume_cache))
+    # how the sub-volumes are produced, shared by the train and val loaders
+    sampling = SamplingOptions.from_args(args)
+
     if args.dataset_name == "iseg2017":
-        total_data = 10
+        total_data = dataset_size("iseg2017", path, default=10)
         split_idx = int(split_percent * total_data)
         train_loader = MRIDatasetISEG2017(args, 'train', dataset_path=path, crop_dim=args.dim,
-                                          split_id=split_idx, samples=samples_train, load=args.loadData)
+                                          split_id=split_idx, samples=samples_train, load=args.loadData,
+                                          sampling=sampling)
 
         val_loader = MRIDatasetISEG2017(args, 'val', dataset_path=path, crop_dim=args.dim, split_id=split_idx,
-                                        samples=samples_val, load=args.loadData)
+                                        samples=samples_val, load=args.loadData, sampling=sampling)
 
     elif args.dataset_name == "iseg2019":
-        total_data = 10
+        total_data = dataset_size("iseg2019", path, default=10)
         split_idx = int(split_percent * total_data)
         train_loader = MRIDatasetISEG2019(args, 'train', dataset_path=path, crop_dim=args.dim,
-                                          split_id=split_idx, samples=samples_train, load=args.loadData)
+                                          split_id=split_idx, samples=samples_train, load=args.loadData,
+                                          sampling=sampling)
 
         val_loader = MRIDatasetISEG2019(args, 'val', dataset_path=path, crop_dim=args.dim, split_id=split_idx,
-                                        samples=samples_val, load=args.loadData)
+                                        samples=samples_val, load=args.loadData, sampling=sampling)
     elif args.dataset_name == "mrbrains4":
         train_loader = MRIDatasetMRBRAINS2018(args, 'train', dataset_path=path, classes=args.classes, dim=args.dim,
-                                              split_id=0, samples=samples_train, load=args.loadData)
+                                              split_id=0, samples=samples_train, load=args.loadData, sampling=sampling)
 
         val_loader = MRIDatasetMRBRAINS2018(args, 'val', dataset_path=path, classes=args.classes, dim=args.dim,
                                             split_id=0,
-                                            samples=samples_val, load=args.loadData)
+                                            samples=samples_val, load=args.loadData, sampling=sampling)
     elif args.dataset_name == "mrbrains9":
         train_loader = MRIDatasetMRBRAINS2018(args, 'train', dataset_path=path, classes=args.classes, dim=args.dim,
-                                              split_id=0, samples=samples_train, load=args.loadData)
+                                              split_id=0, samples=samples_train, load=args.loadData, sampling=sampling)
 
         val_loader = MRIDatasetMRBRAINS2018(args, 'val', dataset_path=path, classes=args.classes,
                                             dim=args.dim,
                                             split_id=0,
-                                            samples=samples_val, load=args.loadData)
+                                            samples=samples_val, load=args.loadData, sampling=sampling)
     elif args.dataset_name == "miccai2019":
         total_data = 244
         split_idx = int(split_percent * total_data) - 1
@@ -74,36 +100,39 @@ def generate_datasets(args, path='.././datasets'):
         return generator, loader.affine
 
     elif args.dataset_name == "brats2018":
-        total_data = 244
+        total_data = dataset_size("brats2018", path, default=244)
         split_idx = int(split_percent * total_data)
         train_loader = MICCAIBraTS2018(args, 'train', dataset_path=path, classes=args.classes, crop_dim=args.dim,
-                                       split_idx=split_idx, samples=samples_train, load=args.loadData)
+                                       split_idx=split_idx, samples=samples_train, load=args.loadData,
+                                       sampling=sampling)
 
         val_loader = MICCAIBraTS2018(args, 'val', dataset_path=path, classes=args.classes, crop_dim=args.dim,
                                      split_idx=split_idx,
-                                     samples=samples_val, load=args.loadData)
+                                     samples=samples_val, load=args.loadData, sampling=sampling)
 
     elif args.dataset_name == "brats2019":
         split = (0.8, 0.2)
-        total_data = 335
+        total_data = dataset_size("brats2019", path, default=335)
         split_idx = int(split[0] * total_data)
         train_loader = MICCAIBraTS2019(args, 'train', dataset_path=path, classes=args.classes, crop_dim=args.dim,
-                                       split_idx=split_idx, samples=samples_train, load=args.loadData)
+                                       split_idx=split_idx, samples=samples_train, load=args.loadData,
+                                       sampling=sampling)
 
         val_loader = MICCAIBraTS2019(args, 'val', dataset_path=path, classes=args.classes, crop_dim=args.dim,
                                      split_idx=split_idx,
-                                     samples=samples_val, load=args.loadData)
+                                     samples=samples_val, load=args.loadData, sampling=sampling)
 
     elif args.dataset_name == "brats2020":
         split = (0.8, 0.2)
-        total_data = 335
+        total_data = dataset_size("brats2020", path, default=335)
         split_idx = int(split[0] * total_data)
         train_loader = MICCAIBraTS2020(args, 'train', dataset_path=path, classes=args.classes, crop_dim=args.dim,
-                                       split_idx=split_idx, samples=samples_train, load=args.loadData)
+                                       split_idx=split_idx, samples=samples_train, load=args.loadData,
+                                       sampling=sampling)
 
         val_loader = MICCAIBraTS2020(args, 'val', dataset_path=path, classes=args.classes, crop_dim=args.dim,
                                      split_idx=split_idx,
-                                     samples=samples_val, load=args.loadData)
+                                     samples=samples_val, load=args.loadData, sampling=sampling)
     elif args.dataset_name == 'COVID_CT':
         train_loader = CovidCTDataset('train', root_dir='.././datasets/covid_ct_dataset/',
                                       txt_COVID='.././datasets/covid_ct_dataset/trainCT_COVID.txt',
@@ -118,13 +147,31 @@ def generate_datasets(args, path='.././datasets'):
                                    dim=(224, 224))
 
     elif args.dataset_name == 'covid_seg':
+        # the train scripts default --normalization to full_volume_mean, COVID-seg keeps max_min
+        # unless the dataset fingerprint is asked for explicitly
+        normalization = 'dataset' if getattr(args, 'normalization', None) == 'dataset' else 'max_min'
         train_loader = COVID_Seg_Dataset(mode='train', dataset_path=path, crop_dim=args.dim,
-                                         fold=0, samples=samples_train)
+                                         normalization=normalization,
+                                         fold=0, samples=samples_train, sampling=sampling)
 
         val_loader = COVID_Seg_Dataset(mode='val', dataset_path=path, crop_dim=args.dim,
-                                       fold=0, samples=samples_val)
-    training_generator = DataLoader(train_loader, **params)
-    val_generator = DataLoader(val_loader, **params)
+                                       normalization=normalization,
+                                       fold=0, samples=samples_val, sampling=sampling)
+    read_ahead = sampling.read_ahead
+    if sampling.online:
+        # the workers, and the subjects decoded in their caches, live across the epochs,
+        # and the val items sharing a subject are read in a row
+        params = dict(params, persistent_workers=True)
+        val_params = dict(params, shuffle=False)
+    else:
+        val_params = params
+    if getattr(args, 'batch_augmentation', False):
+        # the workers augment whole collated batches, instead of the samples one by one
+        training_generator = data_loader(train_loader, params, read_ahead,
+                                         collate_fn=BatchAugmentCollate(BatchAugmentation()))
+    else:
+        training_generator = data_loader(train_loader, params, read_ahead)
+    val_generator = data_loader(val_loader, val_params, read_ahead)
 
     print("DATA SAMPLES HAVE BEEN GENERATED SUCCESSFULLY")
     return training_generator, val_generator, val_loader.full_volume, val_loader.affine
@@ -133,20 +180,21 @@ def generate_datasets(args, path='.././datasets'):
 def select_full_volume_for_infer(args, path='.././datasets'):
     params = {'batch_size': args.batchSz,
               'shuffle': True,
-              'num_workers': 2}
+              'num_workers': 2,
+              'worker_init_fn': seed_worker}
     samples_train = args.samples_train
     samples_val = args.samples_val
     split_percent = args.split
 
     if args.dataset_name == "iseg2017":
-        total_data = 10
+        total_data = dataset_size("iseg2017", path, default=10)
         split_idx = int(split_percent * total_data)
         loader = MRIDatasetISEG2017('viz', dataset_path=path, crop_dim=args.dim,
                                     split_id=split_idx, samples=samples_train)
 
 
     elif args.dataset_name == "iseg2019":
-        total_data = 10
+        total_data = dataset_size("iseg2019", path, default=10)
         split_idx = int(split_percent * total_data)
         train_loader = MRIDatasetISEG2019('train', dataset_path=path, crop_dim=args.dim,
                                           split_id=split_idx, samples=samples_train)
@@ -187,7 +235,7 @@ def select_full_volume_for_infer(args, path='.././datasets'):
         return generator, loader.affine
 
     elif args.dataset_name == "brats2018":
-        total_data = 244
+        total_data = dataset_size("brats2018", path, default=244)
         split_idx = int(split_percent * total_data)
         train_loader = MICCAIBraTS2018('train', dataset_path=path, classes=args.classes, crop_dim=args.dim,
                                        split_idx=split_idx, samples=samples_train)
@@ -198,7 +246,7 @@ def select_full_volume_for_infer(args, path='.././datasets'):
 
     elif args.dataset_name == "brats2019":
         split = (0.8, 0.2)
-        total_data = 335
+        total_data = dataset_size("brats2019", path, default=335)
         split_idx = int(split[0] * total_data)
         train_loader = MICCAIBraTS2018('train', dataset_path=path, classes=args.classes, crop_dim=args.dim,
                                        split_idx=split_idx, samples=samples_train)
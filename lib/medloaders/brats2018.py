@@ -1,14 +1,15 @@
 import glob
 import os
 
-import numpy as np
-import torch
 from torch.utils.data import Dataset
 
 import lib.augment3D as augment3D
 import lib.utils as utils
 from lib.medloaders import medical_image_process as img_loader
-from lib.medloaders.medical_loader_utils import create_sub_volumes
+from lib.medloaders.manifest import dataset_layouts, find_dataset
+from lib.medloaders.medical_loader_utils import create_sub_volumes, load_sub_volume, stack_modalities
+from lib.medloaders.patch_codec import decode_image
+from lib.medloaders.sampling import SamplingOptions
 
 
 class MICCAIBraTS2018(Dataset):
@@ -18,13 +19,14 @@ class MICCAIBraTS2018(Dataset):
 
     def __init__(self, args, mode, dataset_path='./datasets', classes=5, crop_dim=(32, 32, 32), split_idx=10,
                  samples=10,
-                 load=False):
+                 load=False, sampling=None):
         """
         :param mode: 'train','val','test'
         :param dataset_path: root dataset folder
         :param crop_dim: subvolume tuple
         :param split_idx: 1 to 10 values
         :param samples: number of sub-volumes that you want to create
+        :param sampling: SamplingOptions of the sub-volumes, read from args if not given
         """
         self.mode = mode
         self.root = str(dataset_path)
@@ -35,7 +37,10 @@ class MICCAIBraTS2018(Dataset):
         self.crop_size = crop_dim
         self.threshold = args.threshold
         self.normalization = args.normalization
-        self.augmentation = args.augmentation
+        # batched augmentation replaces the per-sample one
+        self.augmentation = args.augmentation and not getattr(args, 'batch_augmentation', False)
+        self.sampling = SamplingOptions.from_args(args) if sampling is None else sampling
+        self.channels = utils.channel_indices(args.inModalities, args.inChannels, getattr(args, 'channel_ids', None))
         self.list = []
         self.samples = samples
         self.full_volume = None
@@ -43,12 +48,15 @@ class MICCAIBraTS2018(Dataset):
         self.save_name = self.root + '/MICCAI_BraTS_2018_Data_Training/brats2018-list-' + mode + '-samples-' + str(
             samples) + '.txt'
         if self.augmentation:
-            self.transform = augment3D.RandomChoice(
-                transforms=[augment3D.GaussianNoise(mean=0, std=0.01), augment3D.RandomFlip(),
-                            augment3D.ElasticTransform()], p=0.5)
+            transforms = [augment3D.GaussianNoise(mean=0, std=0.01), augment3D.RandomFlip(),
+                          augment3D.create_elastic_transform(getattr(args, 'elastic', 'dense'))]
+            spatial = augment3D.create_spatial_transform(getattr(args, 'spatial', 'none'))
+            if spatial is not None:
+                transforms.append(spatial)
+            self.transform = augment3D.RandomChoice(transforms=transforms, p=0.5)
         if load:
             ## load pre-generated data
-            list_IDsT1 = sorted(glob.glob(os.path.join(self.training_path, '*GG/*/*t1.nii.gz')))
+            list_IDsT1 = find_dataset(self.training_path, dataset_layouts['brats2018']['patterns'])[0]
             self.affine = img_loader.load_affine_matrix(list_IDsT1[0])
             self.list = utils.load_list(self.save_name)
             return
@@ -57,11 +65,8 @@ class MICCAIBraTS2018(Dataset):
         self.sub_vol_path = self.root + '/MICCAI_BraTS_2018_Data_Training/generated/' + mode + subvol + '/'
         utils.make_dirs(self.sub_vol_path)
 
-        list_IDsT1 = sorted(glob.glob(os.path.join(self.training_path, '*GG/*/*t1.nii.gz')))
-        list_IDsT1ce = sorted(glob.glob(os.path.join(self.training_path, '*GG/*/*t1ce.nii.gz')))
-        list_IDsT2 = sorted(glob.glob(os.path.join(self.training_path, '*GG/*/*t2.nii.gz')))
-        list_IDsFlair = sorted(glob.glob(os.path.join(self.training_path, '*GG/*/*_flair.nii.gz')))
-        labels = sorted(glob.glob(os.path.join(self.training_path, '*GG/*/*_seg.nii.gz')))
+        list_IDsT1, list_IDsT1ce, list_IDsT2, list_IDsFlair, labels = find_dataset(
+            self.training_path, dataset_layouts['brats2018']['patterns'])
         # print(len(list_IDsT1),len(list_IDsT2),len(list_IDsFlair),len(labels))
 
         self.affine = img_loader.load_affine_matrix(list_IDsT1[0])
@@ -77,7 +82,7 @@ class MICCAIBraTS2018(Dataset):
                                            dataset_name="brats2018", mode=mode, samples=samples,
                                            full_vol_dim=self.full_vol_dim, crop_size=self.crop_size,
                                            sub_vol_path=self.sub_vol_path, normalization=self.normalization,
-                                           th_percent=self.threshold)
+                                           th_percent=self.threshold, sampling=self.sampling)
         elif self.mode == 'val':
             list_IDsT1 = list_IDsT1[split_idx:]
             list_IDsT1ce = list_IDsT1ce[split_idx:]
@@ -88,7 +93,7 @@ class MICCAIBraTS2018(Dataset):
                                            dataset_name="brats2018", mode=mode, samples=samples,
                                            full_vol_dim=self.full_vol_dim, crop_size=self.crop_size,
                                            sub_vol_path=self.sub_vol_path, normalization=self.normalization,
-                                           th_percent=self.threshold)
+                                           th_percent=self.threshold, sampling=self.sampling)
 
         elif self.mode == 'test':
             self.list_IDsT1 = sorted(glob.glob(os.path.join(self.testing_path, '*GG/*/*t1.nii.gz')))
@@ -103,15 +108,8 @@ class MICCAIBraTS2018(Dataset):
         return len(self.list)
 
     def __getitem__(self, index):
-        f_t1, f_t1ce, f_t2, f_flair, f_seg = self.list[index]
-        img_t1, img_t1ce, img_t2, img_flair, img_seg = np.load(f_t1), np.load(f_t1ce), np.load(f_t2), np.load(
-            f_flair), np.load(f_seg)
+        *images, img_seg = load_sub_volume(self.list[index])
+        images = [images[c] for c in self.channels]
         if self.mode == 'train' and self.augmentation:
-            [img_t1, img_t1ce, img_t2, img_flair], img_seg = self.transform([img_t1, img_t1ce, img_t2, img_flair],
-                                                                            img_seg)
-
-            return torch.FloatTensor(img_t1.copy()).unsqueeze(0), torch.FloatTensor(img_t1ce.copy()).unsqueeze(
-                0), torch.FloatTensor(img_t2.copy()).unsqueeze(0), torch.FloatTensor(img_flair.copy()).unsqueeze(
-                0), torch.FloatTensor(img_seg.copy())
-
-        return img_t1, img_t1ce, img_t2, img_flair, img_seg
+            images, img_seg = self.transform([decode_image(img) for img in images], img_seg)
+        return stack_modalities(images, img_seg)
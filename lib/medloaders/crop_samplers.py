@@ -0,0 +1,147 @@
+import numpy as np
+
+"""
+Crop origin samplers for sub-volume generation.
+Label statistics are precomputed once per subject so that drawing a crop
+never needs to reload or re-scan the segmentation map.
+"""
+
+
+def label_integral_image(segmentation_map):
+    """
+    3D summed-area table of the foreground (label > 0) mask.
+    Entry [d, h, w] holds the number of foreground voxels in [0:d, 0:h, 0:w],
+    so the table has one extra leading plane per axis
+    """
+    mask = np.asarray(segmentation_map) > 0
+    dtype = np.int32 if mask.size < 2 ** 31 else np.int64
+    sat = np.zeros(tuple(s + 1 for s in mask.shape), dtype=dtype)
+    np.cumsum(mask, axis=0, dtype=dtype, out=sat[1:, 1:, 1:])
+    np.cumsum(sat[1:, 1:, 1:], axis=1, out=sat[1:, 1:, 1:])
+    np.cumsum(sat[1:, 1:, 1:], axis=2, out=sat[1:, 1:, 1:])
+    return sat
+
+
+def box_sum(sat, crop_size, crop):
+    """
+    Number of foreground voxels in the crop, from 8 lookups of the summed-area table
+    """
+    d0, h0, w0 = crop
+    d1, h1, w1 = d0 + crop_size[0], h0 + crop_size[1], w0 + crop_size[2]
+    return (sat[d1, h1, w1] - sat[d0, h1, w1] - sat[d1, h0, w1] - sat[d1, h1, w0]
+            + sat[d0, h0, w1] + sat[d0, h1, w0] + sat[d1, h0, w0] - sat[d0, h0, w0])
+
+
+def crop_origin_sums(sat, crop_size, planes):
+    """
+    Foreground voxels of every crop whose first-axis origin lies in planes (a slice)
+    """
+    cd, ch, cw = crop_size
+    nh, nw = sat.shape[1] - ch, sat.shape[2] - cw
+    d0 = sat[planes.start:planes.stop]
+    d1 = sat[planes.start + cd:planes.stop + cd]
+    return (d1[:, ch:ch + nh, cw:cw + nw] - d0[:, ch:ch + nh, cw:cw + nw]
+            - d1[:, :nh, cw:cw + nw] - d1[:, ch:ch + nh, :nw]
+            + d0[:, :nh, cw:cw + nw] + d0[:, ch:ch + nh, :nw] + d1[:, :nh, :nw] - d0[:, :nh, :nw])
+
+
+class ForegroundCropSampler(object):
+    """
+    Draws crop origins uniformly among the admissible positions, i.e. the crops that
+    hold at least th_percent of the foreground voxels of the whole volume.
+    The admissible set is computed once from the summed-area table and kept as flat origin
+    indices, so a draw is one random number and one lookup, without rejection retries.
+    If no crop qualifies every position is admissible.
+    """
+
+    def __init__(self, segmentation_map, crop_size, th_percent=0.1, chunk=16):
+        self.crop_size = tuple(int(c) for c in crop_size)
+        self.th_percent = th_percent
+        self.sat = label_integral_image(segmentation_map)
+        self.total = int(self.sat[-1, -1, -1])
+        shape = tuple(s - 1 for s in self.sat.shape)
+        for dim, c in zip(shape, self.crop_size):
+            assert dim >= c, "crop size is too big"
+
+        self.positions = tuple(s - c + 1 for s, c in zip(shape, self.crop_size))
+        admissible = np.zeros(self.positions, dtype=bool)
+        if self.total > 0:
+            for start in range(0, self.positions[0], chunk):
+                planes = slice(start, min(start + chunk, self.positions[0]))
+                sums = crop_origin_sums(self.sat, self.crop_size, planes)
+                admissible[planes] = sums / self.total >= th_percent
+        # flat indices of the admissible origins, None when every position is admissible
+        self.locations = None
+        if admissible.any() and not admissible.all():
+            dtype = np.int32 if admissible.size < 2 ** 31 else np.int64
+            self.locations = np.flatnonzero(admissible).astype(dtype)
+
+    def __len__(self):
+        return int(np.prod(self.positions)) if self.locations is None else len(self.locations)
+
+    def label_fraction(self, crop):
+        if self.total == 0:
+            return 0.0
+        return box_sum(self.sat, self.crop_size, crop) / self.total
+
+    def sample(self, rng=None):
+        rng = np.random if rng is None else rng
+        k = rng.randint(len(self))
+        if self.locations is not None:
+            k = self.locations[k]
+        return tuple(int(p) for p in np.unravel_index(k, self.positions))
+
+
+class ClassBalancedCropSampler(object):
+    """
+    Draws crops centred on a voxel of a class picked with the given weights, so that rare classes
+    (e.g. enhancing tumour) are seen in a chosen share of the crops. The voxels of every foreground
+    class are listed once as flat int32 indices grouped by class, a draw is two random numbers.
+    Class 0 (background) gives a uniformly random crop. Classes missing in the subject are skipped
+    """
+
+    def __init__(self, segmentation_map, crop_size, class_ratios=None):
+        """
+        :param class_ratios: weight of every class, background first. Default: the same for every class
+        """
+        labels = np.asarray(segmentation_map)
+        self.shape = labels.shape
+        self.crop_size = tuple(int(c) for c in crop_size)
+        for dim, c in zip(self.shape, self.crop_size):
+            assert dim >= c, "crop size is too big"
+
+        flat = labels.ravel()
+        foreground = np.flatnonzero(flat).astype(np.int32)
+        classes = flat[foreground].astype(np.intp)
+        counts = np.bincount(classes, minlength=1)
+        # voxel indices sorted by class, the voxels of class c are locations[starts[c]:starts[c + 1]]
+        self.locations = foreground[np.argsort(classes, kind='stable')]
+        self.starts = np.concatenate([[0], np.cumsum(counts)])
+        counts[0] = flat.size - len(foreground)
+
+        ratios = np.ones(len(counts)) if class_ratios is None else np.asarray(class_ratios, dtype=np.float64)
+        weights = np.zeros(len(counts))
+        present = min(len(counts), len(ratios))
+        weights[:present] = ratios[:present]
+        weights[counts == 0] = 0
+        if weights.sum() == 0:
+            weights[0] = 1
+        self.cumulative = np.cumsum(weights / weights.sum())
+
+    def sample(self, rng=None):
+        rng = np.random if rng is None else rng
+        label = min(int(np.searchsorted(self.cumulative, rng.random_sample(), side='right')), len(self.cumulative) - 1)
+        if label == 0:
+            return tuple(int(rng.randint(s - c + 1)) for s, c in zip(self.shape, self.crop_size))
+        start, end = self.starts[label], self.starts[label + 1]
+        centre = np.unravel_index(self.locations[start + rng.randint(end - start)], self.shape)
+        return tuple(int(min(max(p - c // 2, 0), s - c)) for p, c, s in zip(centre, self.crop_size, self.shape))
+
+
+def create_crop_sampler(segmentation_map, crop_size, th_percent=0.1, class_ratios=None):
+    """
+    ClassBalancedCropSampler if class ratios are given, ForegroundCropSampler otherwise
+    """
+    if class_ratios is not None:
+        return ClassBalancedCropSampler(segmentation_map, crop_size, class_ratios)
+    return ForegroundCropSampler(segmentation_map, crop_size, th_percent)
@@ -0,0 +1,206 @@
+import json
+import multiprocessing
+import os
+
+import nibabel as nib
+import numpy as np
+
+from lib.medloaders import medical_image_process as img_loader
+from lib.medloaders.manifest import dataset_layouts, find_dataset
+
+"""
+Dataset-wide intensity fingerprint, for the 'dataset' normalization (e.g. CT).
+Every subject is scanned once, in parallel, into fixed-width histograms of its foreground
+intensities (voxels with a label > 0) with their count, mean and sum of squared deviations.
+Histograms and moments of any two parts of the dataset merge exactly, so the global percentiles,
+mean and std come from a single streaming pass without holding more than one subject in memory.
+Build it with examples/build_fingerprint.py
+"""
+
+fingerprint_name = 'fingerprint.json'
+
+
+class IntensityHistogram(object):
+    """
+    counts[i] voxels in [(first + i) * bin_width, (first + i + 1) * bin_width),
+    with the exact count, mean and m2 (sum of squared deviations) of the voxels
+    """
+
+    def __init__(self, bin_width=1.0, first=0, counts=None, count=0, mean=0., m2=0.):
+        self.bin_width = float(bin_width)
+        self.first = int(first)
+        self.counts = np.zeros(0, dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+        self.count = int(count)
+        self.mean = float(mean)
+        self.m2 = float(m2)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return self
+        bins = np.floor(values / self.bin_width).astype(np.int64)
+        first = int(bins.min())
+        mean = values.mean()
+        deviations = values - mean
+        return self.merge(IntensityHistogram(self.bin_width, first, np.bincount(bins - first), len(values), mean,
+                                             np.dot(deviations, deviations)))
+
+    def merge(self, other):
+        """
+        Adds the voxels of another histogram of the same bin width (Chan et al. update of the moments)
+        """
+        assert self.bin_width == other.bin_width, "histograms of different bin widths"
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.first, self.counts = other.first, other.counts.copy()
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            return self
+        first = min(self.first, other.first)
+        last = max(self.first + len(self.counts), other.first + len(other.counts))
+        counts = np.zeros(last - first, dtype=np.int64)
+        counts[self.first - first:self.first - first + len(self.counts)] += self.counts
+        counts[other.first - first:other.first - first + len(other.counts)] += other.counts
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.first, self.counts, self.count = first, counts, count
+        return self
+
+    @property
+    def std(self):
+        # unbiased, as torch.std
+        return (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0.
+
+    def percentile(self, q):
+        """
+        np.percentile (linear) of the voxels, every voxel taken at the lower edge of its bin:
+        exact for integer intensities (e.g. CT) with a bin width of 1
+        """
+        assert self.count > 0, "empty histogram"
+        cumulative = np.cumsum(self.counts)
+        rank = (self.count - 1) * (q / 100)
+        below = int(np.floor(rank))
+        a, b = [(self.first + int(np.searchsorted(cumulative, r, side='right'))) * self.bin_width
+                for r in (below, min(below + 1, self.count - 1))]
+        return a + (b - a) * (rank - below)
+
+    def state_dict(self):
+        return {'bin_width': self.bin_width, 'first': self.first, 'counts': self.counts.tolist(),
+                'count': self.count, 'mean': self.mean, 'm2': self.m2}
+
+
+class DatasetFingerprint(object):
+    """
+    histograms : one IntensityHistogram per image modality, over the foreground voxels of all subjects
+    files      : one list per image modality of the scanned files, relative to root
+    """
+
+    def __init__(self, root, files, histograms, low_percentile=0.5, high_percentile=99.5):
+        self.root = root
+        self.files = files
+        self.histograms = histograms
+        self.low_percentile = low_percentile
+        self.high_percentile = high_percentile
+
+    @property
+    def paths(self):
+        return [[os.path.join(self.root, f) for f in files] for files in self.files]
+
+    def stats(self, modality):
+        """
+        Clipping range and foreground mean and std of a modality, as used by the 'dataset' normalization
+        """
+        histogram = self.histograms[modality]
+        return {'low': histogram.percentile(self.low_percentile), 'high': histogram.percentile(self.high_percentile),
+                'mean': histogram.mean, 'std': histogram.std}
+
+    @classmethod
+    def build(cls, root, ls, bin_width=1.0, workers=1, low_percentile=0.5, high_percentile=99.5):
+        """
+        :param ls: list of modality paths, where the last path is the segmentation map (the foreground mask)
+        """
+        total = len(ls[0])
+        assert total != 0, "Problem reading data. Check the data paths."
+        histograms = [IntensityHistogram(bin_width) for _ in range(len(ls) - 1)]
+        tasks = [([p[i] for p in ls], bin_width) for i in range(total)]
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                # merged as they come, the parent holds the histograms only
+                for subject_histograms in pool.imap_unordered(scan_fingerprint, tasks):
+                    for histogram, subject_histogram in zip(histograms, subject_histograms):
+                        histogram.merge(subject_histogram)
+        else:
+            for task in tasks:
+                for histogram, subject_histogram in zip(histograms, scan_fingerprint(task)):
+                    histogram.merge(subject_histogram)
+        files = [[os.path.relpath(f, root) for f in p] for p in ls[:-1]]
+        return cls(root, files, histograms, low_percentile, high_percentile)
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            # the fingerprint is moved with its dataset, the root is where it is opened from
+            json.dump({'files': self.files, 'low_percentile': self.low_percentile,
+                       'high_percentile': self.high_percentile,
+                       'stats': [self.stats(m) for m in range(len(self.histograms))],
+                       'histograms': [h.state_dict() for h in self.histograms]}, f)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Opens a fingerprint and registers the statistics of every scanned image in medical_image_process
+        """
+        with open(filename) as f:
+            state = json.load(f)
+        fingerprint = cls(os.path.dirname(os.path.abspath(filename)), state['files'],
+                          [IntensityHistogram(**h) for h in state['histograms']],
+                          state['low_percentile'], state['high_percentile'])
+        for modality, paths in enumerate(fingerprint.paths):
+            stats = fingerprint.stats(modality)
+            for path in paths:
+                img_loader.dataset_stats[os.path.abspath(path)] = stats
+        return fingerprint
+
+
+def scan_fingerprint(task):
+    """
+    Foreground intensity histograms of every image modality of one subject
+    :param task: (modality paths of the subject with the segmentation map last, bin width)
+    """
+    paths, bin_width = task
+    foreground = np.squeeze(nib.load(paths[-1]).get_fdata(dtype=np.float32)) > 0
+    histograms = []
+    for path in paths[:-1]:
+        img_np = np.squeeze(nib.load(path).get_fdata(dtype=np.float32))
+        # a subject without labels counts its non-zero voxels
+        histograms.append(IntensityHistogram(bin_width).update(img_np[foreground if foreground.any() else img_np != 0]))
+    return histograms
+
+
+def build_fingerprint(dataset_name, path, bin_width=1.0, workers=1, low_percentile=0.5, high_percentile=99.5):
+    layout = dataset_layouts[dataset_name]
+    training_path = os.path.join(path, layout['path'])
+    fingerprint = DatasetFingerprint.build(training_path, find_dataset(training_path, layout['patterns']),
+                                           bin_width=bin_width, workers=workers, low_percentile=low_percentile,
+                                           high_percentile=high_percentile)
+    fingerprint.save(os.path.join(training_path, fingerprint_name))
+    for modality in range(len(fingerprint.histograms)):
+        print('{} modality {}: {}'.format(dataset_name, modality, fingerprint.stats(modality)))
+    print('{} fingerprint saved in {}'.format(dataset_name, os.path.join(training_path, fingerprint_name)))
+    return fingerprint
+
+
+def find_fingerprint(path):
+    """
+    Loads the fingerprint saved in the closest parent folder of an image, None if there is none
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    while True:
+        filename = os.path.join(folder, fingerprint_name)
+        if os.path.exists(filename):
+            return DatasetFingerprint.load(filename)
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return None
+        folder = parent
@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+from torch.utils.data import Dataset
+
+from lib.medloaders import medical_image_process as img_loader
+from lib.medloaders.medical_loader_utils import fix_seg_map
+
+"""
+Every crop-sized tile of every subject, e.g. for exhaustive validation.
+Each subject is decoded once and zero-padded to a multiple of the crop size, the tiles
+are views of that padded volume (in memory, or memory-mapped .npy files shared by the
+DataLoader workers through the page cache), so no per-tile file is ever written.
+Items have the same layout as the generated samples: (modality_0, ..., modality_n, label)
+"""
+
+
+class GridPatchDataset(Dataset):
+    """
+    shapes  : subjects x 3 volume shape, pads: subjects x 3 padding before the volume on every axis
+    grids   : subjects x 3 number of tiles on every axis
+    offsets : index of the first tile of every subject, tiles are in C order of the grid
+    """
+
+    def __init__(self, *ls, dataset_name, crop_size, normalization='max_min', memmap_dir=None):
+        """
+        :param ls: list of modality paths, where the last path is the segmentation map
+        :param crop_size: tile size
+        :param memmap_dir: if given, the padded volumes are saved there as .npy files and memory-mapped
+        """
+        self.total = len(ls[0])
+        assert self.total != 0, "Problem reading data. Check the data paths."
+        self.crop_size = tuple(int(c) for c in crop_size)
+        self.channels = len(ls) - 1
+        self.memmap_dir = memmap_dir
+        self.volumes = [None] * self.total
+        self.shapes = np.zeros((self.total, 3), dtype=np.int64)
+        self.pads = np.zeros((self.total, 3), dtype=np.int64)
+        self.grids = np.zeros((self.total, 3), dtype=np.int64)
+
+        for subject in range(self.total):
+            images = [img_loader.load_medical_image(ls[j][subject], type="T1", normalization=normalization).numpy()
+                      for j in range(self.channels)]
+            label = fix_seg_map(img_loader.load_medical_image(ls[-1][subject], viz3d=True, type='label'),
+                                dataset_name).numpy()
+            shape = np.array(label.shape)
+            self.grids[subject] = -(-shape // self.crop_size)
+            padded = self.grids[subject] * self.crop_size
+            # centred padding, the extra voxel of an odd padding goes after the volume
+            self.shapes[subject], self.pads[subject] = shape, (padded - shape) // 2
+            index = tuple(slice(p, p + s) for p, s in zip(self.pads[subject], shape))
+
+            image, padded_label = self.allocate(subject, tuple(int(p) for p in padded))
+            for j in range(self.channels):
+                image[j][index] = images[j]
+            padded_label[index] = label
+            if memmap_dir is not None:
+                image.flush()
+                padded_label.flush()
+                image, padded_label = None, None
+            self.volumes[subject] = (image, padded_label)
+        self.offsets = np.concatenate([[0], np.cumsum(np.prod(self.grids, axis=1))])
+
+    def allocate(self, subject, padded_shape):
+        """
+        Zero-filled padded image (C x D x H x W float32) and label (uint8) arrays of a subject
+        """
+        if self.memmap_dir is None:
+            return (np.zeros((self.channels,) + padded_shape, dtype=np.float32),
+                    np.zeros(padded_shape, dtype=np.uint8))
+        image_path, label_path = self.volume_paths(subject)
+        # a new .npy file is zero-filled
+        return (np.lib.format.open_memmap(image_path, mode='w+', dtype=np.float32,
+                                          shape=(self.channels,) + padded_shape),
+                np.lib.format.open_memmap(label_path, mode='w+', dtype=np.uint8, shape=padded_shape))
+
+    def volume_paths(self, subject):
+        name = os.path.join(self.memmap_dir, 'grid_subject_{}_'.format(subject))
+        return name + 'image.npy', name + 'label.npy'
+
+    def volume(self, subject):
+        """
+        Padded image and label of a subject, memory-mapped files are opened on first use in every process
+        """
+        if self.volumes[subject][0] is None:
+            # copy-on-write mapping: writable views for torch, the files are never modified
+            self.volumes[subject] = tuple(np.load(path, mmap_mode='c') for path in self.volume_paths(subject))
+        return self.volumes[subject]
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def tile(self, index):
+        """
+        :return: subject and origin, in padded volume coordinates, of a tile
+        """
+        subject = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        position = np.unravel_index(index - self.offsets[subject], tuple(self.grids[subject]))
+        return subject, tuple(int(p) * c for p, c in zip(position, self.crop_size))
+
+    def subject_tiles(self, subject):
+        return range(int(self.offsets[subject]), int(self.offsets[subject + 1]))
+
+    def __getitem__(self, index):
+        subject, origin = self.tile(index)
+        image, label = self.volume(subject)
+        index = tuple(slice(o, o + c) for o, c in zip(origin, self.crop_size))
+        return tuple(image[j][index] for j in range(self.channels)) + (label[index],)
+
+    def assemble(self, subject, tiles):
+        """
+        Puts the per-tile outputs of a subject (e.g. predictions) back into the volume geometry
+        :param tiles: tiles of the subject in subject_tiles order, each ... x crop_size (e.g. classes x crop_size)
+        :return: ... x volume shape numpy array
+        """
+        tiles = np.asarray(tiles)
+        grid, lead = tuple(self.grids[subject]), tiles.shape[1:-3]
+        volume = tiles.reshape(grid + lead + self.crop_size)
+        # gd, gh, gw, ..., cd, ch, cw -> ..., gd, cd, gh, ch, gw, cw
+        n = len(lead)
+        volume = volume.transpose(tuple(range(3, 3 + n)) + (0, 3 + n, 1, 4 + n, 2, 5 + n))
+        volume = volume.reshape(lead + tuple(g * c for g, c in zip(grid, self.crop_size)))
+        index = tuple(slice(p, p + s) for p, s in zip(self.pads[subject], self.shapes[subject]))
+        return volume[(Ellipsis,) + index]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.memmap_dir is not None:
+            # workers map the files themselves
+            state['volumes'] = [(None, None)] * self.total
+        return state
@@ -1,14 +1,15 @@
 import glob
 import os
 
-import numpy as np
-import torch
 from torch.utils.data import Dataset
 
 import lib.augment3D as augment3D
 import lib.utils as utils
 from lib.medloaders import medical_image_process as img_loader
-from lib.medloaders.medical_loader_utils import get_viz_set, create_sub_volumes
+from lib.medloaders.manifest import dataset_layouts, find_dataset
+from lib.medloaders.medical_loader_utils import get_viz_set, create_sub_volumes, load_sub_volume, stack_modalities
+from lib.medloaders.patch_codec import decode_image
+from lib.medloaders.sampling import SamplingOptions
 
 
 class MRIDatasetISEG2017(Dataset):
@@ -17,13 +18,14 @@ class MRIDatasetISEG2017(Dataset):
     """
 
     def __init__(self, args, mode, dataset_path='./datasets', crop_dim=(32, 32, 32), split_id=1, samples=1000,
-                 load=False):
+                 load=False, sampling=None):
         """
         :param mode: 'train','val','test'
         :param dataset_path: root dataset folder
         :param crop_dim: subvolume tuple
         :param fold_id: 1 to 10 values
         :param samples: number of sub-volumes that you want to create
+        :param sampling: SamplingOptions of the sub-volumes, read from args if not given
         """
         self.mode = mode
         self.root = str(dataset_path)
@@ -33,7 +35,10 @@ class MRIDatasetISEG2017(Dataset):
         self.full_vol_dim = (144, 192, 256)  # slice, width, height
         self.threshold = args.threshold
         self.normalization = args.normalization
-        self.augmentation = args.augmentation
+        # batched augmentation replaces the per-sample one
+        self.augmentation = args.augmentation and not getattr(args, 'batch_augmentation', False)
+        self.sampling = SamplingOptions.from_args(args) if sampling is None else sampling
+        self.channels = utils.channel_indices(args.inModalities, args.inChannels, getattr(args, 'channel_ids', None))
         self.crop_size = crop_dim
         self.list = []
         self.samples = samples
@@ -41,13 +46,16 @@ class MRIDatasetISEG2017(Dataset):
         self.save_name = self.root + '/iseg_2017/iSeg-2017-Training/iseg2017-list-' + mode + '-samples-' + str(
             samples) + '.txt'
         if self.augmentation:
-            self.transform = augment3D.RandomChoice(
-                transforms=[augment3D.GaussianNoise(mean=0, std=0.01), augment3D.RandomFlip(),
-                            augment3D.ElasticTransform()], p=0.5)
+            transforms = [augment3D.GaussianNoise(mean=0, std=0.01), augment3D.RandomFlip(),
+                          augment3D.create_elastic_transform(getattr(args, 'elastic', 'dense'))]
+            spatial = augment3D.create_spatial_transform(getattr(args, 'spatial', 'none'))
+            if spatial is not None:
+                transforms.append(spatial)
+            self.transform = augment3D.RandomChoice(transforms=transforms, p=0.5)
         if load:
             ## load pre-generated data
             self.list = utils.load_list(self.save_name)
-            list_IDsT1 = sorted(glob.glob(os.path.join(self.training_path, '*T1.img')))
+            list_IDsT1 = find_dataset(self.training_path, dataset_layouts['iseg2017']['patterns'])[0]
             self.affine = img_loader.load_affine_matrix(list_IDsT1[0])
             return
 
@@ -55,9 +63,7 @@ class MRIDatasetISEG2017(Dataset):
         self.sub_vol_path = self.root + '/iseg_2017/generated/' + mode + subvol + '/'
 
         utils.make_dirs(self.sub_vol_path)
-        list_IDsT1 = sorted(glob.glob(os.path.join(self.training_path, '*T1.img')))
-        list_IDsT2 = sorted(glob.glob(os.path.join(self.training_path, '*T2.img')))
-        labels = sorted(glob.glob(os.path.join(self.training_path, '*label.img')))
+        list_IDsT1, list_IDsT2, labels = find_dataset(self.training_path, dataset_layouts['iseg2017']['patterns'])
         self.affine = img_loader.load_affine_matrix(list_IDsT1[0])
 
         if self.mode == 'train':
@@ -70,7 +76,7 @@ class MRIDatasetISEG2017(Dataset):
                                            mode=mode, samples=samples, full_vol_dim=self.full_vol_dim,
                                            crop_size=self.crop_size,
                                            sub_vol_path=self.sub_vol_path, th_percent=self.threshold,
-                                           normalization=args.normalization)
+                                           normalization=args.normalization, sampling=self.sampling)
 
 
         elif self.mode == 'val':
@@ -82,7 +88,7 @@ class MRIDatasetISEG2017(Dataset):
                                            mode=mode, samples=samples, full_vol_dim=self.full_vol_dim,
                                            crop_size=self.crop_size,
                                            sub_vol_path=self.sub_vol_path, th_percent=self.threshold,
-                                           normalization=args.normalization)
+                                           normalization=args.normalization, sampling=self.sampling)
 
             self.full_volume = get_viz_set(list_IDsT1, list_IDsT2, labels, dataset_name="iseg2017")
 
@@ -103,14 +109,8 @@ class MRIDatasetISEG2017(Dataset):
         return len(self.list)
 
     def __getitem__(self, index):
-        t1_path, t2_path, seg_path = self.list[index]
-        t1, t2, s = np.load(t1_path), np.load(t2_path), np.load(seg_path)
-
+        *images, s = load_sub_volume(self.list[index])
+        images = [images[c] for c in self.channels]
         if self.mode == 'train' and self.augmentation:
-            print('augmentation reee')
-            [augmented_t1, augmented_t2], augmented_s = self.transform([t1, t2], s)
-
-            return torch.FloatTensor(augmented_t1.copy()).unsqueeze(0), torch.FloatTensor(
-                augmented_t2.copy()).unsqueeze(0), torch.FloatTensor(augmented_s.copy())
-
-        return torch.FloatTensor(t1).unsqueeze(0), torch.FloatTensor(t2).unsqueeze(0), torch.FloatTensor(s)
+            images, s = self.transform([decode_image(img) for img in images], s)
+        return stack_modalities(images, s)
@@ -0,0 +1,243 @@
+import glob
+import multiprocessing
+import os
+import pickle
+
+import nibabel as nib
+import numpy as np
+
+from lib.medloaders import medical_image_process as img_loader
+from lib.medloaders.medical_loader_utils import compile_label_map, label_maps
+
+"""
+Persistent index of a dataset: paths, headers, intensity statistics and label statistics
+of every subject, computed once so that the loaders start without globbing the tree
+or opening any NIfTI header. Build it with examples/build_manifest.py
+"""
+
+manifest_name = 'manifest.pkl'
+
+# training folder (relative to the datasets root) and glob pattern of every modality, label last
+dataset_layouts = {
+    'brats2018': {'path': 'MICCAI_BraTS_2018_Data_Training',
+                  'patterns': ['*GG/*/*t1.nii.gz', '*GG/*/*t1ce.nii.gz', '*GG/*/*t2.nii.gz', '*GG/*/*_flair.nii.gz',
+                               '*GG/*/*_seg.nii.gz']},
+    'brats2019': {'path': 'brats2019/MICCAI_BraTS_2019_Data_Training',
+                  'patterns': ['*GG/*/*t1.nii.gz', '*GG/*/*t1ce.nii.gz', '*GG/*/*t2.nii.gz', '*GG/*/*_flair.nii.gz',
+                               '*GG/*/*_seg.nii.gz']},
+    'brats2020': {'path': 'brats2020/MICCAI_BraTS_2020_Data_Training',
+                  'patterns': ['*/*t1.nii.gz', '*/*t1ce.nii.gz', '*/*t2.nii.gz', '*/*_flair.nii.gz',
+                               '*/*_seg.nii.gz']},
+    'iseg2017': {'path': 'iseg_2017/iSeg-2017-Training',
+                 'patterns': ['*T1.img', '*T2.img', '*label.img']},
+    'iseg2019': {'path': 'iseg_2019/iSeg-2019-Training',
+                 'patterns': ['*T1.img', '*T2.img', '*label.img']},
+    'mrbrains4': {'path': 'mrbrains_2018/training',
+                  'patterns': ['*/pr*/*g_T1.nii.gz', '*/pr*/*g_IR.nii.gz', '*/pr*/*AIR.nii.gz', '*/*egm.nii.gz']},
+    'mrbrains9': {'path': 'mrbrains_2018/training',
+                  'patterns': ['*/pr*/*g_T1.nii.gz', '*/pr*/*g_IR.nii.gz', '*/pr*/*AIR.nii.gz', '*/*egm.nii.gz']},
+    'covid19seg': {'path': 'covid_segmap_dataset',
+                   'patterns': ['COVID-19-CT-Seg_20cases/*', 'Lung_and_Infection_Mask/*']},
+}
+
+# manifests already opened by this process, keyed by file name and modification time
+manifests = {}
+
+stat_names = ('low', 'high', 'mean', 'std', 'max', 'min', 'fg_mean', 'fg_std')
+
+
+class DatasetManifest(object):
+    """
+    Per-subject arrays, row i describes subject i:
+    files        : one list per modality (label last) of the sorted glob results, relative to root
+    shapes       : N x 3 volume shape, spacings N x 3 voxel size, affines N x 4 x 4 (first modality)
+    stats        : N x image modalities x len(stat_names) intensity statistics, see compute_intensity_stats
+    bboxes       : N x 6 foreground bounding box (min d, h, w, max d, h, w exclusive)
+    label_counts : N x 256 voxel count of every raw label value
+    """
+
+    def __init__(self, root, patterns, files, shapes, spacings, affines, stats, bboxes, label_counts,
+                 intensity_stats=None):
+        self.root = root
+        self.patterns = list(patterns)
+        self.files = files
+        self.shapes = shapes
+        self.spacings = spacings
+        self.affines = affines
+        self.stats = stats
+        self.bboxes = bboxes
+        self.label_counts = label_counts
+        # get_intensity_stats entries of every image, so that patch reads need no full-volume pass,
+        # keyed by the path relative to root (see relative_stats_key)
+        self.intensity_stats = intensity_stats or {}
+
+    def __len__(self):
+        return len(self.files[0])
+
+    @property
+    def paths(self):
+        return [[os.path.join(self.root, f) for f in files] for files in self.files]
+
+    @property
+    def subjects(self):
+        return list(self.files[0])
+
+    def class_counts(self, dataset_name):
+        """
+        N x classes voxel counts, after the label mapping of the dataset (see fix_seg_map)
+        """
+        lut = compile_label_map(label_maps.get(dataset_name, {}))
+        present = np.flatnonzero(self.label_counts.sum(axis=0))
+        counts = np.zeros((len(self), int(lut[present].max()) + 1), dtype=np.int64)
+        for raw in present:
+            counts[:, lut[raw]] += self.label_counts[:, raw]
+        return counts
+
+    @classmethod
+    def build(cls, root, patterns, workers=1):
+        """
+        Scans the subjects of root, in parallel if workers > 1
+        :param patterns: glob pattern of every modality, relative to root, the segmentation map last
+        """
+        paths = [sorted(glob.glob(os.path.join(root, pattern))) for pattern in patterns]
+        total = len(paths[0])
+        assert total != 0, "Problem reading data. Check the data paths."
+        assert all(len(p) == total for p in paths), "every modality must have the same number of files"
+
+        tasks = [[p[i] for p in paths] for i in range(total)]
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                results = pool.map(scan_subject, tasks, chunksize=1)
+        else:
+            results = [scan_subject(task) for task in tasks]
+
+        intensity_stats = {}
+        for result in results:
+            for key, stat in result['intensity_stats'].items():
+                intensity_stats[relative_stats_key(key, root)] = stat
+        return cls(root, patterns, [[os.path.relpath(f, root) for f in p] for p in paths],
+                   shapes=np.array([r['shape'] for r in results], dtype=np.int32),
+                   spacings=np.array([r['spacing'] for r in results], dtype=np.float32),
+                   affines=np.array([r['affine'] for r in results], dtype=np.float64),
+                   stats=np.array([r['stats'] for r in results], dtype=np.float32),
+                   bboxes=np.array([r['bbox'] for r in results], dtype=np.int32),
+                   label_counts=np.array([r['label_counts'] for r in results], dtype=np.int64),
+                   intensity_stats=intensity_stats)
+
+    def save(self, filename):
+        state = self.__dict__.copy()
+        # the manifest is moved with its dataset, the root is where it is opened from
+        del state['root']
+        with open(filename, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Opens a manifest and registers its headers and statistics in medical_image_process
+        """
+        with open(filename, 'rb') as f:
+            manifest = cls(root=os.path.dirname(filename), **pickle.load(f))
+        for key, stat in manifest.intensity_stats.items():
+            img_loader.intensity_stats[absolute_stats_key(key, manifest.root)] = stat
+        for path, affine in zip(manifest.paths[0], manifest.affines):
+            img_loader.header_affines[os.path.abspath(path)] = affine
+        return manifest
+
+
+def relative_stats_key(key, root):
+    """
+    intensity_stats_key of a file, with its path relative to root, so that it still holds
+    once the dataset is moved
+    """
+    fields = key.rsplit('|', 3)
+    fields[0] = os.path.relpath(fields[0], root)
+    return '|'.join(fields)
+
+
+def absolute_stats_key(key, root):
+    """
+    intensity_stats_key of a file of the dataset opened from root
+    """
+    fields = key.rsplit('|', 3)
+    fields[0] = os.path.abspath(os.path.join(root, fields[0]))
+    return '|'.join(fields)
+
+
+def scan_subject(paths):
+    """
+    Header, intensity and label statistics of one subject
+    :param paths: modality paths of the subject, the segmentation map last
+    """
+    img = nib.load(paths[0])
+    result = {'shape': tuple(int(s) for s in img.header.get_data_shape()[:3]),
+              'spacing': tuple(float(s) for s in img.header.get_zooms()[:3]),
+              'affine': img.affine}
+
+    intensity_stats = {}
+    stats = []
+    for path in paths[:-1]:
+        stat = img_loader.get_intensity_stats(path)
+        stats.append([stat[name] for name in stat_names])
+        intensity_stats[img_loader.intensity_stats_key(path)] = stat
+    result['stats'] = stats
+    result['intensity_stats'] = intensity_stats
+
+    labels = np.squeeze(nib.load(paths[-1]).get_fdata(dtype=np.float32))
+    assert labels.min() >= 0 and labels.max() < 256, "label values must be in [0, 255]"
+    labels = labels.astype(np.uint8)
+    result['label_counts'] = np.bincount(labels.ravel(), minlength=256)
+    foreground = np.nonzero(labels)
+    if len(foreground[0]) == 0:
+        result['bbox'] = (0,) * 6
+    else:
+        result['bbox'] = tuple(int(f.min()) for f in foreground) + tuple(int(f.max()) + 1 for f in foreground)
+    return result
+
+
+def load_manifest(training_path, patterns=None):
+    """
+    Returns the manifest of a training folder, or None if it has not been built
+    (or was built for other patterns)
+    """
+    filename = os.path.join(training_path, manifest_name)
+    if not os.path.exists(filename):
+        return None
+    key = (os.path.abspath(filename), os.stat(filename).st_mtime_ns)
+    if key not in manifests:
+        manifests[key] = DatasetManifest.load(filename)
+    manifest = manifests[key]
+    if patterns is not None and manifest.patterns != list(patterns):
+        return None
+    return manifest
+
+
+def find_dataset(training_path, patterns):
+    """
+    Sorted paths of every modality (label last), from the manifest if there is one,
+    by globbing the training folder otherwise
+    """
+    manifest = load_manifest(training_path, patterns)
+    if manifest is not None:
+        return manifest.paths
+    return [sorted(glob.glob(os.path.join(training_path, pattern))) for pattern in patterns]
+
+
+def dataset_size(dataset_name, path, default):
+    """
+    Number of subjects of a dataset, from its manifest if there is one
+    """
+    layout = dataset_layouts[dataset_name]
+    manifest = load_manifest(os.path.join(path, layout['path']), layout['patterns'])
+    return default if manifest is None else len(manifest)
+
+
+def build_manifest(dataset_name, path, workers=1):
+    layout = dataset_layouts[dataset_name]
+    training_path = os.path.join(path, layout['path'])
+    manifest = DatasetManifest.build(training_path, layout['patterns'], workers=workers)
+    manifest.save(os.path.join(training_path, manifest_name))
+    print('{} manifest: {} subjects saved in {}'.format(dataset_name, len(manifest),
+                                                      os.path.join(training_path, manifest_name)))
+    return manifest
+
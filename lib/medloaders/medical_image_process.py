@@ -1,3 +1,6 @@
+import json
+import os
+
 import nibabel as nib
 import numpy as np
 import torch
@@ -10,9 +13,56 @@ concentrate all pre-processing here here
 """
 
 
+# optional cache of preprocessed full volumes, see set_volume_cache
+volume_cache = None
+
+
+def set_volume_cache(cache):
+    """
+    Installs a VolumeCache used by every load_medical_image call, None disables caching
+    """
+    global volume_cache
+    volume_cache = cache
+
+
 def load_medical_image(path, type=None, resample=None,
                        viz3d=False, to_canonical=False, rescale=None, normalization='full_volume_mean',
                        clip_intenisty=True, crop_size=(0, 0, 0), crop=(0, 0, 0), ):
+    if volume_cache is None and not viz3d and crop_size[0] != 0 and resample is None and not to_canonical \
+            and not is_compressed(path):
+        # uncompressed files are read only in the crop region, normalized with the stored subject statistics
+        return load_medical_image_patch(path, type=type, normalization=normalization,
+                                        clip_intenisty=clip_intenisty, crop_size=crop_size, crop=crop)
+
+    if volume_cache is None:
+        img_tensor = preprocess_medical_image(path, type=type, resample=resample, viz3d=viz3d,
+                                              to_canonical=to_canonical, rescale=rescale,
+                                              normalization=normalization, clip_intenisty=clip_intenisty)
+    else:
+        # T1, T2 etc. share the same preprocessing, labels and raw (viz3d) volumes skip the intensity steps
+        raw = viz3d or type == 'label'
+        key = volume_cache.key(path, label=type == 'label', resample=resample, viz3d=viz3d,
+                               to_canonical=to_canonical, rescale=rescale,
+                               normalization=None if raw else normalization,
+                               clip_intenisty=False if raw else clip_intenisty)
+        img_np = volume_cache.get(key, lambda: preprocess_medical_image(
+            path, type=type, resample=resample, viz3d=viz3d, to_canonical=to_canonical, rescale=rescale,
+            normalization=normalization, clip_intenisty=clip_intenisty).numpy())
+        img_tensor = torch.from_numpy(img_np)
+
+    if not viz3d:
+        img_tensor = crop_img(img_tensor, crop_size, crop)
+    if volume_cache is not None:
+        # callers may modify the result in place, never hand out the cached array
+        img_tensor = img_tensor.clone()
+    return img_tensor
+
+
+def preprocess_medical_image(path, type=None, resample=None, viz3d=False, to_canonical=False, rescale=None,
+                             normalization='full_volume_mean', clip_intenisty=True):
+    """
+    Decodes and preprocesses a full volume (no cropping)
+    """
     img_nii = nib.load(path)
 
     if to_canonical:
@@ -26,25 +76,127 @@ def load_medical_image(path, type=None, resample=None,
     if viz3d:
         return torch.from_numpy(img_np)
 
-    # 1. Intensity outlier clipping
-    if clip_intenisty and type != "label":
-        img_np = percentile_clip(img_np)
+    # 1. Intensity outlier clipping, with the statistics of the clipped volume
+    if type != "label":
+        if normalization == 'dataset':
+            # clipped to the dataset range in normalize_volume
+            stats = get_dataset_stats(path)
+        else:
+            stats = clip_intensity_stats(img_np, clip_intenisty=clip_intenisty)
 
     # 2. Rescale to specified output shape
     if rescale is not None:
         rescale_data_volume(img_np, rescale)
 
     # 3. intensity normalization
-    img_tensor = torch.from_numpy(img_np)
-
-    MEAN, STD, MAX, MIN = 0., 1., 1., 0.
-    if type != 'label':
-        MEAN, STD = img_tensor.mean(), img_tensor.std()
-        MAX, MIN = img_tensor.max(), img_tensor.min()
     if type != "label":
-        img_tensor = normalize_intensity(img_tensor, normalization=normalization, norm_values=(MEAN, STD, MAX, MIN))
-    img_tensor = crop_img(img_tensor, crop_size, crop)
-    return img_tensor
+        normalize_volume(img_np, normalization, stats)
+    return torch.from_numpy(img_np)
+
+
+def is_compressed(path):
+    return str(path).endswith('.gz')
+
+
+def crop_slices(full_shape, crop_size, crop):
+    """
+    Index of the crop region, axes where the crop spans the full volume are taken whole as in crop_img
+    """
+    return tuple(slice(0, full) if full == dim else slice(start, start + dim)
+                 for full, dim, start in zip(full_shape, crop_size, crop))
+
+
+def load_medical_image_patch(path, type=None, normalization='full_volume_mean', clip_intenisty=True,
+                             crop_size=(0, 0, 0), crop=(0, 0, 0)):
+    """
+    Reads only the crop region through the nibabel array proxy and normalizes it with the
+    statistics of the full volume, so the result equals load_medical_image with a crop
+    at O(patch) I/O and memory. Worth it for uncompressed files (.nii, .img/.hdr) only.
+    """
+    img_nii = nib.load(path)
+    index = crop_slices(img_nii.shape[:3], crop_size, crop) + (0,) * (len(img_nii.shape) - 3)
+    # unscaled float32 files give a read-only view of the memory map, normalized in place below
+    img_np = np.array(img_nii.dataobj[index], dtype=np.float32)
+
+    if type == 'label':
+        return torch.from_numpy(img_np)
+    if normalization == 'dataset':
+        return torch.from_numpy(normalize_volume(img_np, normalization, get_dataset_stats(path)))
+
+    stats = get_intensity_stats(path, clip_intenisty=clip_intenisty)
+    if clip_intenisty:
+        np.clip(img_np, np.float32(stats['low']), np.float32(stats['high']), out=img_np)
+    normalize_volume(img_np, normalization, stats)
+    return torch.from_numpy(img_np)
+
+
+# intensity statistics of the subjects seen so far, see get_intensity_stats
+intensity_stats = {}
+
+
+def compute_intensity_stats(path, clip_intenisty=True):
+    """
+    Statistics of the full (clipped) volume needed to normalize any of its crops
+    """
+    img_np = np.squeeze(nib.load(path).get_fdata(dtype=np.float32))
+    return clip_intensity_stats(img_np, clip_intenisty=clip_intenisty)
+
+
+def intensity_stats_key(path, clip_intenisty=True):
+    stat = os.stat(path)
+    return '{}|{}|{}|{}'.format(os.path.abspath(path), stat.st_mtime_ns, stat.st_size, clip_intenisty)
+
+
+def get_intensity_stats(path, clip_intenisty=True):
+    """
+    Returns the stored statistics of a subject, computing them once on first use
+    """
+    key = intensity_stats_key(path, clip_intenisty)
+    if key not in intensity_stats:
+        intensity_stats[key] = compute_intensity_stats(path, clip_intenisty=clip_intenisty)
+    return intensity_stats[key]
+
+
+# clipping range, mean and std of the images of fingerprinted datasets, keyed by absolute path
+dataset_stats = {}
+
+
+def get_dataset_stats(path):
+    """
+    Statistics of the dataset of an image for the 'dataset' normalization, the fingerprint
+    saved in the closest parent folder of the image is loaded on first use
+    """
+    key = os.path.abspath(path)
+    if key not in dataset_stats:
+        from lib.medloaders.fingerprint import find_fingerprint
+        find_fingerprint(path)
+    assert key in dataset_stats, "no dataset fingerprint lists {}, see examples/build_fingerprint.py".format(path)
+    return dataset_stats[key]
+
+
+def precompute_intensity_stats(paths, filename=None, clip_intenisty=True):
+    """
+    Statistics of the patch-read images (uncompressed files), computed once and stored in filename
+    (e.g. next to the generated data), so that no process decodes a full volume before its first patch read.
+    Entries already in filename are reused, their keys change with the image files.
+    :return: get_intensity_stats entries of the images, to register in other processes
+    """
+    stored = {}
+    if filename is not None and os.path.exists(filename):
+        with open(filename) as f:
+            stored = json.load(f)
+    intensity_stats.update(stored)
+    entries = {}
+    for path in paths:
+        if is_compressed(path):
+            continue
+        key = intensity_stats_key(path, clip_intenisty)
+        entries[key] = get_intensity_stats(path, clip_intenisty=clip_intenisty)
+    if filename is not None and any(key not in stored for key in entries):
+        stored.update(entries)
+        with open(filename, 'w') as f:
+            json.dump(stored, f)
+    return entries
 
 
 def medical_image_transform(img_tensor, type=None,
@@ -94,10 +246,80 @@ def crop_img(img_tensor, crop_size, crop):
     return img_tensor
 
 
+def foreground_bbox(volumes, min_size=(0, 0, 0), margin=0):
+    """
+    Bounding box of the voxels that are non-zero in any of the volumes, as (min d, h, w, max d, h, w exclusive)
+    like the manifest bboxes. The box is grown by margin and, around its centre, to at least min_size
+    (e.g. the crop size) without leaving the volume. An empty volume gives the whole volume
+    """
+    shape = volumes[0].shape
+    foreground = np.zeros(shape, dtype=bool)
+    for volume in volumes:
+        np.logical_or(foreground, np.asarray(volume) != 0, out=foreground)
+    start, stop = [], []
+    for axis in range(3):
+        index = np.flatnonzero(foreground.any(axis=tuple(a for a in range(3) if a != axis)))
+        low, high = (int(index[0]), int(index[-1]) + 1) if len(index) else (0, shape[axis])
+        low, high = max(low - margin, 0), min(high + margin, shape[axis])
+        size = max(high - low, min(min_size[axis], shape[axis]))
+        low = min(max(low - (size - (high - low)) // 2, 0), shape[axis] - size)
+        start.append(low)
+        stop.append(low + size)
+    return tuple(start + stop)
+
+
+def bbox_slices(bbox):
+    return tuple(slice(low, high) for low, high in zip(bbox[:3], bbox[3:]))
+
+
+def pad_to_full_volume(cropped, bbox, full_shape, fill=0):
+    """
+    Puts a volume cropped to bbox (e.g. its predicted labels) back in the full volume geometry
+    """
+    full = np.full(tuple(full_shape), fill, dtype=np.asarray(cropped).dtype)
+    full[bbox_slices(bbox)] = cropped
+    return full
+
+
+def load_foreground_volumes(paths, normalization='full_volume_mean', clip_intenisty=True, min_size=(0, 0, 0),
+                            margin=0):
+    """
+    Decodes the modalities of a subject and keeps only the bounding box of the voxels that are non-zero in
+    any of them (see foreground_bbox). The crops are normalized with the statistics of the full volumes,
+    so they equal the same region of load_medical_image while the later stages process fewer voxels.
+    The raw volumes go through the VolumeCache, if one is installed
+    :return: list of cropped tensors, bbox
+    """
+    volumes = [load_medical_image(path, viz3d=True).numpy() for path in paths]
+    bbox = foreground_bbox(volumes, min_size=min_size, margin=margin)
+    cropped = []
+    for path, img_np in zip(paths, volumes):
+        if normalization == 'dataset':
+            img_np = np.array(img_np[bbox_slices(bbox)])
+            cropped.append(torch.from_numpy(normalize_volume(img_np, normalization, get_dataset_stats(path))))
+            continue
+        key = intensity_stats_key(path, clip_intenisty)
+        if key not in intensity_stats:
+            intensity_stats[key] = clip_intensity_stats(img_np, clip_intenisty=clip_intenisty)
+        stats = intensity_stats[key]
+        img_np = np.array(img_np[bbox_slices(bbox)])
+        if clip_intenisty:
+            np.clip(img_np, np.float32(stats['low']), np.float32(stats['high']), out=img_np)
+        cropped.append(torch.from_numpy(normalize_volume(img_np, normalization, stats)))
+    return cropped, bbox
+
+
+# affine matrices registered by a loaded dataset manifest, keyed by absolute path
+header_affines = {}
+
+
 def load_affine_matrix(path):
     """
     Reads an path to nifti file and returns the affine matrix as numpy array 4x4
     """
+    affine = header_affines.get(os.path.abspath(path))
+    if affine is not None:
+        return affine
     img = nib.load(path)
     return img.affine
 
@@ -164,6 +386,10 @@ def normalize_intensity(img_tensor, normalization="full_volume_mean", norm_value
     elif normalization == 'full_volume_mean':
         img_tensor = (img_tensor.clone() - norm_values[0]) / norm_values[1]
 
+    elif normalization == 'dataset':
+        # norm_values of the dataset fingerprint: mean, std, high and low percentiles
+        img_tensor = (img_tensor.clamp(norm_values[3], norm_values[2]) - norm_values[0]) / norm_values[1]
+
     elif normalization == 'max_min':
         img_tensor = (img_tensor - norm_values[3]) / ((norm_values[2] - norm_values[3]))
 
@@ -197,9 +423,128 @@ def percentile_clip(img_numpy, min_val=0.1, max_val=99.8):
     :param max_val: should be in the range [0,100]
     :return: intesity normalized image
     """
-    low = np.percentile(img_numpy, min_val)
-    high = np.percentile(img_numpy, max_val)
+    low, high = percentile(img_numpy, min_val), percentile(img_numpy, max_val)
+    np.clip(img_numpy, low, high, out=img_numpy)
+    return img_numpy
+
+
+def tail_values(values, ranks, bound, upper=False):
+    """
+    Values of the given ranks, counted from one end of the sorted values, picked among
+    the voxels beyond bound only. None if bound is not deep enough for the ranks
+    :param upper: ranks are counted from the largest value if True, from the smallest otherwise
+    """
+    tail = values[values > bound] if upper else values[values < bound]
+    deepest = max(ranks)
+    if deepest >= len(tail) and deepest >= len(tail) + np.count_nonzero(values == bound):
+        return None
+    # ranks past the tail fall on the voxels equal to bound
+    inside = [len(tail) - 1 - r if upper else r for r in ranks if r < len(tail)]
+    if inside:
+        tail.partition(inside)
+    return [(tail[len(tail) - 1 - r] if upper else tail[r]) if r < len(tail) else bound for r in ranks]
+
+
+def select_ranks(img_numpy, ranks, sample_stride=64):
+    """
+    Values at the given ranks of the sorted volume, i.e. np.partition(img_numpy, ranks)[ranks]
+    without copying or partitioning the whole volume: every tail is bracketed on a strided
+    sample and only the voxels beyond the bracket are partitioned
+    """
+    values = img_numpy.ravel()
+    total = values.size
+    sample = np.sort(values[::sample_stride])
+    selected = {}
+    for upper in (False, True):
+        tail = [total - 1 - r if upper else r for r in set(ranks) if (2 * r >= total) == upper]
+        if not tail:
+            continue
+        # twice as deep in the sample as the deepest rank, against sampling noise
+        depth = min(2 * (max(tail) + 1) * len(sample) // total + 1, len(sample) - 1)
+        bound = sample[len(sample) - 1 - depth] if upper else sample[depth]
+        found = tail_values(values, tail, bound, upper=upper)
+        if found is None:
+            kth = [total - 1 - r if upper else r for r in tail]
+            found = np.partition(values, kth)[kth]
+        selected.update(zip([total - 1 - r if upper else r for r in tail], found))
+    return [selected[r] for r in ranks]
+
+
+def percentile(img_numpy, q):
+    """
+    Same value as np.percentile(img_numpy, q) (linear method), through select_ranks
+    :param q: should be in the range [0,100]
+    """
+    index = (img_numpy.size - 1) * (q / 100)
+    below = int(np.floor(index))
+    gamma = float(index - below)
+    a, b = select_ranks(img_numpy, [below, min(below + 1, img_numpy.size - 1)])
+    # the interpolation of np.percentile, in the dtype of the volume
+    diff = b - a
+    return b - diff * (1 - gamma) if gamma >= 0.5 else a + diff * gamma
 
-    img_numpy[img_numpy < low] = low
-    img_numpy[img_numpy > high] = high
+
+def clip_intensity_stats(img_numpy, clip_intenisty=True, min_val=0.1, max_val=99.8):
+    """
+    Clips the volume in place to its [min_val, max_val] percentiles and returns the statistics of
+    the clipped volume (see compute_intensity_stats), accumulated in float64 from a few reductions
+    instead of the clip, mean, std, max and min passes over torch copies of the volume
+    """
+    if clip_intenisty:
+        low, high = percentile(img_numpy, min_val), percentile(img_numpy, max_val)
+        np.clip(img_numpy, low, high, out=img_numpy)
+    else:
+        low, high = img_numpy.min(), img_numpy.max()
+    values = img_numpy.ravel()
+    total, count = values.size, np.count_nonzero(values != 0)
+    # the background voxels add nothing to the sums, the foreground statistics come for free
+    sum_ = float(values.sum(dtype=np.float64))
+    sum_squares = float(np.einsum('i,i->', values, values, dtype=np.float64))
+
+    def mean_std(n):
+        if n == 0:
+            return float('nan'), float('nan')
+        variance = max(sum_squares - sum_ * sum_ / n, 0.) / (n - 1) if n > 1 else float('nan')
+        return sum_ / n, variance ** 0.5
+
+    mean, std = mean_std(total)
+    fg_mean, fg_std = mean_std(count)
+    return {'low': float(low), 'high': float(high), 'mean': mean, 'std': std,
+            'max': float(high), 'min': float(low), 'fg_mean': fg_mean, 'fg_std': fg_std}
+
+
+def normalize_volume(img_numpy, normalization, stats):
+    """
+    In-place normalize_intensity of a float32 numpy volume, from its clip_intensity_stats
+    (or get_dataset_stats for the 'dataset' mode)
+    Every mode is applied as one affine map, brats only on the non-zero voxels
+    """
+    # numpy scalars, a constant volume gives inf/nan like the torch pipeline instead of raising
+    stats = {k: np.float64(v) for k, v in stats.items()}
+    if normalization == 'mean':
+        # the mean mode uses the non-zero voxels of the full volume
+        scale, shift = 1. / stats['fg_std'], -stats['fg_mean'] / stats['fg_std']
+    elif normalization == 'max':
+        scale, shift = 1. / stats['max'], 0.
+    elif normalization == 'full_volume_mean':
+        scale, shift = 1. / stats['std'], -stats['mean'] / stats['std']
+    elif normalization == 'dataset':
+        # clipped to the dataset percentiles, z-scored with the dataset foreground mean and std
+        np.clip(img_numpy, np.float32(stats['low']), np.float32(stats['high']), out=img_numpy)
+        scale, shift = 1. / stats['std'], -stats['mean'] / stats['std']
+    elif normalization == 'max_min':
+        scale, shift = 1. / (stats['max'] - stats['min']), -stats['min'] / (stats['max'] - stats['min'])
+    elif normalization == 'brats':
+        # 100 * ((x - mean) / std - min) / (max - min) + 10, the background stays 0
+        extent = stats['max'] - stats['min']
+        scale = 100. / (stats['std'] * extent)
+        shift = 10. - 100. * (stats['mean'] / stats['std'] + stats['min']) / extent
+        foreground = img_numpy != 0
+        np.multiply(img_numpy, np.float32(scale), out=img_numpy, where=foreground)
+        np.add(img_numpy, np.float32(shift), out=img_numpy, where=foreground)
+        return img_numpy
+    else:
+        return img_numpy
+    img_numpy *= np.float32(scale)
+    img_numpy += np.float32(shift)
     return img_numpy
@@ -1,4 +1,13 @@
+import multiprocessing
+import os
+
 from lib.medloaders import medical_image_process as img_loader
+from lib.medloaders.crop_samplers import create_crop_sampler
+from lib.medloaders.patch_codec import decode_image, load_image, save_image
+from lib.medloaders.patch_store import PatchStore
+from lib.medloaders.read_ahead import ReadAhead
+from lib.medloaders.sample_index import SampleIndex, sample_filename
+from lib.medloaders.sampling import SamplingOptions
 from lib.visual3D_temp import *
 
 
@@ -15,7 +24,7 @@ def get_viz_set(*ls, dataset_name, test_subject=0, save=False, sub_vol_path=None
 
         img_tensor = img_loader.load_medical_image(path_img, viz3d=True)
         if i == modalities - 1:
-            img_tensor = fix_seg_map(img_tensor, dataset=dataset_name)
+            img_tensor = fix_seg_map(img_tensor, dataset=dataset_name).float()
 
         total_volumes.append(img_tensor)
 
@@ -30,38 +39,53 @@ def get_viz_set(*ls, dataset_name, test_subject=0, save=False, sub_vol_path=None
         return torch.stack(total_volumes, dim=0)
 
 
+# raw label value -> class per dataset, values that are not listed keep their value
+label_maps = {
+    'iseg2017': {10: 1, 150: 2, 250: 3},
+    'iseg2019': {10: 1, 150: 2, 250: 3},
+    # necrotic core 1, edema 2, enhancing tumor 4 (and anything above) -> 3
+    'brats2018': {1: 1, 2: 2, 3: 3, range(4, 256): 3},
+    'brats2019': {1: 1, 2: 2, 3: 3, range(4, 256): 3},
+    'brats2020': {1: 1, 2: 2, 3: 3, range(4, 256): 3},
+    # grey matter, white matter, csf
+    'mrbrains4': {1: 1, 2: 1, 3: 2, 4: 2, 5: 3, 6: 3},
+    'mrbrains9': {},
+    'covid19seg': {},
+}
+label_luts = {}
+
+
+def compile_label_map(label_map):
+    """
+    Compiles a label map to a uint8 lookup table indexed by the raw label value
+    """
+    lut = np.arange(256, dtype=np.uint8)
+    for raw, label in label_map.items():
+        lut[list(raw) if isinstance(raw, range) else raw] = label
+    return lut
+
+
 def fix_seg_map(segmentation_map, dataset="iseg2017"):
-    if dataset == "iseg2017" or dataset == "iseg2019":
-        label_values = [0, 10, 150, 250]
-        for c, j in enumerate(label_values):
-            segmentation_map[segmentation_map == j] = c
-
-    elif dataset == "brats2018" or dataset == "brats2019" or dataset == "brats2020":
-        ED = 2
-        NCR = 1
-        NET_NCR = 1
-        ET = 3
-        # print('dsdsdsdsd')
-        segmentation_map[segmentation_map == 1] = NET_NCR
-        segmentation_map[segmentation_map == 2] = ED
-        segmentation_map[segmentation_map == 3] = 3
-        segmentation_map[segmentation_map == 4] = 3
-        segmentation_map[segmentation_map >= 4] = 3
-    elif dataset == "mrbrains4":
-        GM = 1
-        WM = 2
-        CSF = 3
-        segmentation_map[segmentation_map == 1] = GM
-        segmentation_map[segmentation_map == 2] = GM
-        segmentation_map[segmentation_map == 3] = WM
-        segmentation_map[segmentation_map == 4] = WM
-        segmentation_map[segmentation_map == 5] = CSF
-        segmentation_map[segmentation_map == 6] = CSF
-    return segmentation_map
+    """
+    Maps the raw label values of a dataset to consecutive classes with a single
+    lookup-table gather, see label_maps
+    :param segmentation_map: numpy array or torch tensor of raw label values in [0, 255]
+    :return: uint8 label map of the same kind (numpy or torch)
+    """
+    if dataset not in label_luts:
+        label_luts[dataset] = compile_label_map(label_maps.get(dataset, {}))
+    lut = label_luts[dataset]
+    is_tensor = isinstance(segmentation_map, torch.Tensor)
+    labels = segmentation_map.numpy() if is_tensor else np.asarray(segmentation_map)
+    if labels.dtype != np.uint8:
+        assert labels.min() >= 0 and labels.max() < len(lut), "label values must be in [0, 255]"
+        labels = labels.astype(np.intp)
+    labels = lut[labels]
+    return torch.from_numpy(labels) if is_tensor else labels
 
 
 def create_sub_volumes(*ls, dataset_name, mode, samples, full_vol_dim, crop_size, sub_vol_path, normalization='max_min',
-                       th_percent=0.1):
+                       th_percent=0.1, sampling=None):
     """
 
     :param ls: list of modality paths, where the last path is the segmentation map
@@ -72,108 +96,224 @@ def create_sub_volumes(*ls, dataset_name, mode, samples, full_vol_dim, crop_size
     :param crop_size: train volume size
     :param sub_vol_path: path for the particular patient
     :param th_percent: the % of the croped dim that corresponds to non-zero labels
-    :param crop_type:
-    :return:
+    :param sampling: SamplingOptions, how the samples are produced (one .npy file per modality by default)
+    :return: SampleIndex of the saved .npy paths, the PatchStore if packed, the OnlinePatchSampler if online
+    or the GridPatchDataset if grid
     """
     total = len(ls[0])
     assert total != 0, "Problem reading data. Check the data paths."
+    sampling = SamplingOptions() if sampling is None else sampling
+    method = sampling.method(mode)
+    if method == 'grid':
+        return get_all_sub_volumes(*ls, dataset_name=dataset_name, mode=mode, samples=samples,
+                                   full_vol_dim=full_vol_dim, crop_size=crop_size, sub_vol_path=sub_vol_path,
+                                   normalization=normalization)
+    if method == 'online':
+        return create_online_sampler(*ls, dataset_name=dataset_name, mode=mode, samples=samples,
+                                     full_vol_dim=full_vol_dim, crop_size=crop_size, sub_vol_path=sub_vol_path,
+                                     normalization=normalization, th_percent=th_percent, sampling=sampling)
+    return generate_sub_volumes(*ls, dataset_name=dataset_name, mode=mode, samples=samples, crop_size=crop_size,
+                                sub_vol_path=sub_vol_path, normalization=normalization, th_percent=th_percent,
+                                packed=method == 'packed', sampling=sampling)
+
+
+def create_online_sampler(*ls, dataset_name, mode, samples, full_vol_dim, crop_size, sub_vol_path,
+                          normalization='max_min', th_percent=0.1, sampling):
+    """
+    OnlinePatchSampler of the subjects, on a SharedVolumePool if sampling.shared
+    """
+    from lib.medloaders.online_sampler import OnlinePatchSampler
+    # train crops change at every epoch, val crops are fixed by a seed drawn from the global RNG
+    seed = None if mode == 'train' else np.random.randint(2 ** 31)
+    pool = None
+    if sampling.shared:
+        from lib.medloaders.volume_pool import SharedVolumePool
+        pool = SharedVolumePool(*ls, dataset_name=dataset_name, normalization=normalization,
+                                foreground_crop=sampling.foreground_crop, min_size=crop_size, crop_size=crop_size,
+                                th_percent=th_percent, class_ratios=sampling.class_ratios)
+    intensity_stats = None
+    if pool is None and not sampling.foreground_crop and img_loader.volume_cache is None \
+            and normalization != 'dataset':
+        # uncompressed modalities are read crop by crop, normalized with their stored full volume statistics
+        stats_file = None if sub_vol_path is None else os.path.join(sub_vol_path, 'intensity_stats.json')
+        intensity_stats = img_loader.precompute_intensity_stats([p for paths in ls[:-1] for p in paths],
+                                                                stats_file)
+    return OnlinePatchSampler(*ls, dataset_name=dataset_name, samples=samples, full_vol_dim=full_vol_dim,
+                              crop_size=crop_size, normalization=normalization, th_percent=th_percent,
+                              cache_size=sampling.cache_size, crops_per_subject=sampling.crops_per_subject,
+                              seed=seed, pool=pool, foreground_crop=sampling.foreground_crop,
+                              class_ratios=sampling.class_ratios, intensity_stats=intensity_stats)
+
+
+def generate_sub_volumes(*ls, dataset_name, mode, samples, crop_size, sub_vol_path, normalization='max_min',
+                         th_percent=0.1, packed=False, sampling):
+    """
+    Generates the random crops once, to one file per modality or to a PatchStore if packed
+    """
+    total = len(ls[0])
+    workers = sampling.workers
     modalities = len(ls)
-    list = []
-    # print(modalities)
-    # print(ls[2])
+    if packed:
+        store = PatchStore.create(sub_vol_path, samples, modalities - 1, crop_size, codec=sampling.codec,
+                                  label_dtype=np.uint8)
 
     print('Mode: ' + mode + ' Subvolume samples to generate: ', samples, ' Volumes: ', total)
-    for i in range(samples):
-        # print(i)
-        random_index = np.random.randint(total)
-        sample_paths = []
-        tensor_images = []
-        for j in range(modalities):
-            sample_paths.append(ls[j][random_index])
-        # print(sample_paths)
-        while True:
-            label_path = sample_paths[-1]
-            crop = find_random_crop_dim(full_vol_dim, crop_size)
-            full_segmentation_map = img_loader.load_medical_image(label_path, viz3d=True, type='label',
-                                                                  crop_size=crop_size,
-                                                                  crop=crop)
-
-            full_segmentation_map = fix_seg_map(full_segmentation_map, dataset_name)
-            # print(full_segmentation_map.shape)
-            if find_non_zero_labels_mask(full_segmentation_map, th_percent, crop_size, crop):
-                segmentation_map = img_loader.load_medical_image(label_path, type='label', crop_size=crop_size,
-                                                                 crop=crop)
-                segmentation_map = fix_seg_map(segmentation_map, dataset_name)
-                for j in range(modalities - 1):
-                    img_tensor = img_loader.load_medical_image(sample_paths[j], type="T1", normalization=normalization,
-                                                               crop_size=crop_size, crop=crop)
-
-                    tensor_images.append(img_tensor)
-
-                break
-
-        filename = sub_vol_path + 'id_' + str(random_index) + '_s_' + str(i) + '_modality_'
+    # every sample has its own RNG stream derived from the global seed,
+    # so the generated list is the same whatever the number of workers
+    seed = np.random.randint(2 ** 31)
+    subjects = [np.random.RandomState([seed, i]).randint(total) for i in range(samples)]
+
+    # samples are grouped by subject so that each volume is decoded once per task
+    subject_samples = [[] for _ in range(total)]
+    for i, subject in enumerate(subjects):
+        subject_samples[subject].append(i)
+    chunk = max(1, int(np.ceil(samples / (workers * 4))))
+    tasks = []
+    for subject, sample_ids in enumerate(subject_samples):
+        for k in range(0, len(sample_ids), chunk):
+            tasks.append(dict(sample_paths=[ls[j][subject] for j in range(modalities)], subject=subject,
+                              sample_ids=sample_ids[k:k + chunk], seed=seed, total=total,
+                              dataset_name=dataset_name, crop_size=crop_size, sub_vol_path=sub_vol_path,
+                              normalization=normalization, th_percent=th_percent, packed=packed,
+                              codec=sampling.codec, foreground_crop=sampling.foreground_crop,
+                              class_ratios=sampling.class_ratios))
+
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(generate_subject_sub_volumes, tasks, chunksize=1)
+    elif sampling.read_ahead > 0:
+        reader = ReadAhead(depth=sampling.read_ahead)
+        results = [generate_subject_sub_volumes(task)
+                   for task in reader.iterate(tasks, lambda task: task['sample_paths'])]
+        reader.close()
+        print('Volumes read ahead:', reader)
+    else:
+        results = [generate_subject_sub_volumes(task) for task in tasks]
+
+    crops = np.zeros((samples, 3), dtype=np.int32)
+    for task, task_results in zip(tasks, results):
+        for i, crop, saved in task_results:
+            crops[i] = crop
+            if packed:
+                # int16 scale and offset of every modality
+                store.scales[i], store.offsets[i] = saved
+
+    if packed:
+        store.subjects[:] = subjects
+        store.crops[:] = crops
+        store.flush()
+        return store
+    return SampleIndex(sub_vol_path, [[paths[i] for paths in ls] for i in range(total)], subjects, crops,
+                       codec=sampling.codec)
+
+
+def generate_subject_sub_volumes(task):
+    """
+    Generates the samples of one subject: the label and every modality are decoded once
+    and all the crops of the task are cut from them
+    :return: list of (sample id, crop, saved paths) tuples
+    """
+    sample_paths = task['sample_paths']
+    crop_size = task['crop_size']
+    modalities = len(sample_paths)
+    bbox = None
+    if task['foreground_crop']:
+        full_images, bbox = img_loader.load_foreground_volumes(sample_paths[:-1], normalization=task['normalization'],
+                                                               min_size=crop_size)
+    else:
+        full_images = [img_loader.load_medical_image(sample_paths[j], type="T1", normalization=task['normalization'])
+                       for j in range(modalities - 1)]
+    full_segmentation_map, crop_sampler = load_crop_sampler(sample_paths[-1], task['dataset_name'], crop_size,
+                                                            task['th_percent'], bbox=bbox,
+                                                            class_ratios=task['class_ratios'])
+    # crop origins are recorded in full volume coordinates
+    offset = (0, 0, 0) if bbox is None else bbox[:3]
+    if task['packed']:
+        store = PatchStore(task['sub_vol_path'])
+        store.open(mode='r+')
+
+    results = []
+    for i in task['sample_ids']:
+        rng = np.random.RandomState([task['seed'], i])
+        # first draw of the stream picked the subject
+        rng.randint(task['total'])
+        crop = crop_sampler.sample(rng)
+        segmentation_map = img_loader.crop_img(full_segmentation_map, crop_size, crop)
+        tensor_images = [img_loader.crop_img(img_tensor, crop_size, crop) for img_tensor in full_images]
+        crop = tuple(c + o for c, o in zip(crop, offset))
+
+        if task['packed']:
+            store.write(i, tensor_images, segmentation_map, task['subject'], crop)
+            results.append((i, crop, (store.scales[i], store.offsets[i])))
+            continue
+
+        filename = sample_filename(task['sub_vol_path'], task['subject'], i)
         list_saved_paths = []
         for j in range(modalities - 1):
-            f_t1 = filename + str(j) + '.npy'
+            f_t1 = save_image(filename + str(j) + '.npy', tensor_images[j], task['codec'])
             list_saved_paths.append(f_t1)
 
-            np.save(f_t1, tensor_images[j])
-
         f_seg = filename + 'seg.npy'
 
         np.save(f_seg, segmentation_map)
         list_saved_paths.append(f_seg)
-        list.append(tuple(list_saved_paths))
+        results.append((i, crop, tuple(list_saved_paths)))
 
-    return list
+    if task['packed']:
+        store.images.flush()
+        store.labels.flush()
+    return results
 
 
-def get_all_sub_volumes(*ls, dataset_name, mode, samples, full_vol_dim, crop_size, sub_vol_path,
-                        normalization='max_min'):
-    # TODO
-    # 1.) gia ola tas subject fortwnwn image kai target
-    # 2.) call generate_non_overlapping_volumes gia na kanw to image kai target sub_volumnes patches
-    # 3.) apothikeuw tensors
-    total = len(ls[0])
-    assert total != 0, "Problem reading data. Check the data paths."
-    modalities = len(ls)
-    list = []
-
-    for vol_id in range(total):
-
-        tensor_images = []
-        for modality_id in range(modalities - 1):
-            img_tensor = img_loader.medical_image_transform(
-                img_loader.load_medical_image(ls[modality_id][vol_id], type="T1"),
-                normalization=normalization)
+def load_crop_sampler(label_path, dataset_name, crop_size, th_percent, bbox=None, class_ratios=None):
+    """
+    Loads a segmentation map once and precomputes the admissible crop origins for it
+    :param bbox: if given, the map is cropped to it first (see img_loader.foreground_bbox)
+    :param class_ratios: class weights of a ClassBalancedCropSampler, see create_crop_sampler
+    :return: the full segmentation map and its crop sampler
+    """
+    segmentation_map = img_loader.load_medical_image(label_path, viz3d=True, type='label')
+    if bbox is not None:
+        segmentation_map = segmentation_map[img_loader.bbox_slices(bbox)]
+    segmentation_map = fix_seg_map(segmentation_map, dataset_name)
+    return segmentation_map, create_crop_sampler(segmentation_map.numpy(), crop_size, th_percent, class_ratios)
 
-            img_tensor = generate_padded_subvolumes(img_tensor, kernel_dim=crop_size)
 
-            tensor_images.append(img_tensor)
-        segmentation_map = img_loader.medical_image_transform(
-            img_loader.load_medical_image(ls[modalities - 1][vol_id], viz3d=True, type='label'))
-        segmentation_map = generate_padded_subvolumes(segmentation_map, kernel_dim=crop_size)
+def load_sub_volume(sample):
+    """
+    Returns the arrays of a generated sample. Samples are either tuples of .npy/.npz paths
+    or already the arrays themselves (e.g. views of a PatchStore). Images may still be
+    encoded, see patch_codec.decode_image
+    """
+    return tuple(load_image(f) if isinstance(f, str) else f for f in sample)
 
-        filename = sub_vol_path + 'id_' + str(vol_id) + '_s_' + str(modality_id) + '_modality_'
 
-        list_saved_paths = []
-        # print(len(tensor_images[0]))
-        for k in range(len(tensor_images[0])):
-            for j in range(modalities - 1):
-                f_t1 = filename + str(j) + '_sample_{}'.format(str(k).zfill(8)) + '.npy'
-                list_saved_paths.append(f_t1)
-                # print(f_t1,tensor_images[j][k].shape)
-                np.save(f_t1, tensor_images[j])
+def stack_modalities(images, segmentation_map):
+    """
+    Stacks the modalities of a sample into one C x D x H x W float tensor, so that
+    batches need no concatenation in prepare_input. Encoded images are decoded
+    straight into the stacked tensor
+    :return: image tensor, label tensor
+    """
+    shape = (images[0][0] if isinstance(images[0], tuple) else images[0]).shape
+    image = torch.empty((len(images),) + tuple(shape), dtype=torch.float32)
+    for c, img in enumerate(images):
+        decode_image(img, out=image[c].numpy())
+    return image, torch.from_numpy(np.array(segmentation_map))
 
-            f_seg = filename + 'seg_sample_{}'.format(str(k).zfill(8)) + '.npy'
-            # print(f_seg)
-            np.save(f_seg, segmentation_map)
-            list_saved_paths.append(f_seg)
-            list.append(tuple(list_saved_paths))
 
-    # print(list)
-    return list
+def get_all_sub_volumes(*ls, dataset_name, mode, samples, full_vol_dim, crop_size, sub_vol_path,
+                        normalization='max_min'):
+    """
+    Every crop-sized tile of every subject, served as views of one padded volume per subject
+    memory-mapped from sub_vol_path (see GridPatchDataset). mode, samples and full_vol_dim are unused
+    :return: GridPatchDataset, items are (modality_0, ..., modality_n, label) like the generated samples
+    """
+    from lib.medloaders.grid_patch_dataset import GridPatchDataset
+    grid = GridPatchDataset(*ls, dataset_name=dataset_name, crop_size=crop_size, normalization=normalization,
+                            memmap_dir=sub_vol_path)
+    print('Mode: ' + mode + ' Grid tiles: ', len(grid), ' Volumes: ', len(ls[0]))
+    return grid
 
 
 def generate_padded_subvolumes(full_volume, kernel_dim=(32, 32, 32)):
@@ -200,7 +340,8 @@ def generate_padded_subvolumes(full_volume, kernel_dim=(32, 32, 32)):
     return patches
 
 
-def find_random_crop_dim(full_vol_dim, crop_size):
+def find_random_crop_dim(full_vol_dim, crop_size, rng=None):
+    rng = np.random if rng is None else rng
     assert full_vol_dim[0] >= crop_size[0], "crop size is too big"
     assert full_vol_dim[1] >= crop_size[1], "crop size is too big"
     assert full_vol_dim[2] >= crop_size[2], "crop size is too big"
@@ -208,17 +349,17 @@ def find_random_crop_dim(full_vol_dim, crop_size):
     if full_vol_dim[0] == crop_size[0]:
         slices = crop_size[0]
     else:
-        slices = np.random.randint(full_vol_dim[0] - crop_size[0])
+        slices = rng.randint(full_vol_dim[0] - crop_size[0])
 
     if full_vol_dim[1] == crop_size[1]:
         w_crop = crop_size[1]
     else:
-        w_crop = np.random.randint(full_vol_dim[1] - crop_size[1])
+        w_crop = rng.randint(full_vol_dim[1] - crop_size[1])
 
     if full_vol_dim[2] == crop_size[2]:
         h_crop = crop_size[2]
     else:
-        h_crop = np.random.randint(full_vol_dim[2] - crop_size[2])
+        h_crop = rng.randint(full_vol_dim[2] - crop_size[2])
 
     return (slices, w_crop, h_crop)
 
@@ -1,18 +1,18 @@
-import glob
 import os
 
-import numpy as np
 from torch.utils.data import Dataset
 
 import lib.utils as utils
 from lib.medloaders import medical_image_process as img_loader
-from lib.medloaders.medical_loader_utils import create_sub_volumes
+from lib.medloaders.manifest import dataset_layouts, find_dataset
+from lib.medloaders.medical_loader_utils import create_sub_volumes, load_sub_volume, stack_modalities
 from lib.medloaders.medical_loader_utils import get_viz_set
+from lib.medloaders.sampling import SamplingOptions
 
 
 class MRIDatasetMRBRAINS2018(Dataset):
     def __init__(self, args, mode, dataset_path='../datasets', classes=4, dim=(32, 32, 32), split_id=0, samples=1000,
-                 load=False):
+                 load=False, sampling=None):
         self.mode = mode
         self.root = dataset_path
         self.classes = classes
@@ -24,6 +24,8 @@ class MRIDatasetMRBRAINS2018(Dataset):
         self.full_vol_size = (240, 240, 48)
         self.threshold = 0.1
         self.crop_dim = dim
+        self.sampling = SamplingOptions.from_args(args) if sampling is None else sampling
+        self.channels = utils.channel_indices(args.inModalities, args.inChannels, getattr(args, 'channel_ids', None))
         self.list_flair = []
         self.list_ir = []
         self.list_reg_ir = []
@@ -43,10 +45,8 @@ class MRIDatasetMRBRAINS2018(Dataset):
         self.sub_vol_path = self.root + '/mrbrains_2018/generated/' + mode + subvol + '/'
         utils.make_dirs(self.sub_vol_path)
 
-        list_reg_t1 = sorted(glob.glob(os.path.join(self.training_path, '*/pr*/*g_T1.nii.gz')))
-        list_reg_ir = sorted(glob.glob(os.path.join(self.training_path, '*/pr*/*g_IR.nii.gz')))
-        list_flair = sorted(glob.glob(os.path.join(self.training_path, '*/pr*/*AIR.nii.gz')))
-        labels = sorted(glob.glob(os.path.join(self.training_path, '*/*egm.nii.gz')))
+        list_reg_t1, list_reg_ir, list_flair, labels = find_dataset(self.training_path,
+                                                                   dataset_layouts[dataset_name]['patterns'])
         self.affine = img_loader.load_affine_matrix(list_reg_t1[0])
 
         split_id = int(split_id)
@@ -66,7 +66,7 @@ class MRIDatasetMRBRAINS2018(Dataset):
                                        dataset_name=dataset_name, mode=mode,
                                        samples=samples, full_vol_dim=self.full_vol_size,
                                        crop_size=self.crop_dim, sub_vol_path=self.sub_vol_path,
-                                       th_percent=self.threshold)
+                                       th_percent=self.threshold, sampling=self.sampling)
 
         utils.save_list(self.save_name, self.list)
 
@@ -74,5 +74,5 @@ class MRIDatasetMRBRAINS2018(Dataset):
         return len(self.list)
 
     def __getitem__(self, index):
-        t1_path, ir_path, flair_path, seg_path = self.list[index]
-        return np.load(t1_path), np.load(ir_path), np.load(flair_path), np.load(seg_path)
+        *images, segmentation_map = load_sub_volume(self.list[index])
+        return stack_modalities([images[c] for c in self.channels], segmentation_map)
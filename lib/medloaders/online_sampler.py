@@ -0,0 +1,158 @@
+from multiprocessing.reduction import ForkingPickler
+
+import numpy as np
+import torch
+
+from lib.medloaders import medical_image_process as img_loader
+from lib.medloaders.medical_loader_utils import load_crop_sampler
+from lib.medloaders.volume_cache import LRUCache
+
+
+class OnlinePatchSampler(object):
+    """
+    Draws random sub-volumes on the fly instead of generating them to disk.
+    Decoded full volumes are kept in a bounded LRU cache and a fresh crop is cut
+    on every access, so every epoch sees new patches. Every drawn subject serves
+    crops_per_subject consecutive items, so most of them are cut from a cached volume.
+    Items have the same layout as the generated samples: (modality_0, ..., modality_n, label)
+    """
+
+    def __init__(self, *ls, dataset_name, samples, full_vol_dim, crop_size, normalization='max_min',
+                 th_percent=0.1, cache_size=8, crops_per_subject=4, seed=None, pool=None, foreground_crop=False,
+                 class_ratios=None, intensity_stats=None):
+        """
+        :param ls: list of modality paths, where the last path is the segmentation map
+        :param dataset_name: which dataset is used
+        :param samples: number of crops per epoch
+        :param full_vol_dim: full image size
+        :param crop_size: train volume size
+        :param th_percent: the % of the croped dim that corresponds to non-zero labels
+        :param cache_size: number of decoded subjects kept in memory
+        :param crops_per_subject: number of consecutive items cut from every drawn subject, in every worker
+        (items [k * crops_per_subject, (k + 1) * crops_per_subject) share a subject if seeded)
+        :param seed: if given, sample i is always the same crop (e.g. for validation)
+        :param pool: SharedVolumePool of the subjects, built with the same crop settings,
+        crops are then cut from shared memory
+        :param foreground_crop: keep only the bounding box of the non-zero voxels of every decoded subject
+        :param class_ratios: class weights of a ClassBalancedCropSampler, see create_crop_sampler
+        :param intensity_stats: precomputed statistics of the patch-read images, see precompute_intensity_stats
+        """
+        self.total = len(ls[0])
+        assert self.total != 0, "Problem reading data. Check the data paths."
+        self.ls = ls
+        self.dataset_name = dataset_name
+        self.samples = samples
+        self.full_vol_dim = full_vol_dim
+        self.crop_size = crop_size
+        self.normalization = normalization
+        self.th_percent = th_percent
+        self.cache_size = cache_size
+        self.crops_per_subject = crops_per_subject
+        self.seed = seed
+        self.pool = pool
+        assert pool is None or pool.crop_size == tuple(crop_size), "the pool samples crops of another size"
+        self.foreground_crop = foreground_crop
+        self.class_ratios = class_ratios
+        self.intensity_stats = intensity_stats or {}
+        self.cache = LRUCache(cache_size)
+        self.rng = None
+        self.rng_seed = None
+        self.subject = None
+        self.subject_crops = 0
+
+    def __len__(self):
+        return self.samples
+
+    def random_state(self, index):
+        if self.seed is not None:
+            return np.random.RandomState([self.seed, index])
+        # torch seeds every DataLoader worker differently at each epoch
+        seed = torch.initial_seed() % 2 ** 32
+        if self.rng is None or self.rng_seed != seed:
+            self.rng = np.random.RandomState(seed)
+            self.rng_seed = seed
+            self.subject_crops = 0
+        return self.rng
+
+    def draw_subject(self, index, rng):
+        if self.seed is not None:
+            group = index // self.crops_per_subject
+            # another stream than the crops of RandomState([seed, index])
+            return np.random.RandomState([self.seed, group, 0]).randint(self.total)
+        if self.subject_crops == 0:
+            self.subject = rng.randint(self.total)
+            self.subject_crops = self.crops_per_subject
+        self.subject_crops -= 1
+        return self.subject
+
+    def load_subject(self, subject):
+        # every worker process gets the stored statistics, before its first patch read
+        img_loader.intensity_stats.update(self.intensity_stats)
+        if self.pool is not None:
+            images, segmentation_map = self.pool.volume(subject)
+            return list(images), segmentation_map, self.pool.crop_samplers[subject]
+        modalities = len(self.ls)
+        if self.foreground_crop:
+            paths = [self.ls[j][subject] for j in range(modalities - 1)]
+            tensor_images, bbox = img_loader.load_foreground_volumes(paths, normalization=self.normalization,
+                                                                     min_size=self.crop_size)
+            segmentation_map, crop_sampler = load_crop_sampler(self.ls[-1][subject], self.dataset_name,
+                                                               self.crop_size, self.th_percent, bbox=bbox,
+                                                               class_ratios=self.class_ratios)
+            return tensor_images, segmentation_map, crop_sampler
+        segmentation_map, crop_sampler = load_crop_sampler(self.ls[-1][subject], self.dataset_name, self.crop_size,
+                                                           self.th_percent, class_ratios=self.class_ratios)
+        tensor_images = []
+        for j in range(modalities - 1):
+            path = self.ls[j][subject]
+            if img_loader.is_compressed(path):
+                img_tensor = img_loader.load_medical_image(path, type="T1", normalization=self.normalization)
+            else:
+                # uncompressed modalities are read crop by crop, see load_medical_image_patch
+                img_tensor = None
+            tensor_images.append(img_tensor)
+        return tensor_images, segmentation_map, crop_sampler
+
+    def __getitem__(self, index):
+        rng = self.random_state(index)
+        subject = self.draw_subject(index, rng)
+        tensor_images, segmentation_map, crop_sampler = self.cache.get(subject, lambda: self.load_subject(subject))
+        crop = crop_sampler.sample(rng)
+
+        crops = []
+        for j, img_tensor in enumerate(tensor_images):
+            if img_tensor is None:
+                img_tensor = img_loader.load_medical_image(self.ls[j][subject], type="T1",
+                                                           normalization=self.normalization,
+                                                           crop_size=self.crop_size, crop=crop)
+                crops.append(img_tensor.numpy())
+            else:
+                crops.append(img_loader.crop_img(img_tensor, self.crop_size, crop).numpy().copy())
+        crops.append(img_loader.crop_img(segmentation_map, self.crop_size, crop).numpy().copy())
+        return tuple(crops)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cache'] = LRUCache(self.cache_size)
+        state['rng'] = None
+        state['rng_seed'] = None
+        state['subject'] = None
+        state['subject_crops'] = 0
+        # a saved sampler reads its subjects from disk again, only the DataLoader workers share the pool
+        state['pool'] = None
+        return state
+
+
+def rebuild_sampler(state):
+    sampler = OnlinePatchSampler.__new__(OnlinePatchSampler)
+    sampler.__dict__.update(state)
+    return sampler
+
+
+def reduce_sampler(sampler):
+    state = sampler.__getstate__()
+    state['pool'] = sampler.pool
+    return rebuild_sampler, (state,)
+
+
+ForkingPickler.register(OnlinePatchSampler, reduce_sampler)
@@ -0,0 +1,67 @@
+import numpy as np
+
+"""
+Compact encodings of the generated image crops.
+float32 : stored as is
+float16 : half precision, half the size
+int16   : quantized to 16 bits with a per-crop scale and offset, half the size,
+          with a uniform error of at most scale / 2 over the crop intensity range
+Encoded int16 crops travel as (data, scale, offset) tuples until they are decoded.
+"""
+
+codecs = ('float32', 'float16', 'int16')
+
+
+def encode_image(img, codec='float32'):
+    """
+    :return: the encoded array, or a (data, scale, offset) tuple for int16
+    """
+    img = np.asarray(img, dtype=np.float32)
+    if codec == 'float32':
+        return img
+    if codec == 'float16':
+        return img.astype(np.float16)
+    assert codec == 'int16', "codec must be one of {}".format(codecs)
+    low, high = float(img.min()), float(img.max())
+    scale = (high - low) / 65535.0 if high > low else 1.0
+    quantized = np.rint((img - low) / scale - 32768.0)
+    data = np.clip(quantized, -32768, 32767, out=quantized).astype(np.int16)
+    return data, np.float32(scale), np.float32(low + 32768.0 * scale)
+
+
+def decode_image(img, out=None):
+    """
+    Decodes an encoded crop to float32, written straight into out if given
+    """
+    if isinstance(img, tuple):
+        data, scale, offset = img
+        out = np.empty(data.shape, dtype=np.float32) if out is None else out
+        np.multiply(data, np.float32(scale), out=out, dtype=np.float32)
+        out += np.float32(offset)
+        return out
+    if out is None:
+        return np.array(img, dtype=np.float32)
+    np.copyto(out, img, casting='unsafe')
+    return out
+
+
+def save_image(filename, img, codec='float32'):
+    """
+    Saves an image crop, int16 crops go to an .npz file with their scale and offset
+    :return: the name of the saved file
+    """
+    encoded = encode_image(img, codec)
+    if codec == 'int16':
+        filename = filename[:-len('.npy')] + '.npz'
+        data, scale, offset = encoded
+        np.savez(filename, data=data, scale=scale, offset=offset)
+    else:
+        np.save(filename, encoded)
+    return filename
+
+
+def load_image(filename):
+    if filename.endswith('.npz'):
+        with np.load(filename) as f:
+            return f['data'], f['scale'][()], f['offset'][()]
+    return np.load(filename)
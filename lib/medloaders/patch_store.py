@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+
+from lib.medloaders.patch_codec import encode_image
+
+"""
+Packed, memory-mapped storage for generated sub-volumes.
+All the crops of a split live in one contiguous array per kind (images, labels)
+plus a small index, instead of one .npy file per modality per crop.
+"""
+
+
+class PatchStore(object):
+    """
+    images.npy : samples x modalities x crop_size
+    labels.npy : samples x crop_size
+    index.npz  : subject id and crop origin of every sample (row i is sample i),
+                 and the int16 scale and offset of every image (samples x modalities)
+    Items are returned as memory-mapped views, so reading a sample costs no
+    open/stat calls and no copies. Images of an int16 store are (data, scale, offset)
+    tuples, see patch_codec.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        index = np.load(os.path.join(path, 'index.npz'))
+        self.subjects = index['subjects']
+        self.crops = index['crops']
+        self.scales = index['scales'] if 'scales' in index else None
+        self.offsets = index['offsets'] if 'offsets' in index else None
+        self.images = None
+        self.labels = None
+
+    @classmethod
+    def create(cls, path, samples, modalities, crop_size, codec='float32', label_dtype=np.float32):
+        """
+        Allocates an empty store on disk and returns it opened for writing
+        :param path: directory of the store
+        :param samples: number of crops
+        :param modalities: number of image modalities (the label is stored apart)
+        :param crop_size: 3d crop shape
+        :param codec: image encoding, see patch_codec
+        """
+        crop_size = tuple(int(d) for d in crop_size)
+        np.lib.format.open_memmap(os.path.join(path, 'images.npy'), mode='w+', dtype=np.dtype(codec),
+                                  shape=(samples, modalities) + crop_size)
+        np.lib.format.open_memmap(os.path.join(path, 'labels.npy'), mode='w+', dtype=label_dtype,
+                                  shape=(samples,) + crop_size)
+        np.savez(os.path.join(path, 'index.npz'), subjects=np.zeros(samples, dtype=np.int32),
+                 crops=np.zeros((samples, 3), dtype=np.int32), scales=np.ones((samples, modalities), np.float32),
+                 offsets=np.zeros((samples, modalities), np.float32))
+        store = cls(path)
+        store.open(mode='r+')
+        return store
+
+    def open(self, mode='r'):
+        self.images = np.load(os.path.join(self.path, 'images.npy'), mmap_mode=mode)
+        self.labels = np.load(os.path.join(self.path, 'labels.npy'), mmap_mode=mode)
+
+    def write(self, i, tensor_images, segmentation_map, subject_id, crop):
+        for j, img in enumerate(tensor_images):
+            encoded = encode_image(img, self.images.dtype.name)
+            if isinstance(encoded, tuple):
+                encoded, self.scales[i, j], self.offsets[i, j] = encoded
+            self.images[i, j] = encoded
+        self.labels[i] = np.asarray(segmentation_map)
+        self.subjects[i] = subject_id
+        self.crops[i] = crop
+
+    def flush(self):
+        self.images.flush()
+        self.labels.flush()
+        np.savez(os.path.join(self.path, 'index.npz'), subjects=self.subjects, crops=self.crops, scales=self.scales,
+                 offsets=self.offsets)
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def __getitem__(self, index):
+        """
+        Returns the modalities and the label of a sample, in the same order
+        as the per-file sample tuples: (modality_0, ..., modality_n, label)
+        """
+        if self.images is None:
+            # opened lazily so that every DataLoader worker maps the files itself
+            self.open()
+        if self.images.dtype == np.int16:
+            images = tuple(zip(self.images[index], self.scales[index], self.offsets[index]))
+        else:
+            images = tuple(self.images[index])
+        return images + (self.labels[index],)
+
+    def __getstate__(self):
+        # pickle only the location, never the mapped data
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
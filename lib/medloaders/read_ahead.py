@@ -0,0 +1,173 @@
+import collections
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from torch.utils.data import RandomSampler, Sampler, SequentialSampler
+
+from lib.medloaders.sample_index import SampleIndex
+
+"""
+Read-ahead of the files of the next samples (or volumes), so that cold reads (e.g. over NFS)
+overlap with the work on the current ones instead of stalling it.
+Background threads hint the kernel with posix_fadvise(WILLNEED), where available, and read every
+file through (sendfile to /dev/null, without copies to user space), which leaves it in the page
+cache shared by all the processes (DataLoader workers included) and tells when it is warm.
+A sample whose files were warm when it was requested is a hit, one whose read-ahead was still
+running a miss.
+It pays off when cold reads are slow compared to the training step (network filesystems, spinning
+disks, datasets larger than the page cache) and cores are left for the read threads. On local SSDs,
+or with a single core, the reads are short and the threads only compete with the loader workers,
+the DataLoader prefetching is enough there, so it is off unless asked for (--read_ahead N).
+"""
+
+
+def warm_file(path, chunk_size=1 << 22):
+    """
+    Brings a file into the page cache, returns once it is there
+    :return: bytes read
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            # lets the kernel read ahead the whole file in large requests
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        size = os.fstat(fd).st_size
+        if hasattr(os, 'sendfile') and os.path.exists(os.devnull):
+            # read in the kernel and discarded, without copies to user space
+            with open(os.devnull, 'wb') as null:
+                total = 0
+                while total < size:
+                    sent = os.sendfile(null.fileno(), fd, total, size - total)
+                    if sent == 0:
+                        break
+                    total += sent
+                return total
+        total = 0
+        while True:
+            data = os.read(fd, chunk_size)
+            if not data:
+                return total
+            total += len(data)
+    finally:
+        os.close(fd)
+
+
+def warm_files(paths):
+    return sum(warm_file(path) for path in paths)
+
+
+class ReadAhead(object):
+    """
+    hits, misses : samples requested with their files already warm, or not
+    warmed_bytes : bytes read ahead
+    """
+
+    def __init__(self, depth=8, threads=4):
+        """
+        :param depth: number of items warmed ahead of the current one
+        :param threads: concurrent reads
+        """
+        self.depth = depth
+        self.threads = threads
+        self.executor = None
+        self.hits = 0
+        self.misses = 0
+        self.warmed_bytes = 0
+
+    def schedule(self, paths):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.threads)
+        future = self.executor.submit(warm_files, paths)
+        future.add_done_callback(self.count_bytes)
+        return future
+
+    def count_bytes(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.warmed_bytes += future.result()
+
+    def iterate(self, items, files):
+        """
+        Yields the items, the files of the next depth items being warmed in the background
+        :param files: item -> list of file paths
+        """
+        window = collections.deque()
+        items = iter(items)
+        for item in items:
+            window.append((item, self.schedule(files(item))))
+            if len(window) > self.depth:
+                yield self.claim(*window.popleft())
+        while window:
+            yield self.claim(*window.popleft())
+
+    def claim(self, item, future):
+        # a pending read is not cancelled, it still shortens the read of the item
+        if future.done():
+            self.hits += 1
+        else:
+            self.misses += 1
+        return item
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def reset(self):
+        self.hits, self.misses, self.warmed_bytes = 0, 0, 0
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['executor'] = None
+        return state
+
+    def __repr__(self):
+        return 'ReadAhead({} hits, {} misses, {:.1f} MB read ahead)'.format(self.hits, self.misses,
+                                                                           self.warmed_bytes / 2 ** 20)
+
+
+class ReadAheadSampler(Sampler):
+    """
+    Sampler that warms the files of the next depth indices of another sampler, in the order
+    the DataLoader dispatches them to its workers
+    """
+
+    def __init__(self, sampler, files, depth=8, threads=4):
+        """
+        :param sampler: sampler giving the order of the indices
+        :param files: index -> list of file paths
+        """
+        self.sampler = sampler
+        self.files = files
+        self.read_ahead = ReadAhead(depth, threads)
+
+    def __iter__(self):
+        return self.read_ahead.iterate(iter(self.sampler), self.files)
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+def sample_files(dataset):
+    """
+    index -> files of a sample, for the datasets of generated per-file samples, None otherwise
+    (packed samples are one memory-mapped store, online samples are cut from volumes in memory)
+    """
+    samples = getattr(dataset, 'list', None)
+    if not isinstance(samples, (list, SampleIndex)):
+        return None
+    return lambda index: [f for f in samples[index] if isinstance(f, str)]
+
+
+def read_ahead_sampler(dataset, shuffle=True, depth=8, threads=4):
+    """
+    :return: a ReadAheadSampler over the dataset, or None if its samples are not files
+    """
+    files = sample_files(dataset)
+    if files is None:
+        return None
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return ReadAheadSampler(sampler, files, depth=depth, threads=threads)
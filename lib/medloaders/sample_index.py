@@ -0,0 +1,54 @@
+import numpy as np
+
+"""
+Array-backed index of generated sub-volume files.
+A list of tuples of path strings holds one Python object per path, and every access
+from a forked DataLoader worker touches their reference counts, which un-shares the
+pages of the list one by one. Here the whole index is a few flat numpy buffers, so the
+workers keep sharing it read-only whatever the number of samples. The file names of a
+sample follow from its id and subject id, only the source paths of every subject are stored.
+"""
+
+
+class SampleIndex(object):
+    """
+    subject_paths : subjects x files, utf-8 encoded source paths of every subject (modalities then the label)
+    subjects      : int32 subject id of every sample
+    crops         : int32 crop origin of every sample
+    Items are the same tuples of paths as the per-file sample lists
+    """
+
+    def __init__(self, sub_vol_path, subject_paths, subjects, crops, codec='float32'):
+        """
+        :param sub_vol_path: prefix of the generated files, see generate_subject_sub_volumes
+        :param codec: codec of the saved image crops, int16 crops are .npz files (see patch_codec)
+        """
+        self.sub_vol_path = sub_vol_path
+        self.subject_paths = np.char.encode(np.asarray(subject_paths, dtype=np.str_), 'utf-8')
+        self.subjects = np.asarray(subjects, dtype=np.int32)
+        self.crops = np.asarray(crops, dtype=np.int32)
+        self.image_ext = '.npz' if codec == 'int16' else '.npy'
+
+    @property
+    def modalities(self):
+        return self.subject_paths.shape[1] - 1
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def __getitem__(self, index):
+        filename = sample_filename(self.sub_vol_path, self.subjects[index], index)
+        return tuple(filename + str(j) + self.image_ext for j in range(self.modalities)) + (filename + 'seg.npy',)
+
+    def subject_files(self, index):
+        """
+        Source paths of the subject of a sample
+        """
+        return tuple(p.decode('utf-8') for p in self.subject_paths[self.subjects[index]])
+
+
+def sample_filename(sub_vol_path, subject, sample):
+    """
+    Common prefix of the saved files of a sample, followed by the modality number or 'seg'
+    """
+    return '{}id_{}_s_{}_modality_'.format(sub_vol_path, subject, sample)
@@ -0,0 +1,66 @@
+"""
+How the sub-volumes of the loaders are produced: generated to .npy files, packed in one PatchStore,
+cut online at every access or served as a grid of tiles. The options are read once from the
+command line arguments (see SamplingOptions.from_args) and handed to every loader.
+"""
+
+
+class SamplingOptions(object):
+    """
+    packed          : write all the crops in one memory-mapped PatchStore instead of one .npy file per modality
+    online          : draw the crops on the fly at every access and write nothing to disk
+    workers         : number of processes generating the samples, the output does not depend on it
+    shared          : with online, decode every subject once into a SharedVolumePool used by all the workers
+    codec           : encoding of the saved image crops, 'float32', 'float16' or 'int16' (see patch_codec)
+    foreground_crop : crop every subject to the bounding box of its non-zero voxels before sampling,
+                      the recorded crop origins stay in full volume coordinates
+    class_ratios    : if given, crops are centred on a voxel of a class drawn with these weights (background
+                      first, see ClassBalancedCropSampler) instead of holding th_percent of the labels
+    grid            : validate on every crop-sized tile of every subject instead of random crops
+    read_ahead      : number of samples (volumes, while generating with one worker) read ahead in the background
+    cache_size      : with online, number of decoded subjects kept in memory by every worker
+    crops_per_subject : with online, number of consecutive crops cut from every drawn subject
+    """
+
+    def __init__(self, packed=False, online=False, workers=1, shared=False, codec='float32', foreground_crop=False,
+                 class_ratios=None, grid=False, read_ahead=0, cache_size=8, crops_per_subject=4):
+        self.packed = packed
+        self.online = online
+        self.workers = workers
+        self.shared = shared
+        self.codec = codec
+        self.foreground_crop = foreground_crop
+        self.class_ratios = class_ratios
+        self.grid = grid
+        self.read_ahead = read_ahead
+        self.cache_size = cache_size
+        self.crops_per_subject = crops_per_subject
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(packed=getattr(args, 'packed', False),
+                   online=getattr(args, 'online_sampling', False),
+                   workers=getattr(args, 'generation_workers', 1),
+                   shared=getattr(args, 'shared_memory', False),
+                   codec=getattr(args, 'patch_codec', 'float32'),
+                   foreground_crop=getattr(args, 'foreground_crop', False),
+                   class_ratios=getattr(args, 'class_ratios', None),
+                   grid=getattr(args, 'grid_validation', False),
+                   read_ahead=getattr(args, 'read_ahead', 0),
+                   cache_size=getattr(args, 'cache_size', 8),
+                   crops_per_subject=getattr(args, 'crops_per_subject', 4))
+
+    def method(self, mode):
+        """
+        'grid', 'online', 'packed' or 'files', how the samples of a train/val loader are produced
+        """
+        if self.grid and mode == 'val':
+            return 'grid'
+        if self.online:
+            return 'online'
+        if self.packed:
+            return 'packed'
+        return 'files'
+
+    def __repr__(self):
+        return 'SamplingOptions({})'.format(', '.join('{}={!r}'.format(k, v) for k, v in self.__dict__.items()))
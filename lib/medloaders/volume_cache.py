@@ -0,0 +1,144 @@
+import glob
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LRUCache(object):
+    """
+    Bounded least-recently-used cache for decoded volumes
+    :param max_items: number of entries kept in memory
+    :param max_bytes: optional bound on the total size of the (numpy) entries
+    """
+
+    def __init__(self, max_items=8, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        """
+        Returns the cached value of key, calling loader() to produce it on a miss
+        """
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value = loader()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.bytes -= nbytes(self.entries.pop(key))
+        self.entries[key] = value
+        self.bytes += nbytes(value)
+        while len(self.entries) > 1 and (len(self.entries) > self.max_items or (
+                self.max_bytes is not None and self.bytes > self.max_bytes)):
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= nbytes(evicted)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+def nbytes(value):
+    return getattr(value, 'nbytes', 0)
+
+
+class VolumeCache(object):
+    """
+    Content-addressed cache of preprocessed full volumes, in memory and optionally on disk.
+    Entries are keyed by the file path, its modification time and size, and every
+    preprocessing argument, so editing a file or changing the pipeline never returns
+    a stale volume. Both levels are size-bounded with least-recently-used eviction.
+    :param cache_dir: directory of the on-disk level, None keeps the cache in memory only
+    :param max_memory_mb: size of the in-memory level
+    :param max_disk_mb: size of the on-disk level
+    """
+
+    def __init__(self, cache_dir=None, max_memory_mb=2048, max_disk_mb=20480):
+        self.cache_dir = cache_dir
+        self.max_memory_mb = max_memory_mb
+        self.max_disk_mb = max_disk_mb
+        self.memory = LRUCache(max_items=float('inf'), max_bytes=max_memory_mb * 2 ** 20)
+        self.disk_hits = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(path, **params):
+        stat = os.stat(path)
+        description = repr((os.path.abspath(path), stat.st_mtime_ns, stat.st_size, sorted(params.items())))
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def get(self, key, loader):
+        """
+        Returns the numpy volume of key, calling loader() to produce it on a miss
+        """
+        if key in self.memory:
+            return self.memory.get(key, loader)
+
+        filename = self.filename(key)
+        if filename is not None and os.path.exists(filename):
+            self.disk_hits += 1
+            volume = np.load(filename)
+            # the modification time orders the disk entries for eviction
+            os.utime(filename)
+        else:
+            volume = loader()
+            if filename is not None:
+                self.save(filename, volume)
+        self.memory.put(key, volume)
+        return volume
+
+    def filename(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def save(self, filename, volume):
+        # write then rename, so that concurrent workers never read a partial file
+        tmp = filename + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, volume)
+        os.replace(tmp, filename)
+        self.evict()
+
+    def evict(self):
+        files = []
+        for f in glob.glob(os.path.join(self.cache_dir, '*.npy')):
+            try:
+                stat = os.stat(f)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, f))
+        total = sum(size for _, size, _ in files)
+        for _, size, f in sorted(files):
+            if total <= self.max_disk_mb * 2 ** 20:
+                break
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def __getstate__(self):
+        # workers get the configuration, not the in-memory volumes
+        return {'cache_dir': self.cache_dir, 'max_memory_mb': self.max_memory_mb, 'max_disk_mb': self.max_disk_mb}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
@@ -0,0 +1,124 @@
+from multiprocessing.reduction import ForkingPickler
+
+import nibabel as nib
+import numpy as np
+import torch
+
+from lib.medloaders import medical_image_process as img_loader
+from lib.medloaders.crop_samplers import create_crop_sampler
+from lib.medloaders.medical_loader_utils import fix_seg_map
+
+"""
+In-RAM pool of decoded subjects shared by all the DataLoader workers.
+Every subject is decoded and normalized once, its modalities are stacked as C x D x H x W
+and copied into one flat shared-memory tensor (the labels into a second, uint8 one).
+Workers receive the pool by reference (fork, or torch's shared-memory pickling for spawn)
+and cut their patches from views of it, without disk I/O. The crop samplers of the subjects are
+built once with the pool and reach the workers with it. The pool cannot be pickled otherwise
+(e.g. by utils.save_list), that would decode the whole dataset again.
+"""
+
+
+class SharedVolumePool(object):
+    """
+    images  : flat float32 shared tensor holding every subject, C x D x H x W each
+    labels  : flat uint8 shared tensor holding every label map, D x H x W each
+    shapes  : subjects x 3 volume shape, offsets: start of every subject in labels
+    (images start at channels * offset)
+    bboxes  : subjects x 6 region of the full volume held by the pool, see img_loader.foreground_bbox
+    crop_samplers : crop sampler of every subject, if the pool was given a crop size
+    """
+
+    def __init__(self, *ls, dataset_name, normalization='max_min', foreground_crop=False, min_size=(0, 0, 0),
+                 crop_size=None, th_percent=0.1, class_ratios=None):
+        """
+        :param ls: list of modality paths, where the last path is the segmentation map
+        :param foreground_crop: hold only the bounding box of the non-zero voxels of every subject
+        :param min_size: smallest size of the kept boxes, e.g. the crop size
+        :param crop_size: if given, the crop sampler of every subject is built, see create_crop_sampler
+        """
+        self.ls = ls
+        self.dataset_name = dataset_name
+        self.normalization = normalization
+        self.foreground_crop = foreground_crop
+        self.min_size = tuple(min_size)
+        self.crop_size = None if crop_size is None else tuple(crop_size)
+        self.th_percent = th_percent
+        self.class_ratios = class_ratios
+        self.total = len(ls[0])
+        assert self.total != 0, "Problem reading data. Check the data paths."
+        self.channels = len(ls) - 1
+        subjects = [None] * self.total
+        if foreground_crop:
+            # the box sizes are known once the subjects are decoded, they are held until the pool is allocated
+            subjects = [self.load_subject(subject) for subject in range(self.total)]
+            self.bboxes = np.array([bbox for _, _, bbox in subjects], dtype=np.int64)
+            self.shapes = self.bboxes[:, 3:] - self.bboxes[:, :3]
+        else:
+            # headers give the size of the pool before anything is decoded
+            self.shapes = np.array([[d for d in nib.load(path).shape if d != 1] for path in ls[-1]], dtype=np.int64)
+            self.bboxes = np.concatenate([np.zeros_like(self.shapes), self.shapes], axis=1)
+        voxels = np.prod(self.shapes, axis=1)
+        self.offsets = np.concatenate([[0], np.cumsum(voxels)])
+        self.images = torch.empty(int(self.offsets[-1]) * self.channels, dtype=torch.float32).share_memory_()
+        self.labels = torch.empty(int(self.offsets[-1]), dtype=torch.uint8).share_memory_()
+        self.crop_samplers = [None] * self.total
+
+        for subject in range(self.total):
+            images, label = self.volume(subject)
+            subject_images, subject_label, _ = subjects[subject] or self.load_subject(subject)
+            subjects[subject] = None
+            for j in range(self.channels):
+                images[j] = subject_images[j]
+            label.copy_(subject_label)
+            if self.crop_size is not None:
+                self.crop_samplers[subject] = create_crop_sampler(label.numpy(), self.crop_size, th_percent,
+                                                                  class_ratios)
+        print('Shared volume pool: {} subjects, {:.1f} MB'.format(
+            self.total, (self.images.numel() * 4 + self.labels.numel()) / 2 ** 20))
+
+    def load_subject(self, subject):
+        """
+        :return: decoded modalities, label map and bbox of a subject
+        """
+        paths = [self.ls[j][subject] for j in range(self.channels)]
+        if self.foreground_crop:
+            images, bbox = img_loader.load_foreground_volumes(paths, normalization=self.normalization,
+                                                              min_size=self.min_size)
+        else:
+            images = [img_loader.load_medical_image(path, type="T1", normalization=self.normalization)
+                      for path in paths]
+            bbox = (0, 0, 0) + tuple(images[0].shape)
+        label = img_loader.load_medical_image(self.ls[-1][subject], viz3d=True, type='label')
+        label = fix_seg_map(label[img_loader.bbox_slices(bbox)], self.dataset_name)
+        return images, label, bbox
+
+    def __len__(self):
+        return self.total
+
+    def volume(self, subject):
+        """
+        Views of the C x D x H x W images and of the D x H x W label map of a subject
+        """
+        start, end = int(self.offsets[subject]), int(self.offsets[subject + 1])
+        shape = tuple(int(s) for s in self.shapes[subject])
+        images = self.images[start * self.channels:end * self.channels].view((self.channels,) + shape)
+        return images, self.labels[start:end].view(shape)
+
+    def __reduce__(self):
+        raise TypeError('SharedVolumePool only goes to DataLoader workers (by shared-memory handles), '
+                        'pickling it would decode the whole dataset again on load')
+
+
+def rebuild_pool(state):
+    pool = SharedVolumePool.__new__(SharedVolumePool)
+    pool.__dict__.update(state)
+    return pool
+
+
+def reduce_pool(pool):
+    # the tensors go through torch's reductions, i.e. as shared-memory handles
+    return rebuild_pool, (pool.__dict__,)
+
+
+ForkingPickler.register(SharedVolumePool, reduce_pool)
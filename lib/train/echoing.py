@@ -0,0 +1,65 @@
+import math
+
+"""
+Data echoing (Choi et al., "Faster Neural Network Training with Data Echoing", 2019):
+when the loader cannot keep up with the training steps, every loaded batch is used
+k times, the repeats with a different cheap augmentation, instead of waiting for I/O.
+"""
+
+
+class EchoFactor(object):
+    """
+    Number of training steps per loaded batch. Fixed, or with echo=0 chosen after every loaded batch
+    so that the k steps on a batch cover the time the loader takes to deliver the next one.
+    A batch that had to be waited for measures the loader period, its wait plus the k steps
+    on the batch before it, and
+    k = ceil(period / step) from moving averages. Without any wait the loader may be faster
+    than k steps: after patience such batches in a row, k is lowered by one to find out.
+    """
+
+    def __init__(self, echo=1, max_echo=4, momentum=0.9, patience=10):
+        """
+        :param echo: steps per loaded batch, 0 for automatic
+        :param max_echo: maximum automatic echo factor
+        :param momentum: of the moving averages of the loader period and of the step time
+        :param patience: loaded batches without wait before lowering the automatic echo factor
+        """
+        self.auto = echo == 0
+        self.k = 1 if self.auto else echo
+        self.max_echo = max_echo
+        self.momentum = momentum
+        self.patience = patience
+        self.period = None
+        self.step = None
+        self.idle = 0
+        self.previous = None
+
+    def average(self, name, value):
+        previous = getattr(self, name)
+        setattr(self, name, value if previous is None else self.momentum * previous + (1 - self.momentum) * value)
+
+    def update(self, wait, step):
+        """
+        :param wait: time spent waiting for the last loaded batch, after the steps on the batch before it
+        :param step: time of one training step on the last loaded batch
+        :return: the echo factor of the next loaded batch
+        """
+        if not self.auto:
+            return self.k
+        self.average('step', step)
+        previous, self.previous = self.previous, self.k
+        if previous is None:
+            # the first batch also waited for the loader to start
+            return self.k
+        if wait >= 0.05 * step:
+            self.idle = 0
+            self.average('period', wait + previous * step)
+            # the tolerance keeps k when the loader delivers right on time
+            k = int(math.ceil(self.period / max(self.step, 1e-9) - 0.05))
+        else:
+            self.idle += 1
+            k = self.k
+            if self.idle >= self.patience:
+                k, self.idle = k - 1, 0
+        self.k = min(self.max_echo, max(1, k))
+        return self.k
@@ -1,6 +1,10 @@
+import time
+
 import numpy as np
 import torch
 
+from lib.augment3D import EchoAugmentation
+from lib.train.echoing import EchoFactor
 from lib.utils.general import prepare_input
 from lib.visual3D_temp.BaseWriter import TensorboardWriter
 
@@ -29,6 +33,12 @@ class Trainer:
         self.save_frequency = 10
         self.terminal_show_freq = self.args.terminal_show_freq
         self.start_epoch = 1
+        # data echoing: every loaded batch is trained on echo.k times, the repeats augmented
+        self.echo = EchoFactor(getattr(args, 'data_echoing', 1))
+        self.echo_augmentation = EchoAugmentation()
+        # tensorboard step of the next trained batch (echoes included), and of the first one of the epoch
+        self.train_step = None
+        self.epoch_step = None
 
     def training(self):
         for epoch in range(self.start_epoch, self.args.nEpochs):
@@ -51,29 +61,50 @@ class Trainer:
 
     def train_epoch(self, epoch):
         self.model.train()
+        if self.train_step is None:
+            self.train_step = epoch * self.len_epoch
+        self.epoch_step = self.train_step
+        step = 0
 
+        loaded = time.perf_counter()
         for batch_idx, input_tuple in enumerate(self.train_data_loader):
-
-            self.optimizer.zero_grad()
+            wait = time.perf_counter() - loaded
 
             input_tensor, target = prepare_input(input_tuple=input_tuple, args=self.args)
-            input_tensor.requires_grad = True
-            output = self.model(input_tensor)
-            loss_dice, per_ch_score = self.criterion(output, target)
-            loss_dice.backward()
-            self.optimizer.step()
-
-            self.writer.update_scores(batch_idx, loss_dice.item(), per_ch_score, 'train',
-                                      epoch * self.len_epoch + batch_idx)
+            start, echoes = time.perf_counter(), self.echo.k
+            for echo in range(echoes):
+                if echo == 0:
+                    self.train_batch(input_tensor, target, step)
+                else:
+                    with torch.no_grad():
+                        echoed = self.echo_augmentation(input_tensor, target)
+                    self.train_batch(*echoed, step)
+                step += 1
+            self.echo.update(wait, (time.perf_counter() - start) / echoes)
 
             if (batch_idx + 1) % self.terminal_show_freq == 0:
                 partial_epoch = epoch + batch_idx / self.len_epoch - 1
                 self.writer.display_terminal(partial_epoch, epoch, 'train')
+            loaded = time.perf_counter()
 
         self.writer.display_terminal(self.len_epoch, epoch, mode='train', summary=True)
 
+    def train_batch(self, input_tensor, target, step):
+        self.optimizer.zero_grad()
+
+        input_tensor.requires_grad = True
+        output = self.model(input_tensor)
+        loss_dice, per_ch_score = self.criterion(output, target)
+        loss_dice.backward()
+        self.optimizer.step()
+
+        self.writer.update_scores(step, loss_dice.item(), per_ch_score, 'train', self.train_step)
+        self.train_step += 1
+
     def validate_epoch(self, epoch):
         self.model.eval()
+        # validation is logged on the training step axis, from the first step of the epoch
+        epoch_step = epoch * self.len_epoch if self.epoch_step is None else self.epoch_step
 
         for batch_idx, input_tuple in enumerate(self.valid_data_loader):
             with torch.no_grad():
@@ -83,7 +114,6 @@ class Trainer:
                 output = self.model(input_tensor)
                 loss, per_ch_score = self.criterion(output, target)
 
-                self.writer.update_scores(batch_idx, loss.item(), per_ch_score, 'val',
-                                          epoch * self.len_epoch + batch_idx)
+                self.writer.update_scores(batch_idx, loss.item(), per_ch_score, 'val', epoch_step + batch_idx)
 
         self.writer.display_terminal(len(self.valid_data_loader), epoch, mode='val', summary=True)
@@ -21,6 +21,16 @@ def reproducibility(args, seed):
     cudnn.benchmark = True
 
 
+def seed_worker(worker_id):
+    """
+    DataLoader worker_init_fn: seeds numpy and random from the worker torch seed (base seed + worker id),
+    so that the workers, and the epochs, do not repeat the same random augmentations
+    """
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
 def save_arguments(args, path):
     with open(path + '/training_arguments.txt', 'w') as f:
         json.dump(args.__dict__, f, indent=2)
@@ -39,6 +49,25 @@ def shuffle_lists(*ls, seed=777):
     return zip(*l)
 
 
+def channel_indices(modalities, channels, channel_ids=None):
+    """
+    Modalities fed to the model, in order
+    :param modalities: number of modalities of the dataset
+    :param channels: number of input channels of the model
+    :param channel_ids: explicit list of modality indices, overrides the defaults
+    """
+    if channel_ids is not None:
+        assert len(channel_ids) == channels, "channel_ids must list inChannels modalities"
+        return list(channel_ids)
+    if modalities == 4 and channels == 3:
+        # t1 post constast is ommited
+        return [0, 2, 3]
+    if modalities == 4 and channels == 2:
+        # t1 and t2 only
+        return [0, 2]
+    return list(range(min(modalities, channels)))
+
+
 def prepare_input(input_tuple, inModalities=-1, inChannels=-1, cuda=False, args=None):
     if args is not None:
         modalities = args.inModalities
@@ -48,40 +77,12 @@ def prepare_input(input_tuple, inModalities=-1, inChannels=-1, cuda=False, args=
         modalities = inModalities
         channels = inChannels
         in_cuda = cuda
-    if modalities == 4:
-        if channels == 4:
-            img_1, img_2, img_3, img_4, target = input_tuple
-            input_tensor = torch.cat((img_1, img_2, img_3, img_4), dim=1)
-        elif channels == 3:
-            # t1 post constast is ommited
-            img_1, _, img_3, img_4, target = input_tuple
-            input_tensor = torch.cat((img_1, img_3, img_4), dim=1)
-        elif channels == 2:
-            # t1 and t2 only
-            img_1, _, img_3, _, target = input_tuple
-            input_tensor = torch.cat((img_1, img_3), dim=1)
-        elif channels == 1:
-            # t1 only
-            input_tensor, _, _, target = input_tuple
-    if modalities == 3:
-        if channels == 3:
-            img_1, img_2, img_3, target = input_tuple
-            input_tensor = torch.cat((img_1, img_2, img_3), dim=1)
-        elif channels == 2:
-            img_1, img_2, _, target = input_tuple
-            input_tensor = torch.cat((img_1, img_2), dim=1)
-        elif channels == 1:
-            input_tensor, _, _, target = input_tuple
-    elif modalities == 2:
-        if channels == 2:
-            img_t1, img_t2, target = input_tuple
-
-            input_tensor = torch.cat((img_t1, img_t2), dim=1)
-
-        elif channels == 1:
-            input_tensor, _, target = input_tuple
-    elif modalities == 1:
+    if len(input_tuple) == 2:
+        # the datasets stack the selected modalities as C x D x H x W already
         input_tensor, target = input_tuple
+    else:
+        target = input_tuple[-1]
+        input_tensor = torch.cat([input_tuple[c] for c in channel_indices(modalities, channels)], dim=1)
 
     if in_cuda:
         input_tensor, target = input_tensor.cuda(), target.cuda()
@@ -0,0 +1,183 @@
+import csv
+import glob
+import os
+import queue
+import threading
+import time
+
+import nibabel as nib
+import numpy as np
+import torch
+
+from lib.medloaders import medical_image_process as img_loader
+from .sliding_window import sliding_window_inference, streaming_sliding_window_inference
+from .viz import save_3d_vol
+
+"""
+Batch inference over many NIfTI studies.
+Decoding + preprocessing, the model forward and the NIfTI write run in separate
+threads connected by bounded queues, so the I/O of one study overlaps the
+prediction of the next one.
+"""
+
+# marks the end of a queue
+_done = object()
+
+
+def find_studies(input_path, modalities):
+    """
+    Lists the studies to segment
+    :param input_path: a csv manifest with one study per line (study_id, modality_0, ..., modality_n),
+    or a directory holding one sub-directory per study, or one file per study if there is a single modality
+    :param modalities: file name suffixes of the modalities inside a study directory, in model input order
+    :return: list of (study_id, [modality paths])
+    """
+    if os.path.isfile(input_path):
+        with open(input_path) as f:
+            return [(row[0], row[1:]) for row in csv.reader(f) if row and not row[0].startswith('#')]
+
+    studies = []
+    for entry in sorted(os.listdir(input_path)):
+        path = os.path.join(input_path, entry)
+        if os.path.isdir(path):
+            paths = []
+            for suffix in modalities:
+                matches = sorted(glob.glob(os.path.join(path, '*' + suffix)))
+                assert len(matches) == 1, "study {} has {} files matching {}".format(entry, len(matches), suffix)
+                paths.append(matches[0])
+            studies.append((entry, paths))
+        elif len(modalities) == 1 and entry.endswith(modalities[0]):
+            studies.append((entry[:-len(modalities[0])], [path]))
+    return studies
+
+
+class BatchInference(object):
+    """
+    Segments a list of studies with a producer/consumer pipeline:
+    loader threads (decode + preprocess) -> model forward (calling thread) -> writer thread (save_3d_vol)
+    """
+
+    def __init__(self, model, output_dir, dim, classes, overlap=0.5, batch_size=4, blend='gaussian',
+                 normalization='full_volume_mean', memory_budget_mb=None, io_workers=2, queue_size=2,
+                 foreground_crop=False):
+        """
+        :param model: any BaseModel, already restored and on its device
+        :param output_dir: predictions are saved as output_dir/<study_id>.nii.gz
+        :param dim: sliding window size
+        :param memory_budget_mb: if given, predicts with the memory-bounded streaming engine
+        :param io_workers: number of decode + preprocess threads
+        :param queue_size: number of decoded studies waiting for the model
+        :param foreground_crop: predict only the bounding box of the voxels non-zero in any modality,
+        the prediction is padded back to the full volume with the background label
+        """
+        self.model = model
+        self.output_dir = output_dir
+        self.dim = dim
+        self.classes = classes
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.blend = blend
+        self.normalization = normalization
+        self.memory_budget_mb = memory_budget_mb
+        self.io_workers = io_workers
+        self.queue_size = queue_size
+        self.foreground_crop = foreground_crop
+        self.latency = {}
+        self.failed = {}
+
+    def load(self, study_id, paths):
+        """
+        :return: study_id, C x D x H x W input, affine, (bbox, full volume shape) or None, load start time
+        """
+        start = time.time()
+        header = nib.load(paths[0])
+        if self.foreground_crop:
+            volumes, bbox = img_loader.load_foreground_volumes(paths, normalization=self.normalization,
+                                                               min_size=self.dim)
+            crop = (bbox, tuple(d for d in header.shape if d != 1))
+        else:
+            volumes = [img_loader.load_medical_image(path, type='T1', normalization=self.normalization)
+                       for path in paths]
+            crop = None
+        return study_id, torch.stack(volumes, dim=0), header.affine, crop, start
+
+    def predict(self, input_tensor):
+        if self.memory_budget_mb is not None:
+            return streaming_sliding_window_inference(input_tensor, self.model, self.dim, self.classes,
+                                                      overlap=self.overlap, blend=self.blend,
+                                                      memory_budget_mb=self.memory_budget_mb,
+                                                      max_batch_size=self.batch_size, verbose=False)
+        logits = sliding_window_inference(input_tensor, self.model, self.dim, overlap=self.overlap,
+                                          batch_size=self.batch_size, blend=self.blend, verbose=False)
+        return logits.argmax(dim=0).numpy().astype(np.uint8)
+
+    def loader(self, tasks, loaded):
+        while True:
+            try:
+                study_id, paths = tasks.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                loaded.put(self.load(study_id, paths))
+            except Exception as e:
+                self.failed[study_id] = repr(e)
+        loaded.put(_done)
+
+    def writer(self, predicted):
+        while True:
+            item = predicted.get()
+            if item is _done:
+                break
+            study_id, labels, affine, crop, start = item
+            try:
+                if crop is not None:
+                    labels = img_loader.pad_to_full_volume(labels, *crop)
+                save_3d_vol(labels, affine, os.path.join(self.output_dir, study_id))
+                self.latency[study_id] = time.time() - start
+                print('{}: {:.2f}s'.format(study_id, self.latency[study_id]))
+            except Exception as e:
+                self.failed[study_id] = repr(e)
+
+    def run(self, studies):
+        """
+        :param studies: list of (study_id, [modality paths]), see find_studies
+        :return: dict of per-study latency in seconds (load start to saved prediction)
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        tasks = queue.Queue()
+        for study in studies:
+            tasks.put(study)
+        loaded = queue.Queue(maxsize=self.queue_size)
+        predicted = queue.Queue(maxsize=self.queue_size)
+
+        start = time.time()
+        loaders = [threading.Thread(target=self.loader, args=(tasks, loaded), daemon=True)
+                   for _ in range(max(1, self.io_workers))]
+        writer = threading.Thread(target=self.writer, args=(predicted,), daemon=True)
+        for thread in loaders + [writer]:
+            thread.start()
+
+        running = len(loaders)
+        while running > 0:
+            item = loaded.get()
+            if item is _done:
+                running -= 1
+                continue
+            study_id, input_tensor, affine, crop, study_start = item
+            try:
+                predicted.put((study_id, self.predict(input_tensor), affine, crop, study_start))
+            except Exception as e:
+                self.failed[study_id] = repr(e)
+        predicted.put(_done)
+        writer.join()
+
+        elapsed = time.time() - start
+        print('Segmented {} studies in {:.2f}s ({:.3f} studies/sec), {} failed'.format(
+            len(self.latency), elapsed, len(self.latency) / max(elapsed, 1e-9), len(self.failed)))
+        if self.latency:
+            latencies = np.array(list(self.latency.values()))
+            print('Per-study latency: mean {:.2f}s, median {:.2f}s, max {:.2f}s'.format(
+                latencies.mean(), np.median(latencies), latencies.max()))
+        for study_id, error in self.failed.items():
+            print('FAILED {}: {}'.format(study_id, error))
+        return self.latency
@@ -0,0 +1,207 @@
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+"""
+Sliding-window inference over full 3D volumes.
+Windows are run through the model in batches and their logits are blended
+into a preallocated output buffer with a per-voxel importance weight.
+The streaming variant bounds the peak memory of very large scans (e.g. CT)
+with a reduced-precision or memory-mapped accumulator.
+"""
+
+
+def window_starts(size, patch, stride):
+    """
+    Start indices along one axis, the last window is aligned to the end of the axis
+    """
+    if size <= patch:
+        return [0]
+    starts = list(range(0, size - patch + 1, stride))
+    if starts[-1] != size - patch:
+        starts.append(size - patch)
+    return starts
+
+
+def sliding_window_coords(volume_shape, patch_size, stride):
+    """
+    Lazily yields the (d, h, w) origin of every window
+    """
+    for d in window_starts(volume_shape[0], patch_size[0], stride[0]):
+        for h in window_starts(volume_shape[1], patch_size[1], stride[1]):
+            for w in window_starts(volume_shape[2], patch_size[2], stride[2]):
+                yield d, h, w
+
+
+def importance_map(patch_size, blend='gaussian', sigma_scale=0.125):
+    """
+    Weight of every voxel of a window, gaussian blending favours the window centres
+    :param blend: 'gaussian' or 'uniform'
+    :param sigma_scale: gaussian sigma as a fraction of the patch size
+    """
+    if blend == 'uniform':
+        return torch.ones(patch_size)
+    assert blend == 'gaussian', "blend must be 'gaussian' or 'uniform'"
+    weights = torch.ones(())
+    for p in patch_size:
+        x = torch.arange(p, dtype=torch.float32) - (p - 1) / 2.0
+        g = torch.exp(-0.5 * (x / (p * sigma_scale)) ** 2)
+        weights = weights.unsqueeze(-1) * g
+    weights = weights / weights.max()
+    # border voxels must keep a non-zero weight
+    return weights.clamp(min=1e-3)
+
+
+def compute_stride(patch_size, overlap):
+    assert 0 <= overlap < 1, "overlap must be in [0, 1)"
+    return tuple(max(1, int(round(p * (1 - overlap)))) for p in patch_size)
+
+
+def predict_windows(x, model, patch_size, stride, batch_size):
+    """
+    Runs the windows of x through the model in batches
+    :return: generator of (window origins, batch logits)
+    """
+    modalities = x.shape[0]
+    batch = torch.empty((batch_size, modalities) + patch_size, dtype=x.dtype)
+    coords = sliding_window_coords(tuple(x.shape[1:]), patch_size, stride)
+    while True:
+        origins = [c for _, c in zip(range(batch_size), coords)]
+        if not origins:
+            break
+        for b, (d, h, w) in enumerate(origins):
+            batch[b].copy_(x[:, d:d + patch_size[0], h:h + patch_size[1], w:w + patch_size[2]])
+        yield origins, model.inference(batch[:len(origins)].to(model.device)).float()
+
+
+def window_region(origin, patch_size):
+    d, h, w = origin
+    return slice(d, d + patch_size[0]), slice(h, h + patch_size[1]), slice(w, w + patch_size[2])
+
+
+def pad_to_patch(input_tensor, patch_size):
+    # volumes smaller than a window are zero padded at the end
+    x = input_tensor.detach().cpu()
+    pad = [max(0, p - s) for p, s in zip(patch_size, x.shape[1:])]
+    if any(pad):
+        x = F.pad(x, (0, pad[2], 0, pad[1], 0, pad[0]))
+    return x
+
+
+def sliding_window_inference(input_tensor, model, patch_size, overlap=0.5, batch_size=4, blend='gaussian',
+                             verbose=True):
+    """
+    Predicts a full volume with overlapping windows
+    :param input_tensor: modalities x D x H x W volume
+    :param model: any BaseModel, windows go through model.inference
+    :param patch_size: window size (d, h, w)
+    :param overlap: fraction of overlap between neighbouring windows, 0 tiles the volume
+    :param batch_size: windows per forward pass
+    :param blend: 'gaussian' or 'uniform' importance weighting of the windows
+    :return: classes x D x H x W logits
+    """
+    patch_size = tuple(int(p) for p in patch_size)
+    D, H, W = input_tensor.shape[1:]
+    x = pad_to_patch(input_tensor, patch_size)
+    volume_shape = tuple(x.shape[1:])
+
+    weight = importance_map(patch_size, blend)
+    output, weights = None, torch.zeros(volume_shape)
+
+    start = time.time()
+    patches = 0
+    for origins, logits in predict_windows(x, model, patch_size, compute_stride(patch_size, overlap), batch_size):
+        if output is None:
+            output = torch.zeros((logits.shape[1],) + volume_shape)
+        for b, origin in enumerate(origins):
+            region = window_region(origin, patch_size)
+            output[(slice(None),) + region].addcmul_(logits[b], weight)
+            weights[region] += weight
+        patches += len(origins)
+
+    output /= weights
+    elapsed = time.time() - start
+    if verbose:
+        print('Sliding window inference: {} patches in {:.2f}s ({:.2f} patches/sec)'.format(
+            patches, elapsed, patches / max(elapsed, 1e-9)))
+    return output[:, :D, :H, :W]
+
+
+def plan_streaming(volume_shape, patch_size, modalities, classes, memory_budget_mb, max_batch_size=8):
+    """
+    Picks the accumulator and the batch size that fit in the memory budget.
+    The accumulator is float32 if it fits in half of the budget, float16 if that fits,
+    and an on-disk float32 memmap otherwise. The rest of the budget bounds the batch size.
+    :return: (accumulator kind: 'float32', 'float16' or 'memmap', batch size)
+    """
+    budget = memory_budget_mb * 2 ** 20
+    voxels = int(np.prod(volume_shape))
+    # the uint8 label map, the importance weights need no buffer as they do not change the argmax
+    fixed = voxels
+    if fixed + classes * voxels * 4 <= budget // 2:
+        kind, accumulator = 'float32', classes * voxels * 4
+    elif fixed + classes * voxels * 2 <= budget // 2:
+        kind, accumulator = 'float16', classes * voxels * 2
+    else:
+        kind, accumulator = 'memmap', 0
+    # input batch, logits and weighted logits of every window
+    window = int(np.prod(patch_size)) * 4 * (modalities + 2 * classes)
+    batch_size = (budget - fixed - accumulator) // window
+    return kind, int(max(1, min(max_batch_size, batch_size)))
+
+
+def streaming_sliding_window_inference(input_tensor, model, patch_size, classes, overlap=0.5, blend='gaussian',
+                                       memory_budget_mb=2048, max_batch_size=8, slab=16, tmp_dir=None,
+                                       verbose=True):
+    """
+    Predicts the label map of a full volume while bounding the peak memory.
+    Windows are generated lazily and their weighted logits are folded into an accumulator
+    chosen by plan_streaming. The summed weights are the same for every class of a voxel,
+    so the label map is the argmax of the accumulator, taken slab by slab along the first axis.
+    :param classes: number of output channels of the model
+    :param memory_budget_mb: memory for the accumulator and the window batches, the input volume excluded
+    :param slab: first-axis planes per argmax step
+    :param tmp_dir: directory of the memmap accumulator, the default temp dir if None
+    :return: D x H x W uint8 label map
+    """
+    patch_size = tuple(int(p) for p in patch_size)
+    D, H, W = input_tensor.shape[1:]
+    x = pad_to_patch(input_tensor, patch_size)
+    volume_shape = tuple(x.shape[1:])
+    kind, batch_size = plan_streaming(volume_shape, patch_size, x.shape[0], classes, memory_budget_mb,
+                                      max_batch_size)
+
+    weight = importance_map(patch_size, blend)
+    tmp = None
+    if kind == 'memmap':
+        tmp = tempfile.NamedTemporaryFile(suffix='.dat', dir=tmp_dir)
+        output = torch.from_numpy(np.memmap(tmp, dtype=np.float32, mode='w+', shape=(classes,) + volume_shape))
+    else:
+        output = torch.zeros((classes,) + volume_shape, dtype=getattr(torch, kind))
+
+    start = time.time()
+    patches = 0
+    for origins, logits in predict_windows(x, model, patch_size, compute_stride(patch_size, overlap), batch_size):
+        assert logits.shape[1] == classes, "model predicts {} classes, not {}".format(logits.shape[1], classes)
+        logits.mul_(weight)
+        for b, origin in enumerate(origins):
+            region = window_region(origin, patch_size)
+            output[(slice(None),) + region] += logits[b].to(output.dtype)
+        patches += len(origins)
+
+    labels = np.empty((D, H, W), dtype=np.uint8)
+    for d in range(0, D, slab):
+        planes = slice(d, min(d + slab, D))
+        labels[planes] = output[:, planes, :H, :W].float().argmax(dim=0).numpy()
+    del output
+    if tmp is not None:
+        tmp.close()
+
+    elapsed = time.time() - start
+    if verbose:
+        print('Streaming inference ({} accumulator, batch {}): {} patches in {:.2f}s ({:.2f} patches/sec)'.format(
+            kind, batch_size, patches, elapsed, patches / max(elapsed, 1e-9)))
+    return labels
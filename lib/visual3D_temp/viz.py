@@ -4,6 +4,7 @@ import nibabel as nib
 import torch
 import torch.nn.functional as F
 
+from .sliding_window import sliding_window_inference, streaming_sliding_window_inference
 from .viz_2d import *
 
 
@@ -45,53 +46,8 @@ def non_overlap_padding(args, full_volume, model,criterion, kernel_dim=(32, 32,
     #print(target.max())
     #print('full volume {} = input {} + target{}'.format(full_volume.shape, x.shape,target.shape))
 
-    modalities, D, H, W = x.shape
-    kc, kh, kw = kernel_dim
-    dc, dh, dw = kernel_dim  # stride
-    # Pad to multiples of kernel_dim
-    a = ((roundup(W, kw) - W) // 2 + W % 2, (roundup(W, kw) - W) // 2,
-         (roundup(H, kh) - H) // 2 + H % 2, (roundup(H, kh) - H) // 2,
-         (roundup(D, kc) - D) // 2 + D % 2, (roundup(D, kc) - D) // 2)
-    #print('padding ', a)
-    x = F.pad(x, a)
-    #print('padded shape ', x.shape)
-    assert x.size(3) % kw == 0
-    assert x.size(2) % kh == 0
-    assert x.size(1) % kc == 0
-    patches = x.unfold(1, kc, dc).unfold(2, kh, dh).unfold(3, kw, dw)
-    unfold_shape = list(patches.size())
-
-    patches = patches.contiguous().view(-1, modalities, kc, kh, kw)
-
-    ## TODO torch stack
-    # with torch.no_grad():
-    #     output = model.inference(patches)
-    number_of_volumes = patches.shape[0]
-    predictions = []
-
-    for i in range(number_of_volumes):
-        input_tensor = patches[i, ...].unsqueeze(0)
-        predictions.append(model.inference(input_tensor))
-    output = torch.stack(predictions, dim=0).squeeze(1).detach()
-    # print(output.shape)
-    N, Classes, _, _, _ = output.shape
-    # Reshape backlist
-    output_unfold_shape = unfold_shape[1:]
-    output_unfold_shape.insert(0, Classes)
-    # print(output_unfold_shape)
-    output = output.view(output_unfold_shape)
-
-    output_c = output_unfold_shape[1] * output_unfold_shape[4]
-    output_h = output_unfold_shape[2] * output_unfold_shape[5]
-    output_w = output_unfold_shape[3] * output_unfold_shape[6]
-    output = output.permute(0, 1, 4, 2, 5, 3, 6).contiguous()
-    output = output.view(-1, output_c, output_h, output_w)
-
-
-    y = output[:, a[4]:output_c - a[5], a[2]:output_h - a[3], a[0]:output_w - a[1]]
-
-    print(target.dtype,torch.randn(1,4,156,240,240).dtype)
-
+    # non-overlapping tiles, run in batches
+    y = sliding_window_inference(x, model, kernel_dim, overlap=0, batch_size=args.batchSz, blend='uniform')
 
     loss_dice, per_ch_score = criterion(y.unsqueeze(0).cuda(),target.cuda())
     print("INFERENCE DICE LOSS {} ".format(loss_dice.item()))
@@ -105,39 +61,31 @@ def visualize_3D_no_overlap_new(args, full_volume, affine, model, epoch, dim):
     compare some slices with ground truth
     :param full_volume: t1, t2, segment
     :param dim: (d1,d2,d3))
-    :return: 3d reconstructed volume
     """
-    classes = args.classes
-    modalities, slices, height, width = full_volume.shape
-    full_volume_dim = (slices, height, width)
+    # non-overlapping tiles, run in batches (volumes need not be multiples of dim)
+    visualize_3D_sliding_window(args, full_volume, affine, model, epoch, dim, overlap=0, blend='uniform')
 
-    print("full volume dim=", full_volume_dim, 'crop dim', dim)
-    desired_dim = find_crop_dims(full_volume_dim, dim)
-    print("Inference dims=", desired_dim)
 
-    input_sub_volumes, segment_map = create_3d_subvol(full_volume, desired_dim)
-    print(input_sub_volumes.shape, segment_map.shape)
-
-    sub_volumes = input_sub_volumes.shape[0]
-    predictions = []
-
-    for i in range(sub_volumes):
-        input_tensor = input_sub_volumes[i, ...].unsqueeze(0)
-        predictions.append(model.inference(input_tensor))
-
-    predictions = torch.stack(predictions)
-
-    # project back to full volume
-    full_vol_predictions = predictions.view(classes, slices, height, width)
-    print("Inference complete", full_vol_predictions.shape)
-
-    # arg max to get the labels in full 3d volume
-    _, indices = full_vol_predictions.max(dim=0)
-    full_vol_predictions = indices
-
-    print("Class indexed prediction shape", full_vol_predictions.shape, "GT", segment_map.shape)
+def visualize_3D_sliding_window(args, full_volume, affine, model, epoch, dim, overlap=0.5, blend='gaussian',
+                                memory_budget_mb=None):
+    """
+    Predicts the full 3d volume with overlapping, blended sub-volumes,
+    compares some slices with ground truth and saves the prediction
+    :param full_volume: t1, t2, segment
+    :param dim: (d1,d2,d3) window size
+    :param memory_budget_mb: if given, predicts with the streaming, memory-bounded engine (large CT scans)
+    """
+    input_tensor, segment_map = full_volume[:-1, ...], full_volume[-1, ...]
+    if memory_budget_mb is not None:
+        full_vol_predictions = torch.from_numpy(streaming_sliding_window_inference(
+            input_tensor, model, dim, args.classes, overlap=overlap, blend=blend,
+            memory_budget_mb=memory_budget_mb, max_batch_size=args.batchSz)).long()
+    else:
+        full_vol_predictions = sliding_window_inference(input_tensor, model, dim, overlap=overlap,
+                                                        batch_size=args.batchSz, blend=blend)
+        # arg max to get the labels in full 3d volume
+        _, full_vol_predictions = full_vol_predictions.max(dim=0)
 
-    # TODO TEST...................
     save_path_2d_fig = args.save + '/' + 'epoch__' + str(epoch).zfill(4) + '.png'
     create_2d_views(full_vol_predictions, segment_map, save_path_2d_fig)
 
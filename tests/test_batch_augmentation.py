@@ -0,0 +1,67 @@
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from lib.augment3D import (BatchAugmentCollate, BatchAugmentation, ComposeTransforms, GaussianNoise, RandomFlip,
+                           RandomRotation, RandomShift, RandomZoom)
+from lib.utils.general import seed_worker
+
+"""
+Batched torch augmentation (flips, affine warp, bias field, gamma and noise on a whole
+B x C x D x H x W batch) against the per-sample scipy.ndimage transforms, on a
+batch of 4 samples of 4 x 64^3, and distinct augmentations in every DataLoader worker
+"""
+
+
+class ConstantDataset(Dataset):
+    def __init__(self, size=8, channels=4, shape=(32, 32, 32)):
+        self.size = size
+        self.image = torch.rand(channels, *shape, generator=torch.Generator().manual_seed(0))
+        self.label = (self.image[0] > 0.5).to(torch.uint8)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        return self.image.clone(), self.label.clone()
+
+
+def batch(batch_size=4, channels=4, shape=(64, 64, 64)):
+    rng = np.random.default_rng(0)
+    images = rng.normal(size=(batch_size, channels) + shape).astype(np.float32)
+    labels = rng.integers(0, 4, size=(batch_size,) + shape).astype(np.uint8)
+    return images, labels
+
+
+images, labels = batch()
+per_sample = ComposeTransforms([RandomRotation(), RandomZoom(), RandomShift(), RandomFlip(), GaussianNoise(std=0.01)],
+                               p=1)
+start = time.perf_counter()
+for b in range(len(images)):
+    per_sample(list(images[b]), labels[b])
+per_sample_time = time.perf_counter() - start
+
+augmentation = BatchAugmentation(p=1)
+best = float('inf')
+for _ in range(3):
+    start = time.perf_counter()
+    augmented, augmented_labels = augmentation(torch.from_numpy(images), torch.from_numpy(labels))
+    best = min(best, time.perf_counter() - start)
+assert augmented.shape == images.shape and augmented_labels.dtype == torch.uint8
+assert torch.isfinite(augmented).all()
+print('per-sample scipy transforms {:8.1f} ms / batch'.format(1000 * per_sample_time))
+print('BatchAugmentation           {:8.1f} ms / batch  speedup {:5.1f}x'.format(1000 * best, per_sample_time / best))
+
+# every worker, and every epoch, draws its own parameters from the same samples
+torch.manual_seed(0)
+loader = DataLoader(ConstantDataset(), batch_size=2, num_workers=2, worker_init_fn=seed_worker,
+                    collate_fn=BatchAugmentCollate(BatchAugmentation(p=1)))
+epochs = [[b[0] for b in loader] for _ in range(2)]
+outputs = [o for epoch in epochs for o in epoch]
+for i in range(len(outputs)):
+    for j in range(i + 1, len(outputs)):
+        assert not torch.equal(outputs[i], outputs[j]), (i, j)
+    assert not torch.equal(outputs[i][0], outputs[i][1])
+print('{} batches, all augmented differently'.format(len(outputs)))
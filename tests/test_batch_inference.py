@@ -0,0 +1,72 @@
+import os
+import tempfile
+import threading
+
+import nibabel as nib
+import numpy as np
+import torch
+
+from lib.visual3D_temp.batch_inference import BatchInference, find_studies
+
+"""
+find_studies on a directory of studies, a csv manifest and single-modality files, and
+BatchInference.run over studies that fail to load (corrupt file) or to predict (a constant
+volume, NaN after max_min): they end up in failed, the others are saved, nothing hangs
+"""
+
+
+class Pointwise(torch.nn.Module):
+    def __init__(self, modalities, classes):
+        super().__init__()
+        self.conv = torch.nn.Conv3d(modalities, classes, kernel_size=1)
+        self.device = torch.device('cpu')
+
+    def inference(self, x):
+        if torch.isnan(x).any():
+            raise ValueError('NaN input')
+        with torch.no_grad():
+            return self.conv(x)
+
+
+rng = np.random.RandomState(0)
+shape, modalities = (20, 18, 16), ('_t1.nii', '_t2.nii')
+
+with tempfile.TemporaryDirectory() as path:
+    input_dir = os.path.join(path, 'studies')
+    for study in ['a', 'b', 'corrupt', 'constant', 'c']:
+        os.makedirs(os.path.join(input_dir, study))
+        for suffix in modalities:
+            filename = os.path.join(input_dir, study, study + suffix)
+            if study == 'corrupt' and suffix == '_t2.nii':
+                with open(filename, 'wb') as f:
+                    f.write(b'not a nifti file')
+                continue
+            volume = np.full(shape, 7., np.float32) if study == 'constant' else rng.rand(*shape).astype(np.float32)
+            nib.save(nib.Nifti1Image(volume, np.eye(4)), filename)
+
+    studies = find_studies(input_dir, list(modalities))
+    assert [s for s, _ in studies] == ['a', 'b', 'c', 'constant', 'corrupt']
+    assert studies[0][1] == [os.path.join(input_dir, 'a', 'a' + suffix) for suffix in modalities]
+    manifest = os.path.join(path, 'studies.csv')
+    with open(manifest, 'w') as f:
+        f.write('# study_id, t1, t2\n')
+        f.writelines('{},{}\n'.format(study_id, ','.join(paths)) for study_id, paths in studies)
+    assert find_studies(manifest, list(modalities)) == studies
+    assert [s for s, _ in find_studies(os.path.join(input_dir, 'a'), ['_t1.nii'])] == ['a']
+    print('find_studies lists the same studies from a directory and a manifest')
+
+    model = Pointwise(len(modalities), classes=3)
+    output_dir = os.path.join(path, 'predictions')
+    for memory_budget_mb in (None, 64):
+        inference = BatchInference(model, output_dir, dim=(16, 16, 16), classes=3, normalization='max_min',
+                                   memory_budget_mb=memory_budget_mb, io_workers=2, queue_size=1)
+        run = threading.Thread(target=inference.run, args=(studies,), daemon=True)
+        run.start()
+        run.join(timeout=120)
+        assert not run.is_alive(), 'the pipeline hangs'
+        assert sorted(inference.failed) == ['constant', 'corrupt'], inference.failed
+        assert sorted(inference.latency) == ['a', 'b', 'c']
+        for study_id in inference.latency:
+            labels = nib.load(os.path.join(output_dir, study_id + '.nii.gz')).get_fdata()
+            assert labels.shape == shape and set(np.unique(labels)) <= {0, 1, 2}
+    print('BatchInference saves the other studies and records the failed ones')
@@ -0,0 +1,50 @@
+import numpy as np
+
+from lib.medloaders.crop_samplers import (ClassBalancedCropSampler, ForegroundCropSampler, box_sum,
+                                          crop_origin_sums, label_integral_image)
+
+"""
+Summed-area table crop sums against brute-force sums over the crops, and crop samplers
+drawing only admissible, in-bounds origins
+"""
+
+rng = np.random.RandomState(0)
+labels = (rng.rand(20, 17, 13) > 0.9).astype(np.uint8) * rng.randint(1, 4, size=(20, 17, 13)).astype(np.uint8)
+crop_size = (6, 5, 4)
+positions = tuple(s - c + 1 for s, c in zip(labels.shape, crop_size))
+foreground = labels > 0
+
+brute = np.zeros(positions, dtype=np.int64)
+for d in range(positions[0]):
+    for h in range(positions[1]):
+        for w in range(positions[2]):
+            brute[d, h, w] = foreground[d:d + crop_size[0], h:h + crop_size[1], w:w + crop_size[2]].sum()
+
+sat = label_integral_image(labels)
+assert sat[-1, -1, -1] == foreground.sum()
+assert np.array_equal(crop_origin_sums(sat, crop_size, slice(0, positions[0])), brute)
+# in chunks of planes, as ForegroundCropSampler computes them
+chunks = [crop_origin_sums(sat, crop_size, slice(s, min(s + 4, positions[0]))) for s in range(0, positions[0], 4)]
+assert np.array_equal(np.concatenate(chunks), brute)
+for crop in [(0, 0, 0), (3, 7, 2), tuple(p - 1 for p in positions)]:
+    assert box_sum(sat, crop_size, crop) == brute[crop]
+print('summed-area table: {} crop sums match the brute force'.format(brute.size))
+
+th_percent = 0.03
+sampler = ForegroundCropSampler(labels, crop_size, th_percent)
+admissible = brute / foreground.sum() >= th_percent
+assert 0 < admissible.sum() < admissible.size and len(sampler) == admissible.sum()
+draws = np.random.RandomState(1)
+for _ in range(200):
+    crop = sampler.sample(draws)
+    assert admissible[crop] and abs(sampler.label_fraction(crop) - brute[crop] / foreground.sum()) < 1e-12
+
+# no crop qualifies: every position is admissible
+assert len(ForegroundCropSampler(labels, crop_size, th_percent=1.0)) == np.prod(positions)
+
+balanced = ClassBalancedCropSampler(labels, crop_size, class_ratios=[0, 0, 0, 1])
+for _ in range(200):
+    crop = balanced.sample(draws)
+    assert all(0 <= c <= p - 1 for c, p in zip(crop, positions))
+    assert (labels[tuple(slice(c, c + s) for c, s in zip(crop, crop_size))] == 3).any()
+print('crop samplers: every draw admissible')
@@ -0,0 +1,30 @@
+from lib.train.echoing import EchoFactor
+
+"""
+Automatic echo factor against a simulated loader that delivers a batch every loader_period seconds
+(one batch prefetched), for a training step of 0.1 s: k settles on ceil(loader_period / step)
+"""
+
+
+def simulate(loader_period, step=0.1, batches=300):
+    echo = EchoFactor(0)
+    ready, now, factors = loader_period, 0., []
+    for _ in range(batches):
+        wait = max(0., ready - now)
+        now += wait
+        ready = now + loader_period
+        factors.append(echo.k)
+        now += echo.k * step
+        echo.update(wait, step)
+    return factors
+
+
+for loader_period, expected in [(0.05, 1), (0.15, 2), (0.25, 3), (0.3, 3), (1.0, 4)]:
+    factors = simulate(loader_period)
+    # lowered by one for a batch or two every patience batches, to check if the loader got faster
+    settled = max(set(factors[-100:]), key=factors[-100:].count)
+    assert settled == expected, (loader_period, factors[-30:])
+    print('loader period {:4.2f} s, step 0.10 s: k = {}'.format(loader_period, settled))
+
+fixed = EchoFactor(3)
+assert fixed.update(1.0, 0.1) == 3
@@ -0,0 +1,57 @@
+import time
+
+import numpy as np
+import torch
+
+from lib.augment3D import RandomChoice
+from lib.augment3D.elastic_deform import CoarseElasticTransform, ElasticTransform, elastic_sampling_grid
+
+"""
+Shared-field elastic deformation (CoarseElasticTransform, one grid_sample pass for all the modalities
+and the label) against the per-modality ElasticTransform, on 4 x 128^3 samples, and against the
+target of 100 ms per sample. Nearly all the time goes to the grid_sample warp, which runs on the
+torch threads: the target assumes several cores, with a single thread the warp takes 2-4x longer.
+"""
+
+target = 0.1
+
+
+def sample(seed, channels=4, shape=(128, 128, 128)):
+    rng = np.random.default_rng(seed)
+    images = [rng.normal(size=shape).astype(np.float32) for _ in range(channels)]
+    label = rng.integers(0, 4, size=shape).astype(np.uint8)
+    return images, label
+
+
+def benchmark(transform, repeats):
+    best = float('inf')
+    for seed in range(repeats):
+        images, label = sample(seed)
+        start = time.perf_counter()
+        outputs = transform(images, label)
+        best = min(best, time.perf_counter() - start)
+    return best, outputs
+
+
+reference = RandomChoice(transforms=[ElasticTransform()], p=1)
+shared = RandomChoice(transforms=[CoarseElasticTransform(max_displacement=4.0)], p=1)
+
+reference_time, _ = benchmark(reference, repeats=1)
+shared_time, (images, label) = benchmark(shared, repeats=5)
+grid_time, _ = benchmark(lambda images, label: elastic_sampling_grid(label.shape, 32, 4.0), repeats=5)
+
+# the same field for every modality: identical modalities stay identical
+same = sample(0)[0][0]
+warped, _ = shared([same, same.copy()], None)
+assert np.array_equal(warped[0], warped[1])
+assert len(images) == 4 and label.shape == (128, 128, 128) and label.dtype == np.uint8
+assert set(np.unique(label)) <= {0, 1, 2, 3}
+assert shared_time < reference_time
+
+print('per-modality ElasticTransform {:8.1f} ms'.format(1000 * reference_time))
+print('CoarseElasticTransform        {:8.1f} ms  speedup {:5.1f}x'.format(1000 * shared_time,
+                                                                          reference_time / shared_time))
+print('  of which the sampling grid   {:8.1f} ms'.format(1000 * grid_time))
+print('target {:.0f} ms per sample with {} torch threads: {}'.format(
+    1000 * target, torch.get_num_threads(), 'met' if shared_time < target else
+    'missed by {:.1f}x'.format(shared_time / target)))
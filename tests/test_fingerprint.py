@@ -0,0 +1,64 @@
+import os
+import tempfile
+
+import nibabel as nib
+import numpy as np
+
+from lib.medloaders import medical_image_process as img_loader
+from lib.medloaders.fingerprint import DatasetFingerprint, IntensityHistogram
+
+"""
+Streaming intensity fingerprint: histograms and moments merged part by part equal those of the whole
+data (np.percentile, mean and std), in any merge order, and a fingerprint saved and loaded back
+registers the same statistics for every scanned image
+"""
+
+rng = np.random.RandomState(0)
+# integer intensities (e.g. CT), where the percentiles of a bin width of 1 are exact
+parts = [rng.randint(-1024, 3000, size=n).astype(np.float32) for n in (5000, 1, 1200, 0, 7000)]
+values = np.concatenate(parts).astype(np.float64)
+
+merged = IntensityHistogram()
+for part in parts:
+    merged.merge(IntensityHistogram().update(part))
+reverse = IntensityHistogram()
+for part in parts[::-1]:
+    reverse.update(part)
+
+for histogram in (merged, reverse):
+    assert histogram.count == len(values) and histogram.counts.sum() == len(values)
+    assert abs(histogram.mean - values.mean()) < 1e-9 * abs(values.mean())
+    assert abs(histogram.std - values.std(ddof=1)) < 1e-9 * values.std()
+    for q in (0, 0.5, 25, 50, 99.5, 100):
+        assert abs(histogram.percentile(q) - np.percentile(values, q)) < 1e-9, q
+assert np.array_equal(merged.counts, reverse.counts) and merged.first == reverse.first
+
+# wider bins: every value is taken at the lower edge of its bin
+coarse = IntensityHistogram(bin_width=16).update(values)
+assert all(abs(coarse.percentile(q) - np.percentile(values, q)) <= 16 for q in (1, 50, 99))
+print('IntensityHistogram: merged percentiles, mean and std match numpy on {} voxels'.format(len(values)))
+
+with tempfile.TemporaryDirectory() as path:
+    ls = [[], []]
+    foreground = []
+    for subject in range(3):
+        image = rng.randint(-1000, 2000, size=(10, 9, 8)).astype(np.float32)
+        label = (rng.rand(10, 9, 8) > 0.5).astype(np.float32)
+        foreground.append(image[label > 0])
+        for j, volume in enumerate((image, label)):
+            filename = os.path.join(path, 'subject_{}_{}.nii'.format(subject, j))
+            nib.save(nib.Nifti1Image(volume, np.eye(4)), filename)
+            ls[j].append(filename)
+
+    fingerprint = DatasetFingerprint.build(path, ls, workers=1)
+    fingerprint.save(os.path.join(path, 'fingerprint.json'))
+    voxels = np.concatenate(foreground).astype(np.float64)
+    stats = fingerprint.stats(0)
+    assert abs(stats['low'] - np.percentile(voxels, 0.5)) < 1e-9
+    assert abs(stats['high'] - np.percentile(voxels, 99.5)) < 1e-9
+    assert abs(stats['mean'] - voxels.mean()) < 1e-6 and abs(stats['std'] - voxels.std(ddof=1)) < 1e-6
+
+    DatasetFingerprint.load(os.path.join(path, 'fingerprint.json'))
+    for filename in ls[0]:
+        assert img_loader.dataset_stats[os.path.abspath(filename)] == stats
+    print('DatasetFingerprint: foreground statistics of {} subjects saved and loaded'.format(len(ls[0])))
@@ -0,0 +1,52 @@
+import os
+import tempfile
+
+import nibabel as nib
+import numpy as np
+
+from lib.medloaders import medical_image_process as img_loader
+from lib.medloaders.volume_cache import VolumeCache
+
+"""
+foreground_bbox of the voxels non-zero in any modality, grown to a minimum size inside the volume,
+and load_foreground_volumes against the same region of load_medical_image, with and without a VolumeCache
+"""
+
+shape = (30, 28, 26)
+first, second = np.zeros(shape, np.float32), np.zeros(shape, np.float32)
+first[5:12, 6:20, 3:9] = 1
+second[10:15, 8:10, 2:4] = 1
+assert img_loader.foreground_bbox([first, second]) == (5, 6, 2, 15, 20, 9)
+assert img_loader.foreground_bbox([first, second], margin=3) == (2, 3, 0, 18, 23, 12)
+# grown around the centre, then shifted back inside the volume
+assert img_loader.foreground_bbox([first, second], min_size=(16, 16, 16)) == (2, 5, 0, 18, 21, 16)
+assert img_loader.foreground_bbox([first], min_size=(40, 8, 8)) == (0, 6, 2, 30, 20, 10)
+assert img_loader.foreground_bbox([np.zeros(shape)]) == (0, 0, 0) + shape
+labels = np.arange(10 * 14 * 7).reshape(10, 14, 7)
+full = img_loader.pad_to_full_volume(labels, (5, 6, 2, 15, 20, 9), shape)
+assert full.shape == shape and full.sum() == labels.sum() and np.array_equal(full[5:15, 6:20, 2:9], labels)
+print('foreground_bbox and pad_to_full_volume')
+
+rng = np.random.RandomState(0)
+with tempfile.TemporaryDirectory() as path:
+    paths = []
+    for j, region in enumerate(((slice(4, 20), slice(5, 23), slice(3, 22)), (slice(8, 26), slice(6, 12), 7))):
+        # foregrounds large enough for the percentile clipping of the statistics
+        volume = np.zeros(shape, np.float32)
+        volume[region] = rng.gamma(2., 100., size=volume[region].shape)
+        paths.append(os.path.join(path, 'modality_{}.nii.gz'.format(j)))
+        nib.save(nib.Nifti1Image(volume, np.eye(4)), paths[-1])
+
+    for cache in (None, VolumeCache()):
+        img_loader.set_volume_cache(cache)
+        for normalization in ('full_volume_mean', 'max_min', 'brats'):
+            cropped, bbox = img_loader.load_foreground_volumes(paths, normalization=normalization,
+                                                               min_size=(16, 16, 16))
+            assert bbox == (4, 5, 3, 26, 23, 22)
+            for path_j, crop in zip(paths, cropped):
+                full = img_loader.load_medical_image(path_j, type='T1', normalization=normalization)
+                expected = full[img_loader.bbox_slices(bbox)].numpy()
+                assert crop.shape == (22, 18, 19)
+                assert np.allclose(crop.numpy(), expected, rtol=1e-5, atol=1e-5), (normalization, cache)
+    img_loader.set_volume_cache(None)
+    print('load_foreground_volumes matches the full volumes, with and without a VolumeCache')
@@ -0,0 +1,48 @@
+import os
+import tempfile
+
+import nibabel as nib
+import numpy as np
+
+from lib.medloaders import medical_image_process as img_loader
+from lib.medloaders.grid_patch_dataset import GridPatchDataset
+
+"""
+GridPatchDataset tiles put back together with assemble, in memory and memory-mapped:
+the tiles of every subject cover its volume exactly once, and per-tile outputs with
+leading dimensions (e.g. class scores) are reassembled the same way
+"""
+
+rng = np.random.RandomState(0)
+shapes = [(21, 16, 11), (8, 8, 8)]
+crop_size = (8, 8, 8)
+
+with tempfile.TemporaryDirectory() as path:
+    ls = [[], [], []]
+    for subject, shape in enumerate(shapes):
+        images = [rng.randint(1, 300, size=shape).astype(np.float32) for _ in range(2)]
+        label = rng.randint(0, 4, size=shape).astype(np.float32)
+        for j, volume in enumerate(images + [label]):
+            filename = os.path.join(path, 'subject_{}_{}.nii'.format(subject, j))
+            nib.save(nib.Nifti1Image(volume, np.eye(4)), filename)
+            ls[j].append(filename)
+
+    for memmap_dir in (None, path):
+        grid = GridPatchDataset(*ls, dataset_name='brats2018', crop_size=crop_size, normalization='max_min',
+                                memmap_dir=memmap_dir)
+        assert len(grid) == sum(int(np.prod([-(-s // c) for s, c in zip(shape, crop_size)])) for shape in shapes)
+        for subject, shape in enumerate(shapes):
+            tiles = [grid[i] for i in grid.subject_tiles(subject)]
+            assert all(t.shape == crop_size for tile in tiles for t in tile)
+
+            label = nib.load(ls[-1][subject]).get_fdata(dtype=np.float32)
+            assert np.array_equal(grid.assemble(subject, [tile[-1] for tile in tiles]), label)
+            image = img_loader.load_medical_image(ls[0][subject], type="T1", normalization='max_min').numpy()
+            assert np.array_equal(grid.assemble(subject, [tile[0] for tile in tiles]), image)
+
+            # classes x crop_size outputs, e.g. one-hot predictions
+            scores = [np.stack([tile[-1] == c for c in range(4)]) for tile in tiles]
+            assembled = grid.assemble(subject, scores)
+            assert assembled.shape == (4,) + shape and np.array_equal(assembled.argmax(axis=0), label)
+        del grid
+    print('GridPatchDataset: tiles of {} subjects reassembled, in memory and memory-mapped'.format(len(shapes)))
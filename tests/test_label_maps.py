@@ -0,0 +1,52 @@
+import numpy as np
+import torch
+
+from lib.medloaders.medical_loader_utils import fix_seg_map, label_maps
+
+"""
+Lookup-table fix_seg_map against the former chain of per-value assignments, for every dataset,
+on numpy arrays and torch tensors of raw label values
+"""
+
+
+def reference_fix_seg_map(segmentation_map, dataset="iseg2017"):
+    if dataset == "iseg2017" or dataset == "iseg2019":
+        label_values = [0, 10, 150, 250]
+        for c, j in enumerate(label_values):
+            segmentation_map[segmentation_map == j] = c
+
+    elif dataset == "brats2018" or dataset == "brats2019" or dataset == "brats2020":
+        segmentation_map[segmentation_map == 1] = 1
+        segmentation_map[segmentation_map == 2] = 2
+        segmentation_map[segmentation_map == 3] = 3
+        segmentation_map[segmentation_map == 4] = 3
+        segmentation_map[segmentation_map >= 4] = 3
+    elif dataset == "mrbrains4":
+        segmentation_map[segmentation_map == 1] = 1
+        segmentation_map[segmentation_map == 2] = 1
+        segmentation_map[segmentation_map == 3] = 2
+        segmentation_map[segmentation_map == 4] = 2
+        segmentation_map[segmentation_map == 5] = 3
+        segmentation_map[segmentation_map == 6] = 3
+    return segmentation_map
+
+
+rng = np.random.RandomState(0)
+raw_values = {'iseg2017': [0, 10, 150, 250], 'iseg2019': [0, 10, 150, 250], 'brats2018': [0, 1, 2, 4],
+              'brats2019': [0, 1, 2, 4], 'brats2020': [0, 1, 2, 3, 4, 5], 'mrbrains4': list(range(9)),
+              'mrbrains9': list(range(9)), 'covid19seg': [0, 1, 2, 3]}
+assert set(raw_values) == set(label_maps)
+
+for dataset, values in raw_values.items():
+    raw = rng.choice(values, size=(12, 10, 8)).astype(np.float32)
+    expected = reference_fix_seg_map(raw.copy(), dataset)
+
+    mapped = fix_seg_map(raw, dataset)
+    assert mapped.dtype == np.uint8 and np.array_equal(mapped, expected), dataset
+    assert np.array_equal(fix_seg_map(raw.astype(np.uint8), dataset), expected), dataset
+
+    mapped = fix_seg_map(torch.from_numpy(raw), dataset)
+    assert isinstance(mapped, torch.Tensor) and np.array_equal(mapped.numpy(), expected), dataset
+    # the input is left untouched
+    assert np.array_equal(np.unique(raw), np.unique(values)), dataset
+print('fix_seg_map: {} label maps match the per-value assignments'.format(len(raw_values)))
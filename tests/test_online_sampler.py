@@ -0,0 +1,50 @@
+import os
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+from torch.utils.data import DataLoader
+
+from lib.medloaders.online_sampler import OnlinePatchSampler
+
+"""
+Cache hit rate of the OnlinePatchSampler, over a shuffled epoch of 40 subjects with the
+default cache of 8 subjects, when every drawn subject serves 1 or crops_per_subject crops
+"""
+
+rng = np.random.RandomState(0)
+subjects, shape, crop_size = 40, (40, 40, 40), (16, 16, 16)
+
+with tempfile.TemporaryDirectory() as path:
+    ls = [[], [], []]
+    for subject in range(subjects):
+        images = [rng.randint(1, 300, size=shape).astype(np.float32) for _ in range(2)]
+        label = np.zeros(shape, np.float32)
+        label[10:30, 10:30, 10:30] = rng.randint(0, 4, size=(20, 20, 20))
+        for j, volume in enumerate(images + [label]):
+            filename = os.path.join(path, 'subject_{}_{}.nii.gz'.format(subject, j))
+            nib.save(nib.Nifti1Image(volume, np.eye(4)), filename)
+            ls[j].append(filename)
+
+    hit_rates = {}
+    for crops_per_subject in (1, 4):
+        sampler = OnlinePatchSampler(*ls, dataset_name='brats2018', samples=320, full_vol_dim=shape,
+                                     crop_size=crop_size, crops_per_subject=crops_per_subject)
+        start = time.perf_counter()
+        for batch in DataLoader(sampler, batch_size=4, shuffle=True):
+            assert all(tuple(t.shape[1:]) == crop_size for t in batch)
+        elapsed = time.perf_counter() - start
+        hit_rates[crops_per_subject] = sampler.cache.hits / (sampler.cache.hits + sampler.cache.misses)
+        print('crops_per_subject {}: cache hit rate {:.0%}, epoch {:.2f} s'.format(
+            crops_per_subject, hit_rates[crops_per_subject], elapsed))
+    assert hit_rates[1] < 0.4
+    assert hit_rates[4] >= 0.75
+
+    # seeded (validation) samplers: the same crops at every pass, groups of items share a subject
+    sampler = OnlinePatchSampler(*ls, dataset_name='brats2018', samples=64, full_vol_dim=shape,
+                                 crop_size=crop_size, seed=3)
+    first = [sampler[i] for i in range(len(sampler))]
+    assert sampler.cache.misses <= len(sampler) // sampler.crops_per_subject
+    assert all(np.array_equal(a, b) for i, item in enumerate(first) for a, b in zip(item, sampler[i]))
+    print('seeded: {} subject loads for {} items'.format(sampler.cache.misses, len(sampler)))
@@ -0,0 +1,36 @@
+import tempfile
+
+import numpy as np
+
+from lib.medloaders.patch_codec import decode_image, encode_image, load_image, save_image
+
+"""
+Round trips of the patch codecs: float32 exact, float16 and int16 within their quantization error
+"""
+
+rng = np.random.RandomState(0)
+crop = (rng.randn(8, 9, 10) * 300 + 40).astype(np.float32)
+
+assert np.array_equal(decode_image(encode_image(crop, 'float32')), crop)
+assert np.allclose(decode_image(encode_image(crop, 'float16')), crop, rtol=1e-3, atol=1e-3)
+
+data, scale, offset = encode_image(crop, 'int16')
+assert data.dtype == np.int16 and data.min() == -32768 and data.max() == 32767
+decoded = decode_image((data, scale, offset))
+assert decoded.dtype == np.float32
+error = np.abs(decoded - crop).max()
+# half a quantization step, and float32 rounding of the decoded values
+assert error <= scale / 2 + 1e-6 * np.abs(crop).max(), error
+out = np.empty_like(crop)
+assert decode_image((data, scale, offset), out=out) is out and np.array_equal(out, decoded)
+# constant crops survive too
+constant = np.full((4, 4, 4), 7.5, np.float32)
+assert np.array_equal(decode_image(encode_image(constant, 'int16')), constant)
+print('int16 codec: max error {:.4f} for a scale of {:.4f}'.format(error, scale))
+
+with tempfile.TemporaryDirectory() as path:
+    filename = save_image(path + '/crop.npy', crop, 'int16')
+    assert filename.endswith('.npz') and np.array_equal(decode_image(load_image(filename)), decoded)
+    filename = save_image(path + '/crop.npy', crop, 'float16')
+    assert filename.endswith('.npy') and load_image(filename).dtype == np.float16
+print('saved crops load back')
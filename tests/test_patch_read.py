@@ -0,0 +1,43 @@
+import os
+import tempfile
+
+import nibabel as nib
+import numpy as np
+
+from lib.medloaders import medical_image_process as img_loader
+
+"""
+load_medical_image_patch against a full read followed by crop_img, for every normalization:
+inner crops, crops spanning a whole axis (see crop_slices) and a 4D volume with one frame
+"""
+
+rng = np.random.RandomState(0)
+shape = (30, 28, 26)
+normalizations = ['full_volume_mean', 'max_min', 'mean', 'max', 'brats', 'dataset', None]
+crops = [((16, 16, 16), (3, 7, 10)), ((16, 28, 8), (14, 0, 18)), ((30, 28, 26), (0, 0, 0))]
+
+with tempfile.TemporaryDirectory() as path:
+    volume = np.zeros(shape, np.float32)
+    volume[4:-4, 3:-3, 2:-2] = rng.gamma(2., 100., size=(22, 22, 22))
+    # outliers, clipped by clip_intenisty
+    volume[10, 10, 10], volume[12, 5, 20] = 1e5, -1e3
+    files = []
+    for name, data in (('volume.nii', volume), ('volume_4d.nii', volume[..., None])):
+        filename = os.path.join(path, name)
+        nib.save(nib.Nifti1Image(data, np.eye(4)), filename)
+        files.append(filename)
+        img_loader.dataset_stats[os.path.abspath(filename)] = {'low': 20., 'high': 600., 'mean': 210., 'std': 95.}
+
+    for filename in files:
+        for normalization in normalizations:
+            full = img_loader.preprocess_medical_image(filename, type='T1', normalization=normalization)
+            for crop_size, crop in crops:
+                expected = img_loader.crop_img(full, crop_size, crop).numpy()
+                patch = img_loader.load_medical_image_patch(filename, type='T1', normalization=normalization,
+                                                            crop_size=crop_size, crop=crop).numpy()
+                assert patch.shape == expected.shape == crop_size, (patch.shape, expected.shape)
+                tolerance = 1e-5 * max(1., np.abs(expected).max())
+                assert np.abs(patch - expected).max() <= tolerance, (filename, normalization, crop_size)
+        label = img_loader.load_medical_image_patch(filename, type='label', crop_size=(16, 28, 8), crop=(14, 0, 18))
+        assert np.array_equal(label.numpy(), volume[14:30, :, 18:26])
+    print('patch reads match the cropped full volumes for', normalizations)
@@ -0,0 +1,38 @@
+import tempfile
+
+import numpy as np
+
+from lib.medloaders.patch_codec import decode_image
+from lib.medloaders.patch_store import PatchStore
+
+"""
+Read-back of the crops, subject ids and crop origins written to a PatchStore,
+for float32 and int16 stores
+"""
+
+rng = np.random.RandomState(0)
+
+with tempfile.TemporaryDirectory() as path:
+    for codec in ('float32', 'int16'):
+        samples, modalities, crop_size = 5, 2, (8, 9, 10)
+        store = PatchStore.create(path, samples, modalities, crop_size, codec=codec, label_dtype=np.uint8)
+        written = []
+        for i in range(samples):
+            images = [(rng.randn(*crop_size) * 100).astype(np.float32) for _ in range(modalities)]
+            label = rng.randint(0, 4, size=crop_size).astype(np.uint8)
+            store.write(i, images, label, subject_id=i % 2, crop=(i, 2 * i, 3 * i))
+            written.append((images, label))
+        store.flush()
+
+        store = PatchStore(path)
+        assert len(store) == samples
+        assert np.array_equal(store.subjects, np.arange(samples) % 2)
+        assert np.array_equal(store.crops[3], (3, 6, 9))
+        for i, (images, label) in enumerate(written):
+            *read, read_label = store[i]
+            assert np.array_equal(read_label, label)
+            for img, expected in zip(read, images):
+                tolerance = 0 if codec == 'float32' else (expected.max() - expected.min()) / 65535
+                assert np.abs(decode_image(img) - expected).max() <= tolerance
+        del store
+    print('PatchStore: float32 and int16 crops read back')
@@ -0,0 +1,55 @@
+import time
+
+import numpy as np
+import torch
+
+from lib.medloaders.medical_image_process import clip_intensity_stats, normalize_intensity, normalize_volume
+
+"""
+Fused intensity preprocessing (clip_intensity_stats + normalize_volume) against the
+np.percentile / torch pipeline it replaced, on BraTS sized 240 x 240 x 155 volumes
+"""
+
+
+def brats_like_volume(seed):
+    rng = np.random.default_rng(seed)
+    img = np.zeros((240, 240, 155), dtype=np.float32)
+    # a skull-stripped head: an ellipsoid of tissue on a zero background
+    d, h, w = np.ogrid[:240, :240, :155]
+    head = ((d - 120) / 80.) ** 2 + ((h - 120) / 95.) ** 2 + ((w - 77) / 65.) ** 2 < 1
+    img[head] = rng.gamma(4., 200., size=int(head.sum())).astype(np.float32)
+    return img
+
+
+def reference(img_np, normalization):
+    low, high = np.percentile(img_np, 0.1), np.percentile(img_np, 99.8)
+    img_np[img_np < low] = low
+    img_np[img_np > high] = high
+    img_tensor = torch.from_numpy(img_np)
+    norm_values = (img_tensor.mean(), img_tensor.std(), img_tensor.max(), img_tensor.min())
+    return normalize_intensity(img_tensor, normalization=normalization, norm_values=norm_values).numpy()
+
+
+def fused(img_np, normalization):
+    stats = clip_intensity_stats(img_np)
+    return normalize_volume(img_np, normalization, stats)
+
+
+def benchmark(function, volumes, normalization, repeats=3):
+    best = float('inf')
+    for _ in range(repeats):
+        copies = [v.copy() for v in volumes]
+        start = time.perf_counter()
+        outputs = [function(v, normalization) for v in copies]
+        best = min(best, time.perf_counter() - start)
+    return best / len(volumes), outputs
+
+
+volumes = [brats_like_volume(seed) for seed in range(4)]
+for normalization in ('brats', 'full_volume_mean', 'max_min', 'mean'):
+    reference_time, expected = benchmark(reference, volumes, normalization)
+    fused_time, outputs = benchmark(fused, volumes, normalization)
+    error = max(np.abs(e - o).max() / np.abs(e).max() for e, o in zip(expected, outputs))
+    assert error < 1e-5, error
+    print('{:16s} reference {:6.1f} ms  fused {:6.1f} ms  speedup {:4.1f}x  max rel. error {:.1e}'.format(
+        normalization, 1000 * reference_time, 1000 * fused_time, reference_time / fused_time, error))
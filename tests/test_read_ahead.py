@@ -0,0 +1,91 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, SequentialSampler
+
+from lib.medloaders import data_loader
+from lib.medloaders.read_ahead import ReadAheadSampler, read_ahead_sampler
+from lib.medloaders.sampling import SamplingOptions
+
+"""
+Read-ahead of generated .npy samples: the files are evicted from the page cache
+(posix_fadvise DONTNEED) before every epoch, then read by a DataLoader with and without
+a ReadAheadSampler, with a training step simulated in the main process.
+Read-ahead is off by default, it only shortens the wait for data when cold reads are slow
+compared to the training step, which is asserted when the storage here is that slow.
+"""
+
+
+class NpySamples(Dataset):
+    def __init__(self, folder, samples=64, shape=(4, 64, 64, 64)):
+        self.list = []
+        for i in range(samples):
+            path = os.path.join(folder, 'sample_{}.npy'.format(i))
+            np.save(path, np.random.rand(*shape).astype(np.float32))
+            self.list.append((path,))
+
+    def __len__(self):
+        return len(self.list)
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        sample = np.load(self.list[index][0])
+        # the time the worker spent reading the sample
+        return torch.from_numpy(sample), time.perf_counter() - start
+
+
+def evict(dataset):
+    for (path,) in dataset.list:
+        fd = os.open(path, os.O_RDONLY)
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.close(fd)
+
+
+def epoch(loader, step=0.02):
+    reads, wait = 0., 0.
+    loaded = time.perf_counter()
+    for samples, read_times in loader:
+        order.extend(samples[:, 0, 0, 0, 0].tolist())
+        wait += time.perf_counter() - loaded
+        reads += float(read_times.sum())
+        # training step
+        time.sleep(step)
+        loaded = time.perf_counter()
+    return reads, wait
+
+
+assert SamplingOptions.from_args(argparse.Namespace()).read_ahead == 0
+
+# not in /tmp, which may be a tmpfs
+with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(__file__))) as folder:
+    dataset = NpySamples(folder)
+    assert not isinstance(data_loader(dataset, {'batch_size': 2, 'shuffle': False}).sampler, ReadAheadSampler)
+    order = []
+    warm = epoch(DataLoader(dataset, batch_size=2, num_workers=1))[0]
+    print('{:30s} np.load in the worker {:5.2f} s'.format('page cache (warm)', warm))
+    sampler = read_ahead_sampler(dataset, shuffle=False, depth=8)
+    results = []
+    assert list(ReadAheadSampler(SequentialSampler(dataset), sampler.files)) == list(SequentialSampler(dataset))
+    for name, loader in [('DataLoader', DataLoader(dataset, batch_size=2, num_workers=1)),
+                         ('DataLoader + ReadAheadSampler', DataLoader(dataset, batch_size=2, num_workers=1,
+                                                                     sampler=sampler))]:
+        evict(dataset)
+        reads, wait = epoch(loader)
+        print('{:30s} np.load in the worker {:5.2f} s, waiting for data {:5.2f} s'.format(name, reads, wait))
+        results.append((reads, wait))
+    print(sampler.read_ahead, 'hit rate {:.0%}'.format(sampler.read_ahead.hit_rate))
+    # the same samples in the same order, with and without read-ahead
+    assert order[:len(dataset)] == order[len(dataset):2 * len(dataset)] == order[2 * len(dataset):]
+    (cold, plain_wait), (_, read_ahead_wait) = results
+    if cold > 4 * warm and cold > 1.:
+        assert read_ahead_wait < plain_wait, 'read-ahead does not shorten the wait for data on slow storage'
+    else:
+        print('cold reads take {:.2f} s for {:.2f} s warm here, too fast for read-ahead to help'.format(cold, warm))
+    assert sampler.read_ahead.hits + sampler.read_ahead.misses == len(dataset)
+    assert sampler.read_ahead.warmed_bytes == sum(os.path.getsize(p) for (p,) in dataset.list)
+    sampler.read_ahead.close()
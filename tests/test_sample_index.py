@@ -0,0 +1,28 @@
+import pickle
+
+import numpy as np
+
+from lib.medloaders.sample_index import SampleIndex
+
+"""
+File names of a SampleIndex, derived from the sample and subject ids, against the
+per-file sample lists (sub_vol_path + 'id_<subject>_s_<sample>_modality_<j or seg>')
+"""
+
+subject_paths = [['/data/s0_t1.nii.gz', '/data/s0_t2.nii.gz', '/data/s0_seg.nii.gz'],
+                 ['/data/ß1_t1.nii.gz', '/data/ß1_t2.nii.gz', '/data/ß1_seg.nii.gz']]
+subjects = [1, 0, 1, 1]
+crops = np.arange(12).reshape(4, 3)
+
+for codec, ext in (('float32', '.npy'), ('float16', '.npy'), ('int16', '.npz')):
+    index = SampleIndex('/generated/train_vol_32x32x32/', subject_paths, subjects, crops, codec=codec)
+    assert len(index) == 4 and index.modalities == 2
+    for i, subject in enumerate(subjects):
+        prefix = '/generated/train_vol_32x32x32/id_{}_s_{}_modality_'.format(subject, i)
+        assert index[i] == (prefix + '0' + ext, prefix + '1' + ext, prefix + 'seg.npy')
+        assert index.subject_files(i) == tuple(subject_paths[subject])
+    assert index.subjects.dtype == index.crops.dtype == np.int32
+    assert np.array_equal(index.crops, crops)
+    restored = pickle.loads(pickle.dumps(index))
+    assert [restored[i] for i in range(4)] == [index[i] for i in range(4)]
+print('SampleIndex file names match the per-file sample lists')
@@ -0,0 +1,46 @@
+import numpy as np
+import torch
+
+from lib.visual3D_temp.sliding_window import plan_streaming, sliding_window_inference, \
+    streaming_sliding_window_inference
+
+"""
+Sliding-window inference of a pointwise model (1x1x1 convolution) must give the output of
+the full volume at once, whatever the blending, overlap and accumulator of the streaming variant.
+Volumes smaller than the patch are zero padded (pad_to_patch) and cropped back.
+"""
+
+
+class Pointwise(torch.nn.Module):
+    def __init__(self, modalities, classes):
+        super().__init__()
+        self.conv = torch.nn.Conv3d(modalities, classes, kernel_size=1)
+        self.device = torch.device('cpu')
+
+    def inference(self, x):
+        with torch.no_grad():
+            return self.conv(x)
+
+
+torch.manual_seed(0)
+modalities, classes, patch_size = 2, 4, (16, 16, 16)
+model = Pointwise(modalities, classes)
+
+for shape in [(40, 36, 30), (10, 20, 12)]:
+    volume = torch.randn((modalities,) + shape)
+    expected = model.inference(volume[None])[0]
+    for overlap, blend in [(0.5, 'gaussian'), (0.25, 'uniform'), (0., 'gaussian')]:
+        output = sliding_window_inference(volume, model, patch_size, overlap=overlap, blend=blend, verbose=False)
+        assert output.shape == expected.shape
+        error = (output - expected).abs().max().item()
+        assert error <= 5e-6, (shape, overlap, blend, error)
+
+    labels = expected.argmax(dim=0).numpy()
+    padded = tuple(max(s, p) for s, p in zip(shape, patch_size))
+    for memory_budget_mb, kind in [(64, 'float32'), (0.02, 'memmap')]:
+        assert plan_streaming(padded, patch_size, modalities, classes, memory_budget_mb)[0] == kind
+        streamed = streaming_sliding_window_inference(volume, model, patch_size, classes,
+                                                      memory_budget_mb=memory_budget_mb, slab=7, verbose=False)
+        assert streamed.shape == shape and streamed.dtype == np.uint8
+        assert np.array_equal(streamed, labels), (shape, kind)
+    print(shape, 'sliding window and streaming (float32, memmap) match the full volume')
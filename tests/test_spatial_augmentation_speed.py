@@ -0,0 +1,50 @@
+import time
+
+import numpy as np
+
+from lib.augment3D import ComposeTransforms, RandomAffine, RandomChoice, RandomFlip, RandomRotation, RandomShift, \
+    RandomZoom, create_spatial_transform
+
+"""
+Cost of the spatial transforms on a 4 x 128^3 sample: every scipy.ndimage transform alone,
+chained in ComposeTransforms (one resampling per transform), and RandomAffine (rotation,
+zoom, shift and flips composed in one matrix, a single resampling), as selected in the
+loaders with --spatial affine
+"""
+
+
+def sample(seed, channels=4, shape=(128, 128, 128)):
+    rng = np.random.default_rng(seed)
+    images = [rng.normal(size=shape).astype(np.float32) for _ in range(channels)]
+    label = rng.integers(0, 4, size=shape).astype(np.uint8)
+    return images, label
+
+
+def benchmark(transform, repeats):
+    best = float('inf')
+    for seed in range(repeats):
+        images, label = sample(seed)
+        start = time.perf_counter()
+        transform(images, label)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+transforms = [('RandomRotation', RandomRotation()), ('RandomZoom', RandomZoom()), ('RandomShift', RandomShift()),
+              ('RandomFlip', RandomFlip())]
+chained_time = 0
+for name, t in transforms:
+    t_time = benchmark(ComposeTransforms([t], p=1), repeats=1)
+    chained_time += t_time
+    print('{:32s} {:8.1f} ms'.format(name, 1000 * t_time))
+print('{:32s} {:8.1f} ms'.format('chained in ComposeTransforms', 1000 * chained_time))
+affine_time = benchmark(ComposeTransforms([RandomAffine()], p=1), repeats=3)
+print('{:32s} {:8.1f} ms  speedup {:5.1f}x'.format('RandomAffine', 1000 * affine_time, chained_time / affine_time))
+
+# the loaders add it to their RandomChoice, called once with all the modalities
+assert create_spatial_transform('none') is None
+images, label = sample(0)
+images[1] = images[0].copy()
+images, label = RandomChoice(transforms=[create_spatial_transform('affine')], p=1)(images, label)
+assert len(images) == 4 and all(img.shape == (128, 128, 128) for img in images)
+assert np.array_equal(images[0], images[1]) and label.dtype == np.uint8
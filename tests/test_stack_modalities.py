@@ -0,0 +1,31 @@
+import numpy as np
+import torch
+
+from lib.medloaders.medical_loader_utils import stack_modalities
+from lib.medloaders.patch_codec import decode_image, encode_image
+
+"""
+stack_modalities of float32, float16 and int16-encoded crops: one C x D x H x W float32 tensor
+holding the decoded modalities, and the label tensor with the dtype of the saved map
+"""
+
+rng = np.random.RandomState(0)
+crop_size = (8, 9, 10)
+crop = (rng.randn(*crop_size) * 100).astype(np.float32)
+label = rng.randint(0, 4, size=crop_size).astype(np.uint8)
+
+for codec in ('float32', 'float16', 'int16'):
+    for modalities in (1, 3):
+        images = [encode_image(crop + c, codec) for c in range(modalities)]
+        image, segmentation_map = stack_modalities(images, label)
+        assert image.shape == (modalities,) + crop_size and image.dtype == torch.float32
+        assert image.is_contiguous()
+        for c in range(modalities):
+            assert np.array_equal(image[c].numpy(), decode_image(images[c]))
+        assert segmentation_map.dtype == torch.uint8 and np.array_equal(segmentation_map.numpy(), label)
+    print(codec, 'crops stack into one float32 tensor')
+
+# the label is copied, the memory-mapped or cached map it comes from is never modified
+image, segmentation_map = stack_modalities([crop], label)
+segmentation_map += 1
+assert label.max() == 3
@@ -0,0 +1,47 @@
+import os
+import tempfile
+
+import nibabel as nib
+import numpy as np
+
+from lib.medloaders.medical_loader_utils import generate_sub_volumes, load_sub_volume
+from lib.medloaders.sampling import SamplingOptions
+
+"""
+Sub-volumes generated with one worker and with several: the same subjects, crop origins
+and crops, for the per-file samples and for the packed PatchStore
+"""
+
+rng = np.random.RandomState(0)
+subjects, shape, crop_size, samples = 3, (32, 28, 24), (16, 16, 16), 20
+
+with tempfile.TemporaryDirectory() as path:
+    ls = [[], [], []]
+    for subject in range(subjects):
+        images = [rng.randint(1, 300, size=shape).astype(np.float32) for _ in range(2)]
+        label = np.zeros(shape, np.float32)
+        label[8:24, 6:22, 4:20] = rng.randint(0, 4, size=(16, 16, 16))
+        for j, volume in enumerate(images + [label]):
+            filename = os.path.join(path, 'subject_{}_{}.nii'.format(subject, j))
+            nib.save(nib.Nifti1Image(volume, np.eye(4)), filename)
+            ls[j].append(filename)
+
+    for packed in (False, True):
+        generated = []
+        for workers in (1, 3):
+            sub_vol_path = os.path.join(path, 'packed_{}_workers_{}'.format(packed, workers)) + '/'
+            os.makedirs(sub_vol_path)
+            np.random.seed(0)
+            generated.append(generate_sub_volumes(*ls, dataset_name='brats2018', mode='train', samples=samples,
+                                                  crop_size=crop_size, sub_vol_path=sub_vol_path, packed=packed,
+                                                  sampling=SamplingOptions(packed=packed, workers=workers)))
+        one, several = generated
+        assert len(one) == len(several) == samples
+        assert np.array_equal(one.subjects, several.subjects)
+        assert np.array_equal(one.crops, several.crops)
+        assert len(set(one.subjects)) > 1
+        for i in range(samples):
+            for a, b in zip(load_sub_volume(one[i]), load_sub_volume(several[i])):
+                assert a.shape == crop_size and np.array_equal(a, b)
+        print('packed' if packed else 'files', ': 1 and 3 workers generate the same', samples, 'sub-volumes')
+        del one, several, generated
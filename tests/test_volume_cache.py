@@ -0,0 +1,75 @@
+import os
+import tempfile
+
+import nibabel as nib
+import numpy as np
+
+from lib.medloaders import medical_image_process as img_loader
+from lib.medloaders.volume_cache import LRUCache, VolumeCache
+
+"""
+LRUCache eviction order and size bound, VolumeCache keys that change with the file
+(modification time, size) and the preprocessing, on-disk reuse and eviction, and
+load_medical_image through the cache after the file is edited
+"""
+
+
+def load(filename):
+    return img_loader.load_medical_image(filename, type='T1', normalization=None, clip_intenisty=False)
+
+
+cache = LRUCache(max_items=2)
+loads = []
+for key in ['a', 'b', 'a', 'c', 'b']:
+    cache.get(key, lambda: loads.append(key) or key)
+# 'b' was the least recently used when 'c' came in
+assert loads == ['a', 'b', 'c', 'b'] and list(cache.entries) == ['c', 'b']
+assert (cache.hits, cache.misses) == (1, 4)
+cache = LRUCache(max_items=10, max_bytes=3000)
+for key in range(4):
+    cache.put(key, np.zeros(1000, np.uint8))
+assert list(cache.entries) == [1, 2, 3] and cache.bytes == 3000
+print('LRUCache evicts the least recently used entries')
+
+with tempfile.TemporaryDirectory() as path:
+    filename = os.path.join(path, 'volume.nii')
+    volume = np.arange(8 * 9 * 10, dtype=np.float32).reshape(8, 9, 10)
+    nib.save(nib.Nifti1Image(volume, np.eye(4)), filename)
+
+    key = VolumeCache.key(filename, normalization='max_min')
+    assert key == VolumeCache.key(filename, normalization='max_min')
+    assert key != VolumeCache.key(filename, normalization='full_volume_mean')
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert VolumeCache.key(filename, normalization='max_min') != key
+    key = VolumeCache.key(filename, normalization='max_min')
+    nib.save(nib.Nifti1Image(volume[:-1], np.eye(4)), filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert os.stat(filename).st_size != stat.st_size
+    assert VolumeCache.key(filename, normalization='max_min') != key
+    print('VolumeCache keys change with the modification time, the size and the preprocessing')
+
+    cache_dir = os.path.join(path, 'cache')
+    cache = VolumeCache(cache_dir=cache_dir)
+    loads = []
+    for key in ['a' * 40, 'b' * 40]:
+        cache.get(key, lambda: loads.append(key) or np.full(1000, len(loads), np.float32))
+    # written a minute ago, the modification times may be too coarse to order the files otherwise
+    for key in ['a' * 40, 'b' * 40]:
+        os.utime(cache.filename(key), (os.stat(cache_dir).st_mtime - 60,) * 2)
+    # a new process finds the volumes on disk
+    cache = VolumeCache(cache_dir=cache_dir, max_disk_mb=9000 / 2 ** 20)
+    assert cache.get('a' * 40, lambda: None)[0] == 1 and cache.disk_hits == 1
+    cache.get('c' * 40, lambda: np.zeros(1000, np.float32))
+    # 'b' is the oldest file, the three (4128 bytes each) do not fit in 9000 bytes
+    assert sorted(os.listdir(cache_dir)) == ['a' * 40 + '.npy', 'c' * 40 + '.npy']
+    print('VolumeCache reuses and evicts the volumes on disk')
+
+    img_loader.set_volume_cache(VolumeCache())
+    first = load(filename)
+    first += 1
+    assert np.array_equal(load(filename), volume[:-1])
+    nib.save(nib.Nifti1Image(volume * 2, np.eye(4)), filename)
+    assert np.array_equal(load(filename), volume * 2)
+    img_loader.set_volume_cache(None)
+    print('load_medical_image never returns a stale or modified cached volume')
@@ -0,0 +1,59 @@
+import os
+import pickle
+import tempfile
+
+import nibabel as nib
+import numpy as np
+from torch.utils.data import DataLoader
+
+from lib.medloaders import medical_image_process as img_loader
+from lib.medloaders.online_sampler import OnlinePatchSampler
+from lib.medloaders.volume_pool import SharedVolumePool
+
+"""
+SharedVolumePool: the pooled subjects equal their decoded volumes, the crop samplers are built
+once, plain pickling is refused, and DataLoader workers cut the same crops from the pool as
+the main process
+"""
+
+rng = np.random.RandomState(0)
+shapes, crop_size = [(24, 20, 18), (20, 22, 16), (18, 18, 18)], (12, 12, 12)
+
+with tempfile.TemporaryDirectory() as path:
+    ls = [[], [], []]
+    for subject, shape in enumerate(shapes):
+        images = [rng.randint(1, 300, size=shape).astype(np.float32) for _ in range(2)]
+        label = np.zeros(shape, np.float32)
+        label[4:16, 4:16, 4:16] = rng.randint(0, 4, size=(12, 12, 12))
+        for j, volume in enumerate(images + [label]):
+            filename = os.path.join(path, 'subject_{}_{}.nii.gz'.format(subject, j))
+            nib.save(nib.Nifti1Image(volume, np.eye(4)), filename)
+            ls[j].append(filename)
+
+    pool = SharedVolumePool(*ls, dataset_name='brats2018', normalization='max_min', crop_size=crop_size)
+    assert pool.images.is_shared() and pool.labels.is_shared()
+    for subject, shape in enumerate(shapes):
+        images, label = pool.volume(subject)
+        assert images.shape == (2,) + shape and label.shape == shape
+        for j in range(2):
+            expected = img_loader.load_medical_image(ls[j][subject], type='T1', normalization='max_min')
+            assert np.array_equal(images[j].numpy(), expected.numpy())
+        assert pool.crop_samplers[subject] is not None
+    try:
+        pickle.dumps(pool)
+        raise AssertionError('the pool was pickled')
+    except TypeError:
+        pass
+    print('pool of {} subjects, crop samplers built once, plain pickling refused'.format(len(pool)))
+
+    sampler = OnlinePatchSampler(*ls, dataset_name='brats2018', samples=16, full_vol_dim=shapes[0],
+                                 crop_size=crop_size, seed=1, pool=pool)
+    # a saved sampler leaves the pool behind
+    assert pickle.loads(pickle.dumps(sampler)).pool is None
+    expected = [sampler[i] for i in range(len(sampler))]
+    for workers in (0, 2):
+        loader = DataLoader(sampler, batch_size=4, num_workers=workers)
+        items = [tuple(t[b].numpy() for t in batch) for batch in loader for b in range(len(batch[0]))]
+        assert len(items) == len(expected)
+        assert all(np.array_equal(a, b) for item, other in zip(items, expected) for a, b in zip(item, other))
+    print('DataLoader workers cut the same crops from the shared pool')